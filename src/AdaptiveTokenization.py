@@ -0,0 +1,170 @@
+import time
+import numpy as np
+import torch
+from typing import Callable, Dict, List, Sequence
+
+from Metrics import REGISTRY, SIZE_BUCKETS, stage_timer
+
+'''
+Length-aware tokenization for the transformer models.
+
+Padding every input to max_length=512 makes a ten-word abstract cost as much as a
+full page, and attention grows quadratically with the padded length. Here inputs are
+tokenized without padding, sorted by length, grouped so that each group is padded
+only to its own longest member (rounded up to a length bucket so the kernels see a
+few repeating shapes), and no group exceeds max_batch_tokens padded tokens.
+
+Long inputs are either truncated or split into overlapping max_length windows whose
+logits are averaged, weighted by window length. token_budget caps the tokens read
+from one input, which bounds the worst-case cost of a single request.
+'''
+
+LENGTH_BUCKETS = (16, 32, 64, 128, 256, 384, 512)
+MAX_BATCH_TOKENS = 8192
+CHUNK_STRIDE = 64
+
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def bucket_length(length: int, buckets: Sequence[int] = LENGTH_BUCKETS) -> int:
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return length
+
+
+def plan_batches(lengths: Sequence[int], max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 buckets: Sequence[int] = LENGTH_BUCKETS) -> List[List[int]]:
+    """
+    Groups input indices into batches of similar length.
+    Returns:
+        Lists of indices, shortest inputs first. Every batch has at least one index and,
+        unless a single input is longer, at most max_batch_tokens padded tokens.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        padded = bucket_length(lengths[i], buckets)
+        # Sorted ascending, so the newest member sets the padded length of the batch
+        if batch and padded * (len(batch) + 1) > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class AdaptiveClassifier:
+    """
+    Tokenizes, batches and pools for a sequence classifier.
+
+        classifier = AdaptiveClassifier(tokenizer, runtime.predict_logits, long_inputs='chunk')
+        logits = classifier.logits(texts)       # (len(texts), num_labels)
+    """
+
+    def __init__(self, tokenizer, predict_logits: Callable[[Dict[str, torch.Tensor]], np.ndarray],
+                 max_length: int = 512, long_inputs: str = 'truncate', token_budget: int = 2048,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS, stride: int = CHUNK_STRIDE, name: str = 'arxiv',
+                 endpoint: str = None):
+        if long_inputs not in ('truncate', 'chunk'):
+            raise ValueError(f"Unknown long input strategy: {long_inputs}")
+        self.tokenizer = tokenizer
+        self.predict_logits = predict_logits
+        self.max_length = max_length
+        self.long_inputs = long_inputs
+        self.token_budget = token_budget
+        self.max_batch_tokens = max_batch_tokens
+        self.stride = stride
+        # Room for [CLS] and [SEP] in every window
+        self.window = max_length - tokenizer.num_special_tokens_to_add()
+
+        labels = {'model': name}
+        self.tokens_histogram = REGISTRY.histogram('tokenized_input_tokens', 'Tokens per input after truncation', TOKEN_BUCKETS, labels)
+        self.chunks_histogram = REGISTRY.histogram('tokenized_input_chunks', 'Windows per input', SIZE_BUCKETS, labels)
+        self.padding_counter = REGISTRY.counter('tokenized_padding_tokens_total', 'Padding tokens sent to the model', labels)
+        self.real_counter = REGISTRY.counter('tokenized_real_tokens_total', 'Non-padding tokens sent to the model', labels)
+        # Tokenization and model_forward time of each logits() call, under the endpoint that serves it
+        self.stages = stage_timer(endpoint) if endpoint is not None else None
+
+    def _windows(self, ids: List[int]) -> List[List[int]]:
+        ids = ids[:self.token_budget]
+        if len(ids) <= self.window or self.long_inputs == 'truncate':
+            return [ids[:self.window]]
+        step = self.window - self.stride
+        return [ids[start:start + self.window] for start in range(0, max(1, len(ids) - self.stride), step)]
+
+    def _batch_inputs(self, segments: List[List[int]]) -> Dict[str, torch.Tensor]:
+        rows = [self.tokenizer.build_inputs_with_special_tokens(segment) for segment in segments]
+        types = [self.tokenizer.create_token_type_ids_from_sequences(segment) for segment in segments]
+        width = min(self.max_length, bucket_length(max(len(row) for row in rows)))
+
+        input_ids = np.full((len(rows), width), self.tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(rows), width), dtype=np.int64)
+        token_type_ids = np.zeros((len(rows), width), dtype=np.int64)
+        for i, (row, row_types) in enumerate(zip(rows, types)):
+            input_ids[i, :len(row)] = row
+            attention_mask[i, :len(row)] = 1
+            token_type_ids[i, :len(row_types)] = row_types
+
+        real = int(attention_mask.sum())
+        self.real_counter.inc(real)
+        self.padding_counter.inc(attention_mask.size - real)
+        return {
+            'input_ids'         : torch.from_numpy(input_ids),
+            'attention_mask'    : torch.from_numpy(attention_mask),
+            'token_type_ids'    : torch.from_numpy(token_type_ids),
+        }
+
+    def logits(self, texts: List[str]) -> np.ndarray:
+        start = time.perf_counter()
+        forward_seconds = 0.0
+        encoded = self.tokenizer(texts, add_special_tokens=False, truncation=False)['input_ids']
+
+        owners, segments = [], []
+        for text_index, ids in enumerate(encoded):
+            windows = self._windows(ids)
+            self.tokens_histogram.observe(sum(len(window) for window in windows))
+            self.chunks_histogram.observe(len(windows))
+            owners.extend([text_index] * len(windows))
+            segments.extend(windows)
+
+        segment_logits = [None] * len(segments)
+        lengths = [len(segment) + 2 for segment in segments]
+        for batch in plan_batches(lengths, self.max_batch_tokens):
+            inputs = self._batch_inputs([segments[i] for i in batch])
+            forward_start = time.perf_counter()
+            batch_logits = self.predict_logits(inputs)
+            forward_seconds += time.perf_counter() - forward_start
+            for i, row in zip(batch, batch_logits):
+                segment_logits[i] = row
+        if self.stages is not None:
+            self.stages.observe('tokenization', time.perf_counter() - start - forward_seconds)
+            self.stages.observe('model_forward', forward_seconds)
+
+        # Pool the windows of each text, longer windows weigh more
+        pooled = np.zeros((len(texts), segment_logits[0].shape[-1]), dtype=np.float32)
+        weights = np.zeros(len(texts), dtype=np.float32)
+        for owner, segment, row in zip(owners, segments, segment_logits):
+            pooled[owner] += len(segment) * row
+            weights[owner] += len(segment)
+        return pooled / np.maximum(weights, 1)[:, None]
+
+
+def encode_sentences(model, sentences: List[str], max_batch_tokens: int = MAX_BATCH_TOKENS) -> List[np.ndarray]:
+    """
+    SentenceTransformer.encode() over length-planned batches: short queries are not padded
+    to the longest one that happened to arrive in the same micro-batch.
+    Truncation follows model.max_seq_length.
+    """
+    if not sentences:
+        return []
+    limit = model.max_seq_length
+    lengths = [min(len(ids) + 2, limit) for ids in model.tokenizer(sentences, add_special_tokens=False)['input_ids']]
+
+    embeddings = [None] * len(sentences)
+    for batch in plan_batches(lengths, max_batch_tokens):
+        vectors = model.encode([sentences[i] for i in batch], batch_size=len(batch), convert_to_numpy=True)
+        for i, vector in zip(batch, vectors):
+            embeddings[i] = vector
+    return embeddings
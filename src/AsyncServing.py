@@ -0,0 +1,337 @@
+import json
+import time
+import asyncio
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+import WebServer
+from WebServer import BAD_REQUEST, BUSY_RESPONSE, BadRequestError, NOT_READY_RESPONSE, PING_REQUEST, RETRY_AFTER_SECONDS
+from ConcurrentServing import BoundedExecutor, QueueFullError
+from ModelLoading import ModelNotReadyError
+from PostGresQueryGenerator import PGQuery as PGQ, PoolTimeoutError
+from VectorIndex import search_settings
+from Metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, stage_timer
+
+'''
+asyncio front end for the SidHubHttpServer endpoints.
+
+One event loop serves every connection as a coroutine: HTTP/1.1 keep-alive and
+pipelined requests (answered in order) cost a buffer each instead of a thread, and an
+idle client holds no worker. The routing and responses are the same as WebServer's.
+
+Work that blocks stays off the loop:
+    arxivClassification     awaits the arxiv micro-batcher's future, no thread waits on it
+    360PiazzaDatabase       encodes the query on the I/O executor (the embedding cache
+                            blocks on its batcher) and queries Postgres through asyncpg
+Without asyncpg, with the local vector index or with the hybrid search, the whole
+Piazza handler runs on the I/O executor against the psycopg2 pool. Full executors answer 503 like the threaded server.
+Search responses come from WebServer's response cache while the data version is unchanged.
+Requests and their stages are timed into the same metrics as WebServer's, GET /metrics serves them.
+
+    python AsyncServing.py
+'''
+
+PORT = WebServer.PORT
+DEFAULT_IP = WebServer.DEFAULT_IP
+
+# Blocking calls (query encoding, the psycopg2 fallback) and unbatched model calls
+IO_EXECUTOR_WORKERS = WebServer.IO_POOL_WORKERS
+IO_EXECUTOR_QUEUE = 256
+INFERENCE_WORKERS = WebServer.INFERENCE_WORKERS
+INFERENCE_QUEUE = WebServer.INFERENCE_QUEUE
+
+# asyncpg pool; it prepares and caches statements per connection itself
+ASYNC_PG_POOL_MIN_SIZE = 1
+ASYNC_PG_POOL_MAX_SIZE = 16
+ASYNC_PG_STATEMENT_CACHE_SIZE = 256
+
+KEEPALIVE_TIMEOUT_SECONDS = 15
+REQUEST_TIMEOUT_SECONDS = 120
+MAX_BODY_BYTES = 1024 * 1024
+LISTEN_BACKLOG = 1024
+
+STATUS_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+io_executor = None
+pg_pool = None
+
+connections_gauge = REGISTRY.gauge('async_open_connections', 'Connections held open by the asyncio front end')
+requests_counter = REGISTRY.counter('async_requests_total', 'Requests read by the asyncio front end')
+
+
+class HttpError(Exception):
+    def __init__(self, status: int):
+        super().__init__(STATUS_REASONS[status])
+        self.status = status
+
+
+def encode_response(status: int, data, keep_alive: bool, retry_after: bool = False,
+                    content_type: str = "application/json") -> bytes:
+    # Cached responses arrive already serialized
+    body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+    headers = [
+        f"HTTP/1.1 {status} {STATUS_REASONS[status]}",
+        f"Content-type: {content_type}",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    if retry_after:
+        headers.append(f"Retry-After: {RETRY_AFTER_SECONDS}")
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str], bytes]]:
+    """
+    Reads one request off the connection.
+    Returns:
+        (method, path, version, headers with lower-case names, body), or None when the
+        client closed the connection between requests.
+    Raises:
+        HttpError: malformed request or body over MAX_BODY_BYTES.
+    """
+    request_line = await reader.readline()
+    while request_line in (b'\r\n', b'\n'):
+        # Stray CRLF between pipelined requests is allowed
+        request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(400)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise HttpError(400)
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HttpError(400)
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length else b''
+    return method, path, version, headers, body
+
+
+def wants_keep_alive(version: str, headers: Dict[str, str]) -> bool:
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+async def run_blocking(executor: BoundedExecutor, fn, *args):
+    """
+    Runs fn on a bounded executor and awaits it without blocking the loop.
+    Raises:
+        QueueFullError: the executor is full.
+    """
+    return await asyncio.wrap_future(executor.submit(fn, *args))
+
+
+async def classify_arxiv(text: str) -> dict:
+    WebServer.validate_text(text)
+    WebServer.model_loader.require('arxiv')
+    if WebServer.arxiv_batcher is not None:
+        prediction = await asyncio.wrap_future(WebServer.arxiv_batcher.submit(text))
+    else:
+        prediction = await run_blocking(WebServer.inference_pool, WebServer.classify_arxiv, text)
+    return {"message": WebServer.LABEL_DESCRIPTIONS[prediction]}
+
+
+def encode_query(query: str) -> np.ndarray:
+    if WebServer.query_embedding_cache is not None:
+        return WebServer.query_embedding_cache.get(query)
+    return WebServer.run_inference(WebServer.piazza_db_tokenizer.encode, query)
+
+
+async def search_piazza(query: str, ef_search: int = None, probes: int = None, semesters: tuple = None) -> dict:
+    if pg_pool is None or WebServer.PIAZZA_SEARCH_BACKEND != 'sql' or WebServer.PIAZZA_SEARCH_MODE != 'vector':
+        return await run_blocking(io_executor, WebServer.SidHubHttpServer.handle_360_Piazza_Database, query, ef_search, probes, semesters)
+
+    WebServer.model_loader.require('piazza')
+    stages = WebServer.piazza_stages
+    with stages.stage('query_encoding'):
+        query_embedding = await run_blocking(io_executor, encode_query, query)
+
+    statement, values = WebServer.similar_posts_query(PGQ(), query_embedding, semesters).numbered()
+    checkout_start = time.perf_counter()
+    async with pg_pool.acquire() as connection:
+        stages.observe('db_checkout', time.perf_counter() - checkout_start)
+        # SET LOCAL only lasts until the end of this transaction
+        with stages.stage('sql_execution'):
+            async with connection.transaction():
+                for setting, value in search_settings(WebServer.search_ef(ef_search), probes).items():
+                    await connection.execute(f"SET LOCAL {setting} = {int(value)}")
+                rows = await connection.fetch(statement, *[PGQ.toParam(value) for value in values])
+    with stages.stage('row_shaping'):
+        return WebServer.posts_response(rows)
+
+
+async def handle_post(endpoint: str, data: dict):
+    """
+    Routes a parsed POST body on its endpoint (WebServer.request_endpoint), like SidHubHttpServer.do_POST.
+    Returns:
+        (status code, JSON data or serialized JSON bytes)
+    """
+    if endpoint == WebServer.ARXIV_ENDPOINT:
+        return 200, WebServer.serialize(WebServer.arxiv_stages, await classify_arxiv(data['data']))
+    if endpoint == WebServer.PIAZZA_ENDPOINT:
+        options = WebServer.search_options(data)
+        key, version, body = WebServer.search_cache_lookup(data['data'], options)
+        if body is None:
+            body = WebServer.search_cache_store(key, version, await search_piazza(data['data'], **options))
+        return 200, body
+    return 200, PING_REQUEST
+
+
+async def respond(method: str, path: str, body: bytes):
+    """
+    Returns:
+        (status code, JSON data, whether to send Retry-After); GET /metrics returns the Prometheus text
+    """
+    start = time.perf_counter()
+    endpoint = 'ping'
+    status = 200
+    try:
+        if method == 'GET':
+            endpoint = WebServer.GET_ENDPOINTS.get(path, 'ping')
+            if path == WebServer.METRICS_PATH:
+                return status, REGISTRY.prometheus_text().encode('utf-8'), False
+            status, data = WebServer.get_response(path)
+            if status == 503:
+                data = dict(NOT_READY_RESPONSE, models=data['models'])
+            return status, data, status == 503
+        if method != 'POST':
+            status = 405
+            return status, BAD_REQUEST, False
+
+        try:
+            parse_start = time.perf_counter()
+            data = json.loads(body.decode('utf-8'))
+            endpoint = WebServer.request_endpoint(data)
+            stage_timer(endpoint).observe('json_parse', time.perf_counter() - parse_start)
+            status, data = await handle_post(endpoint, data)
+            return status, data, False
+        except (QueueFullError, PoolTimeoutError) as e:
+            print(e)
+            status = 503
+            return status, BUSY_RESPONSE, True
+        except ModelNotReadyError as e:
+            print(e)
+            status = 503
+            return status, dict(NOT_READY_RESPONSE, models=e.status), True
+        except BadRequestError as e:
+            print(e)
+            status = 400
+            return status, BAD_REQUEST, False
+        except Exception as e:
+            print(e)
+            return status, BAD_REQUEST, False
+    finally:
+        WebServer.observe_request(method, endpoint, status, time.perf_counter() - start)
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    connections_gauge.inc()
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT_SECONDS)
+            except HttpError as e:
+                writer.write(encode_response(e.status, BAD_REQUEST, keep_alive=False))
+                await writer.drain()
+                break
+            if request is None:
+                break
+
+            method, path, version, headers, body = request
+            requests_counter.inc()
+            status, data, retry_after = await asyncio.wait_for(respond(method, path, body), REQUEST_TIMEOUT_SECONDS)
+            keep_alive = wants_keep_alive(version, headers)
+            content_type = PROMETHEUS_CONTENT_TYPE if method == 'GET' and path == WebServer.METRICS_PATH else "application/json"
+            writer.write(encode_response(status, data, keep_alive, retry_after, content_type))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        connections_gauge.dec()
+        writer.close()
+
+
+async def init_pg_connection(connection):
+    # pgvector is not an asyncpg built-in type, vectors go over the wire as pgvector text
+    await connection.set_type_codec('vector', encoder=PGQ.toParam, decoder=PGQ.fromVector, format='text')
+
+
+async def create_pg_pool():
+    """
+    The asyncpg pool for the Piazza search, or None when asyncpg is not installed.
+    """
+    try:
+        import asyncpg
+    except ImportError:
+        print("asyncpg is not installed, Piazza searches use the psycopg2 pool on the I/O executor")
+        return None
+
+    login = dict(WebServer.POSTGRES_LOGIN)
+    login['database'] = login.pop('dbname')
+    login['port'] = int(login['port'])
+    return await asyncpg.create_pool(
+        **login,
+        min_size=ASYNC_PG_POOL_MIN_SIZE,
+        max_size=ASYNC_PG_POOL_MAX_SIZE,
+        statement_cache_size=ASYNC_PG_STATEMENT_CACHE_SIZE,
+        init=init_pg_connection,
+    )
+
+
+async def serve(host: str = DEFAULT_IP, port: int = PORT, started: asyncio.Event = None):
+    """
+    Serves until cancelled. The models should be loading or loaded (WebServer.start_up);
+    requests for a model still loading get the 503 readiness response.
+    """
+    global io_executor
+    global pg_pool
+
+    io_executor = BoundedExecutor(IO_EXECUTOR_WORKERS, IO_EXECUTOR_QUEUE, name='async-io')
+    WebServer.inference_pool = BoundedExecutor(INFERENCE_WORKERS, INFERENCE_QUEUE, name='inference')
+    server = await asyncio.start_server(handle_connection, host, port, backlog=LISTEN_BACKLOG)
+    WebServer.startup_phases.mark('bound')
+    if started is not None:
+        started.set()
+    try:
+        pg_pool = await create_pg_pool()
+    except Exception as e:
+        print(f"Could not connect asyncpg, using the psycopg2 pool: {e}")
+        pg_pool = None
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if pg_pool is not None:
+            await pg_pool.close()
+        io_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    WebServer.startup_phases.mark('imported')
+    WebServer.start_up(background=True)
+    print(f"Serving on port {PORT} (asyncio)")
+    asyncio.run(serve())
@@ -0,0 +1,70 @@
+import time
+import numpy as np
+from typing import Hashable, List, Tuple
+
+from Metrics import REGISTRY
+
+'''
+Batched sentence encoding for ingestion.
+
+Instead of one encoder.encode() call per sentence, every sentence from a window of
+posts is collected into one list, de-duplicated, sorted by length so each batch pads
+to similar lengths, encoded in batches of batch_size and mapped back to its tag.
+'''
+
+MIN_SENTENCE_LENGTH = 20
+ENCODE_BATCH_SIZE = 64
+
+
+def split_sentences(text: str, min_length: int = MIN_SENTENCE_LENGTH) -> List[str]:
+    """
+    Splits on '.' and keeps the pieces longer than min_length characters,
+    the same rule the scraper has always used.
+    """
+    return [sentence for sentence in text.split('.') if len(sentence) > min_length]
+
+
+def post_sentences(title: str, content: str, instructor_answer: str, student_answer: str) -> List[Tuple[str, str]]:
+    """
+    Returns (field, sentence) pairs for one cleaned post: the whole title,
+    then the sentences of the content, instructor answer and student answer.
+    """
+    sentences = [('post_title', title)]
+    for field, text in (('post_content', content), ('instructor_answer', instructor_answer), ('student_answer', student_answer)):
+        sentences.extend((field, sentence) for sentence in split_sentences(text))
+    return sentences
+
+
+class SentenceBatchEncoder:
+    def __init__(self, encoder, batch_size: int = ENCODE_BATCH_SIZE):
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.sentences_counter = REGISTRY.counter('ingest_sentences_encoded_total', 'Sentences encoded during ingestion')
+        self.seconds_counter = REGISTRY.counter('ingest_encode_seconds_total', 'Time spent encoding during ingestion')
+        self.last_stats = {}
+
+    def encode(self, items: List[Tuple[Hashable, str]]) -> List[Tuple[Hashable, np.ndarray]]:
+        """
+        Encodes (tag, sentence) pairs and returns (tag, embedding) pairs in the same order.
+        """
+        if not items:
+            return []
+
+        start = time.perf_counter()
+        unique = list(dict.fromkeys(sentence for _, sentence in items))
+        # Longest first, so the first batch also surfaces memory problems early
+        unique.sort(key=len, reverse=True)
+
+        vectors = self.encoder.encode(unique, batch_size=self.batch_size, convert_to_numpy=True)
+        by_sentence = dict(zip(unique, vectors))
+        seconds = time.perf_counter() - start
+
+        self.sentences_counter.inc(len(unique))
+        self.seconds_counter.inc(seconds)
+        self.last_stats = {
+            'sentences'             : len(items),
+            'unique_sentences'      : len(unique),
+            'seconds'               : seconds,
+            'sentences_per_second'  : len(unique) / seconds if seconds > 0 else float('inf'),
+        }
+        return [(tag, by_sentence[sentence]) for tag, sentence in items]
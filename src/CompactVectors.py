@@ -0,0 +1,133 @@
+import sys
+from typing import Dict, List, Sequence
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from VectorIndex import create_vector_index, describe_vector_index, VECTOR_INDEX_NAME, VECTOR_TABLE
+
+'''
+Compact copies of Embeddings.embedding for a coarse first search pass, reranked exactly.
+
+    halfvec     embedding_half  halfvec(768)    1536 bytes  cosine distance on float16
+    binary      embedding_bits  bit(768)          96 bytes  Hamming distance between the signs
+
+(a float32 vector(768) is 3072 bytes). Both are generated columns: Postgres fills them
+from embedding on every INSERT and COPY, so ingestion sends nothing extra, and adding one
+computes it for the stored rows once (a table rewrite). Each gets its own ANN index.
+
+A quantized search walks the compact index for the RERANK_CANDIDATES nearest rows, then
+orders only those rows by the exact cosine distance on the full-precision embedding.
+The float32 index is then no longer read by searches; dropping it
+(python VectorIndex.py drop) is where most of the disk and cache saving comes from.
+
+    python CompactVectors.py add binary
+    python CompactVectors.py show
+'''
+
+QUANTIZATIONS = {
+    'halfvec' : {
+        'column'    : 'embedding_half',
+        'type'      : 'halfvec(768)',
+        'expression': 'embedding::halfvec(768)',
+        'opclass'   : 'halfvec_cosine_ops',
+        # The parameter is cast to vector first so it has the same type wherever it is used
+        'distance'  : 'embedding_half <=> %s::vector::halfvec(768)',
+    },
+    'binary' : {
+        'column'    : 'embedding_bits',
+        'type'      : 'bit(768)',
+        'expression': 'binary_quantize(embedding)::bit(768)',
+        'opclass'   : 'bit_hamming_ops',
+        'distance'  : 'embedding_bits <~> binary_quantize(%s::vector)::bit(768)',
+    },
+}
+
+# Rows taken from the compact index for every reranked result; at least the search's LIMIT
+RERANK_CANDIDATES = 400
+
+
+def compact_column(quantization: str) -> str:
+    """
+    The generated column definition of a quantization, for CREATE or ALTER TABLE.
+    """
+    spec = QUANTIZATIONS[quantization]
+    return f"{spec['column']} {spec['type']} GENERATED ALWAYS AS ({spec['expression']}) STORED"
+
+
+def compact_index_name(quantization: str) -> str:
+    return f"embeddings_{QUANTIZATIONS[quantization]['column']}_idx"
+
+
+def add_compact_vectors(SQL: PGQ, quantization: str, method: str = 'hnsw', table_name: str = VECTOR_TABLE):
+    """
+    Adds the compact column of a quantization and its ANN index when they do not exist yet.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown vector quantization: {quantization}")
+    spec = QUANTIZATIONS[quantization]
+
+    SQL.ALTER_TABLE(table_name).ADD_COLUMN(compact_column(quantization), if_not_exists=True).execute_nofetch(raise_errors=True)
+    SQL.commit()
+    if describe_vector_index(SQL, compact_index_name(quantization)) is None:
+        create_vector_index(SQL, method, index_name=compact_index_name(quantization), table_name=table_name,
+                            column=spec['column'], opclass=spec['opclass'])
+
+
+def coarse_candidates(SQL: PGQ, quantization: str, query_embedding, limit: int = RERANK_CANDIDATES,
+                      semester_ids: Sequence[int] = None) -> PGQ:
+    """
+    Appends a subquery, aliased CoarseCandidates, of the limit rows nearest to
+    query_embedding by the compact column, with their full-precision embedding for the rerank.
+    """
+    SQL.P(
+    ).SELECT([
+        'semester_id',
+        'post_id',
+        'embedding'
+    ]).FROM([
+        'embeddings'
+    ])
+    if semester_ids is not None:
+        SQL.WHERE('semester_id = ANY(%s::int[])', [[int(semester_id) for semester_id in semester_ids]])
+    return SQL.ORDER_BY([
+        QUANTIZATIONS[quantization]['distance']
+    ], [query_embedding]).LIMIT(
+        limit
+    ).EP(
+    ).AS(
+        'CoarseCandidates'
+    )
+
+
+def storage_footprint(SQL: PGQ, table_name: str = VECTOR_TABLE, index_names: List[str] = None) -> Dict[str, int]:
+    """
+    Bytes on disk of the table (heap and TOAST) and of each index, summed over partitions.
+    Missing indexes count 0.
+    """
+    if index_names is None:
+        index_names = [VECTOR_INDEX_NAME] + [compact_index_name(quantization) for quantization in QUANTIZATIONS]
+
+    sizes = {}
+    for name, size_function in [(table_name, 'pg_table_size')] + [(index_name, 'pg_relation_size') for index_name in index_names]:
+        sizes[name.lower()] = int(SQL.SELECT([
+            f'COALESCE(SUM({size_function}(relid)), 0)'
+        ]).FROM([
+            f'pg_partition_tree(to_regclass({PGQ.toString(name.lower())}))'
+        ]).execute_fetch(raise_errors=True)[0][0])
+    return sizes
+
+
+if __name__ == "__main__":
+    from WebServer import POSTGRES_LOGIN
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    SQL = PGQ()
+    SQL.login(POSTGRES_LOGIN)
+
+    if command == 'add':
+        add_compact_vectors(SQL, sys.argv[2] if len(sys.argv) > 2 else 'binary')
+    elif command != 'show':
+        print(f"Unknown command: {command}")
+        sys.exit(1)
+
+    for name, size in storage_footprint(SQL).items():
+        print(f"{name:>32}  {size / 1024 / 1024:10.1f} MB")
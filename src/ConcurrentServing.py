@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a bounded executor has no free slot for another task.
+    The web server turns this into a 503 with a Retry-After header.
+    """
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a hard cap on the number of running + waiting tasks.
+
+    A plain ThreadPoolExecutor queues without limit, so a burst of slow requests
+    just grows the backlog until clients time out. Here every task takes a slot
+    out of max_workers + max_queue, and submit() fails fast once they are gone.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, name: str = 'pool'):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Schedules fn(*args, **kwargs) on the pool.
+        Raises:
+            QueueFullError: all worker and queue slots are taken.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(f"{self.name} queue is full")
+
+        with self._lock:
+            self._in_flight += 1
+            self.submitted += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def run(self, fn, *args, timeout: float = None, **kwargs):
+        """
+        Submits fn and blocks the calling thread until it finishes.
+        """
+        return self.submit(fn, *args, **kwargs).result(timeout)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_workers'   : self.max_workers,
+                'max_queue'     : self.max_queue,
+                'in_flight'     : self._in_flight,
+                'submitted'     : self.submitted,
+                'rejected'      : self.rejected,
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
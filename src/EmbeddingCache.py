@@ -0,0 +1,140 @@
+import re
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, List
+
+from MicroBatching import InferenceBatcher
+from Metrics import REGISTRY
+
+WHITESPACE = re.compile(r'\s+')
+TRAILING_PUNCTUATION = '?!.,;: '
+
+# Rough per-entry bookkeeping cost on top of the vector and key (dict slot, tuple, ndarray header)
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def normalize_query(text: str) -> str:
+    """
+    Maps near-identical queries to the same cache key:
+    case-folded, whitespace collapsed and trailing punctuation removed.
+    """
+    return WHITESPACE.sub(' ', text.casefold()).strip().rstrip(TRAILING_PUNCTUATION)
+
+
+class EmbeddingCache:
+    """
+    LRU + TTL cache of query embeddings with a memory budget.
+
+    Misses are handed to an InferenceBatcher, so misses that arrive together are
+    encoded in one batched call. Concurrent misses for the same key share a single
+    pending encode instead of encoding the text twice.
+    Only the key is normalized: the encoder gets the text as the user wrote it, and
+    variants of a query share the embedding of the first one encoded.
+    """
+
+    def __init__(self, encode_batch: Callable[[List[str]], List[np.ndarray]], max_bytes: int = 32 * 1024 * 1024,
+                 ttl_seconds: float = 6 * 3600, max_batch_size: int = 32, max_wait_ms: float = 5,
+                 max_queue: int = 256, name: str = 'query'):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.name = name
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._batcher = InferenceBatcher(encode_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                                         max_queue=max_queue, name=f'{name}_encode')
+
+        labels = {'cache': name}
+        self.hits = REGISTRY.counter('embedding_cache_hits_total', 'Lookups answered from the cache', labels)
+        self.misses = REGISTRY.counter('embedding_cache_misses_total', 'Lookups that had to encode', labels)
+        self.coalesced = REGISTRY.counter('embedding_cache_coalesced_total', 'Misses that joined a pending encode', labels)
+        self.evictions = REGISTRY.counter('embedding_cache_evictions_total', 'Entries dropped to stay within max_bytes', labels)
+        self.expirations = REGISTRY.counter('embedding_cache_expirations_total', 'Entries dropped after the TTL', labels)
+        self.entries_gauge = REGISTRY.gauge('embedding_cache_entries', 'Entries currently cached', labels)
+        self.bytes_gauge = REGISTRY.gauge('embedding_cache_bytes', 'Approximate memory held by the cache', labels)
+
+    def get(self, text: str) -> np.ndarray:
+        """
+        Returns the embedding of text, encoding it on a miss.
+        Raises:
+            QueueFullError: the encode queue is full.
+        """
+        key = normalize_query(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                embedding, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits.inc()
+                    return embedding
+                self._remove(key)
+                self.expirations.inc()
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses.inc()
+                future = self._batcher.submit(text)
+                self._in_flight[key] = future
+            else:
+                self.coalesced.inc()
+
+        if owner:
+            # Registered outside the lock: an already finished future runs the callback right here
+            future.add_done_callback(lambda f: self._store(key, f))
+        return future.result()
+
+    def _store(self, key: str, future):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if future.exception() is not None:
+                return
+
+            embedding = np.ascontiguousarray(future.result(), dtype=np.float32)
+            embedding.setflags(write=False)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (embedding, time.monotonic() + self.ttl)
+            self.bytes += self._entry_bytes(key, embedding)
+
+            while self.bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions.inc()
+            self._update_gauges()
+
+    def _remove(self, key: str):
+        embedding, _ = self._entries.pop(key)
+        self.bytes -= self._entry_bytes(key, embedding)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        self.entries_gauge.set(len(self._entries))
+        self.bytes_gauge.set(self.bytes)
+
+    @staticmethod
+    def _entry_bytes(key: str, embedding: np.ndarray) -> int:
+        return embedding.nbytes + len(key) + ENTRY_OVERHEAD_BYTES
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self._update_gauges()
+
+    def stats(self) -> dict:
+        lookups = self.hits.value + self.misses.value + self.coalesced.value
+        return {
+            'entries'       : len(self._entries),
+            'bytes'         : self.bytes,
+            'max_bytes'     : self.max_bytes,
+            'hits'          : self.hits.value,
+            'misses'        : self.misses.value,
+            'coalesced'     : self.coalesced.value,
+            'evictions'     : self.evictions.value,
+            'expirations'   : self.expirations.value,
+            'hit_ratio'     : (self.hits.value / lookups) if lookups else 0.0,
+        }
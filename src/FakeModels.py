@@ -0,0 +1,135 @@
+import zlib
+import numpy as np
+from typing import Dict, List
+
+'''
+Random-weight stand-ins for the arxiv classifier and the Piazza sentence encoder, for
+exercising the serving path without the downloaded models. Both tokenize by hashing
+words, so nothing is read from disk or the hub.
+
+    FakeClassifier      a small BertForSequenceClassification with random weights, served
+                        through ModelRuntime.EagerRuntime and AdaptiveClassifier like the real one
+    FakeSentenceEncoder SentenceTransformer.encode() lookalike: the normalized mean of fixed
+                        random word vectors, so texts sharing words get similar embeddings
+
+The predictions mean nothing; the shapes, batching and per-request cost are the server's.
+install_fake_models() registers them with WebServer's model loader in place of the real ones.
+'''
+
+HASH_VOCAB_SIZE = 8192
+PAD_TOKEN_ID = 0
+CLS_TOKEN_ID = 1
+SEP_TOKEN_ID = 2
+FIRST_WORD_ID = 3
+
+EMBEDDING_DIM = 768
+
+# Default size of the random BERT: big enough that the forward pass dominates like the real one
+CLASSIFIER_HIDDEN_SIZE = 128
+CLASSIFIER_LAYERS = 2
+CLASSIFIER_HEADS = 2
+
+
+class HashingTokenizer:
+    """
+    The parts of a transformers tokenizer AdaptiveClassifier and encode_sentences use,
+    with word ids from a hash of each lower-cased word.
+    """
+    pad_token_id = PAD_TOKEN_ID
+
+    def __init__(self, vocab_size: int = HASH_VOCAB_SIZE):
+        self.vocab_size = vocab_size
+
+    def word_ids(self, text: str) -> List[int]:
+        return [FIRST_WORD_ID + zlib.crc32(word.encode('utf-8')) % (self.vocab_size - FIRST_WORD_ID)
+                for word in text.lower().split()]
+
+    def __call__(self, texts: List[str], add_special_tokens: bool = True, truncation: bool = False, **kwargs) -> Dict[str, list]:
+        if isinstance(texts, str):
+            texts = [texts]
+        ids = [self.word_ids(text) for text in texts]
+        if add_special_tokens:
+            ids = [self.build_inputs_with_special_tokens(row) for row in ids]
+        return {'input_ids': ids}
+
+    def build_inputs_with_special_tokens(self, ids: List[int]) -> List[int]:
+        return [CLS_TOKEN_ID] + list(ids) + [SEP_TOKEN_ID]
+
+    def create_token_type_ids_from_sequences(self, ids: List[int]) -> List[int]:
+        return [0] * (len(ids) + 2)
+
+
+def make_fake_classifier(num_labels: int, hidden_size: int = CLASSIFIER_HIDDEN_SIZE, layers: int = CLASSIFIER_LAYERS,
+                         heads: int = CLASSIFIER_HEADS, seed: int = 0):
+    """
+    Returns:
+        (HashingTokenizer, EagerRuntime over a randomly initialised BertForSequenceClassification)
+    """
+    import torch
+    from transformers import BertConfig, BertForSequenceClassification
+    from ModelRuntime import EagerRuntime
+
+    torch.manual_seed(seed)
+    tokenizer = HashingTokenizer()
+    config = BertConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=hidden_size,
+        num_hidden_layers=layers,
+        num_attention_heads=heads,
+        intermediate_size=4 * hidden_size,
+        max_position_embeddings=512,
+        num_labels=num_labels,
+    )
+    return tokenizer, EagerRuntime(BertForSequenceClassification(config))
+
+
+class FakeSentenceEncoder:
+    """
+    Stands in for the SentenceTransformer behind WebServer.piazza_db_tokenizer.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, max_seq_length: int = 128, seed: int = 0):
+        self.tokenizer = HashingTokenizer()
+        self.max_seq_length = max_seq_length
+        rng = np.random.default_rng(seed)
+        self.word_vectors = rng.standard_normal((self.tokenizer.vocab_size, dim)).astype(np.float32)
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        embeddings = np.zeros((len(sentences), self.word_vectors.shape[1]), dtype=np.float32)
+        for i, ids in enumerate(self.tokenizer(sentences, add_special_tokens=False)['input_ids']):
+            ids = ids[:self.max_seq_length - 2]
+            if ids:
+                embeddings[i] = self.word_vectors[ids].mean(axis=0)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+def install_fake_models(WebServer, hidden_size: int = CLASSIFIER_HIDDEN_SIZE, layers: int = CLASSIFIER_LAYERS, seed: int = 0):
+    """
+    Registers loaders for the stand-ins under the real model names; WebServer.start_up()
+    then loads them instead of the real models. Call before start_up().
+    """
+    from AdaptiveTokenization import AdaptiveClassifier
+
+    def load_arxiv():
+        tokenizer, runtime = make_fake_classifier(WebServer.NUM_LABELS, hidden_size, layers, seed=seed)
+        WebServer.arxiv_classif_tokenizer = tokenizer
+        WebServer.arxiv_classif_model = runtime
+        WebServer.arxiv_classifier = AdaptiveClassifier(
+            tokenizer,
+            runtime.predict_logits,
+            max_length=WebServer.ARXIV_MAX_LENGTH,
+            long_inputs=WebServer.ARXIV_LONG_INPUTS,
+            token_budget=WebServer.ARXIV_TOKEN_BUDGET,
+            max_batch_tokens=WebServer.ARXIV_MAX_BATCH_TOKENS,
+            endpoint=WebServer.ARXIV_ENDPOINT,
+        )
+
+    def load_piazza():
+        WebServer.piazza_db_tokenizer = FakeSentenceEncoder(max_seq_length=WebServer.QUERY_MAX_SEQ_LENGTH, seed=seed)
+
+    WebServer.model_loader.register('arxiv', load_arxiv)
+    WebServer.model_loader.register('piazza', load_piazza)
@@ -0,0 +1,108 @@
+import random
+import threading
+from typing import Dict, Iterable
+
+'''
+In-memory stand-in for piazza_api, for exercising the scrape pipeline without
+network access or a Piazza account. Posts use the same dictionary layout as
+piazza_api's Network.get_post().
+'''
+
+SAMPLE_SENTENCES = [
+    "How do I compute the gradient of the loss with respect to the weights",
+    "The homework deadline was extended until Friday at midnight",
+    "Make sure the learning rate is small enough for gradient descent to converge",
+    "You can use the office hours on Tuesday to ask about the project",
+    "The midterm covers everything up to dynamic programming and greedy algorithms",
+    "Please check the autograder output before submitting a regrade request",
+    "Backpropagation applies the chain rule layer by layer",
+    "Recursion needs a base case or the stack will overflow",
+]
+
+
+class FakeRequestError(Exception):
+    pass
+
+
+def makeFakePost(post_id: int, rng: random.Random, private: bool = False, regrade: bool = False) -> dict:
+    def paragraph(sentences: int) -> str:
+        return '<p>' + '. '.join(rng.choice(SAMPLE_SENTENCES) for _ in range(sentences)) + '.</p>'
+
+    children = [{'type': 'i_answer', 'history': [{'content': paragraph(rng.randint(1, 3))}]}]
+    if rng.random() < 0.5:
+        children.append({'type': 's_answer', 'is_tag_endorse': True, 'history': [{'content': paragraph(2)}]})
+
+    return {
+        'nr'        : post_id,
+        'status'    : 'private' if private else 'active',
+        'folders'   : ['regrade'] if regrade else ['hw'],
+        'history'   : [{'subject': f'Question {post_id}: {rng.choice(SAMPLE_SENTENCES)}', 'content': paragraph(rng.randint(2, 6))}],
+        'children'  : children,
+    }
+
+
+class FakePiazzaNetwork:
+    """
+    Serves a set of posts. Ids listed in fail_once raise on their first fetch,
+    ids that were never generated always raise, like deleted posts on Piazza.
+    edit_post() replaces a post and moves its 'updated' time in the feed.
+    """
+    def __init__(self, posts: Dict[int, dict], fail_once: Iterable[int] = ()):
+        self.posts = posts
+        self.updated = {post_id: '2024-01-01T00:00:00Z' for post_id in posts}
+        self.edits = 0
+        self.fail_once = set(fail_once)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_post(self, post_id: int) -> dict:
+        with self._lock:
+            self.requests += 1
+            if post_id in self.fail_once:
+                self.fail_once.discard(post_id)
+                raise FakeRequestError(f"Temporary error fetching post {post_id}")
+        if post_id not in self.posts:
+            raise FakeRequestError(f"Post {post_id} not found")
+        return self.posts[post_id]
+
+    def get_feed(self, limit: int = 100, offset: int = 0) -> dict:
+        with self._lock:
+            self.requests += 1
+        post_ids = sorted(self.posts, reverse=True)[offset:offset + limit]
+        return {'feed': [{'nr': post_id, 'updated': self.updated[post_id]} for post_id in post_ids]}
+
+    def edit_post(self, post_id: int, post: dict):
+        self.edits += 1
+        self.posts[post_id] = post
+        self.updated[post_id] = f'2024-01-01T00:00:{self.edits:02d}Z'
+
+
+class FakePiazza:
+    """
+    Mimics piazza_api.Piazza: user_login(), get_user_classes() and network(nid).
+    """
+    def __init__(self, classes: Dict[str, FakePiazzaNetwork], class_num: str = 'CSCI 360'):
+        self.classes = classes
+        self.class_num = class_num
+        self.logins = 0
+
+    def user_login(self, email: str = None, password: str = None):
+        self.logins += 1
+
+    def get_user_classes(self):
+        return [{'nid': nid, 'num': self.class_num} for nid in self.classes]
+
+    def network(self, nid: str) -> FakePiazzaNetwork:
+        return self.classes[nid]
+
+
+def makeFakePiazza(num_classes: int = 1, posts_per_class: int = 50, seed: int = 0, **network_kwargs) -> FakePiazza:
+    rng = random.Random(seed)
+    classes = {}
+    for class_index in range(num_classes):
+        posts = {
+            post_id: makeFakePost(post_id, rng, private=(post_id % 17 == 0), regrade=(post_id % 23 == 0))
+            for post_id in range(5, 5 + posts_per_class)
+        }
+        classes[f'fakenid{class_index}'] = FakePiazzaNetwork(posts, **network_kwargs)
+    return FakePiazza(classes)
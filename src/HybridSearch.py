@@ -0,0 +1,141 @@
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from PostGresQueryGenerator import PGQuery as PGQ
+
+'''
+Hybrid lexical + vector retrieval for the Piazza search.
+
+Posts carries a generated tsvector (title weighted A, content B, answers C) with a GIN
+index. A search first takes the best LEXICAL_CANDIDATES posts matching any query term,
+then scores only the sentence embeddings of those posts against the query vector
+(through the (semester_id, post_id) index on Embeddings) instead of the whole table,
+and merges the lexical and the vector ranking with reciprocal-rank fusion:
+
+    score(post) = sum over rankings of 1 / (RRF_K + rank of post in that ranking)
+
+When fewer than MIN_LEXICAL_HITS posts match (typos, stop-word-only or purely
+conceptual queries), or fewer than that are left once the posts below MIN_SIMILARITY are
+dropped, hybrid_search returns None and the caller falls back to the plain vector search.
+'''
+
+TEXT_SEARCH_CONFIG = 'english'
+SEARCH_VECTOR_INDEX_NAME = 'posts_search_idx'
+
+# Schema of the generated column, used for new tables and added to existing ones
+SEARCH_VECTOR_COLUMN = (
+    "search_vector tsvector GENERATED ALWAYS AS ("
+    f"setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(post_title, '')), 'A') || "
+    f"setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(post_content, '')), 'B') || "
+    f"setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(instructor_answer, '') || ' ' || coalesce(student_answer, '')), 'C')"
+    ") STORED"
+)
+
+LEXICAL_CANDIDATES = 200
+MIN_LEXICAL_HITS = 5
+# 60 is the constant from the original RRF paper; larger values flatten the head of each ranking
+RRF_K = 60
+# Lexical hits whose best sentence is further from the query than this are dropped
+MIN_SIMILARITY = 0.5
+
+
+def create_search_vector(SQL: PGQ):
+    """
+    Adds Posts.search_vector and its GIN index when they do not exist yet.
+    Adding the column rewrites Posts once to compute it for the stored rows.
+    """
+    SQL.ALTER_TABLE('Posts').ADD_COLUMN(SEARCH_VECTOR_COLUMN, if_not_exists=True).execute_nofetch()
+    SQL.CREATE_INDEX(SEARCH_VECTOR_INDEX_NAME, 'Posts', ['search_vector'], using='gin', if_not_exists=True).execute_nofetch()
+
+
+def lexical_candidates(SQL: PGQ, query: str, limit: int = LEXICAL_CANDIDATES,
+                       semester_ids: Sequence[int] = None) -> List[Tuple[int, int]]:
+    """
+    Posts matching any term of query, best ts_rank_cd first, only from semester_ids when given.
+    Returns:
+        (semester_id, post_id) keys, at most limit of them.
+    """
+    # plainto_tsquery ANDs the terms; OR them so a post matching most of a question still qualifies
+    SQL.WITH(
+        "LexicalQuery AS"
+    ).P(
+    ).SELECT([
+        f"replace(plainto_tsquery('{TEXT_SEARCH_CONFIG}', %s)::text, '&', '|')::tsquery AS query"
+    ], [query]).EP(
+    ).SELECT([
+        'p.semester_id',
+        'p.post_id',
+    ]).FROM([
+        'Posts AS p',
+        'LexicalQuery AS lq'
+    ]).WHERE(
+        'p.search_vector @@ lq.query'
+    )
+    if semester_ids is not None:
+        SQL.AND('p.semester_id = ANY(%s::int[])', [[int(semester_id) for semester_id in semester_ids]])
+    return [tuple(row) for row in SQL.ORDER_BY([
+        'ts_rank_cd(p.search_vector, lq.query) DESC'
+    ]).LIMIT(
+        limit
+    ).execute_fetch()]
+
+
+def score_candidates(SQL: PGQ, query_embedding, keys: Sequence[Tuple[int, int]]) -> Dict[Tuple[int, int], float]:
+    """
+    Cosine similarity of each candidate post's closest sentence to the query.
+    Posts without embeddings are missing from the result.
+    """
+    if not keys:
+        return {}
+    rows = SQL.SELECT([
+        'semester_id',
+        'post_id',
+        'MAX(1 - (embedding <=> %s)) AS similarity'
+    ], [query_embedding]).FROM([
+        'Embeddings'
+    ]).WHERE(
+        '(semester_id, post_id) IN (SELECT * FROM unnest(%s::int[], %s::int[]))',
+        [[int(semester_id) for semester_id, _ in keys], [int(post_id) for _, post_id in keys]]
+    ).GROUP_BY([
+        'semester_id',
+        'post_id'
+    ]).execute_fetch()
+    return {(row[0], row[1]): float(row[2]) for row in rows}
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = RRF_K) -> List[Tuple[Hashable, float]]:
+    """
+    Merges rankings (best first) into one.
+    Returns:
+        (key, fused score) pairs, best first; ties keep the order of first appearance.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def hybrid_search(SQL: PGQ, query: str, query_embedding, limit: int, candidates: int = LEXICAL_CANDIDATES,
+                  min_lexical_hits: int = MIN_LEXICAL_HITS, min_similarity: float = MIN_SIMILARITY,
+                  semester_ids: Sequence[int] = None) -> Optional[List[Tuple[int, int, float]]]:
+    """
+    Args:
+        semester_ids: only search these semesters, every semester when None.
+    Returns:
+        Up to limit (semester_id, post_id, similarity) hits, best fused score first,
+        or None when the query has too few lexical hits for a hybrid search, before or
+        after dropping the hits below min_similarity.
+    """
+    lexical = lexical_candidates(SQL, query, candidates, semester_ids)
+    if len(lexical) < min_lexical_hits:
+        return None
+
+    similarities = score_candidates(SQL, query_embedding, lexical)
+    lexical = [key for key in lexical if similarities.get(key, -1.0) >= min_similarity]
+    if len(lexical) < min_lexical_hits:
+        # Matching words but not the meaning: the vector search may still find similar posts
+        return None
+    by_vector = sorted(lexical, key=lambda key: similarities[key], reverse=True)
+
+    fused = reciprocal_rank_fusion([lexical, by_vector])[:limit]
+    return [(semester_id, post_id, similarities[(semester_id, post_id)]) for (semester_id, post_id), _ in fused]
@@ -0,0 +1,205 @@
+import os
+import threading
+import numpy as np
+from typing import List, Tuple
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from ScrapePipeline import readDataVersion
+
+'''
+In-process copy of the Embeddings table for read-heavy Piazza search.
+
+Postgres stays the source of truth. refresh() reads nothing while the DataVersion is
+unchanged. After a bump it appends the rows with an id above the last one loaded, unless
+rows the index holds were deleted or replaced (incremental sync, re-embedding, a
+detached or attached semester), which it detects from the COUNT and SUM of the ids it
+has loaded; then the index is rebuilt from scratch and swapped in. Vectors are stored
+L2-normalised in one contiguous float32 matrix (optionally a memory-mapped file), which
+turns cosine similarity into a single matrix-vector product.
+'''
+
+EMBEDDING_DIM = 768
+LOAD_CHUNK_SIZE = 20000
+INITIAL_CAPACITY = 1024
+
+
+class LocalVectorIndex:
+    def __init__(self, dim: int = EMBEDDING_DIM, mmap_path: str = None, initial_capacity: int = INITIAL_CAPACITY):
+        self.dim = dim
+        self.mmap_path = mmap_path
+        self.size = 0
+        self.last_id = 0
+        # Sum of the Embeddings ids loaded, to notice deleted or replaced rows
+        self.id_sum = 0
+        # DataVersion of the last refresh
+        self.version = None
+        self._lock = threading.Lock()
+        self._capacity = 0
+        self.matrix = np.empty((0, dim), dtype=np.float32)
+        # (semester_id, post_id) for each row of the matrix
+        self.keys = np.empty((0, 2), dtype=np.int32)
+        self._grow(initial_capacity)
+
+    def _grow(self, min_capacity: int):
+        capacity = max(min_capacity, self._capacity * 2, INITIAL_CAPACITY)
+        if self.mmap_path is not None:
+            if isinstance(self.matrix, np.memmap):
+                self.matrix.flush()
+            with open(self.mmap_path, 'ab') as f:
+                f.truncate(capacity * self.dim * 4)
+            matrix = np.memmap(self.mmap_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        else:
+            matrix = np.empty((capacity, self.dim), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+        keys = np.empty((capacity, 2), dtype=np.int32)
+        keys[:self.size] = self.keys[:self.size]
+        # Searches already running keep their reference to the old arrays
+        self.matrix, self.keys, self._capacity = matrix, keys, capacity
+
+    def add(self, vectors: np.ndarray, semester_ids, post_ids, ids=None):
+        """
+        Appends rows to the index. vectors is an (n, dim) array, normalised here;
+        ids are their Embeddings ids, when they come from the table.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        with self._lock:
+            end = self.size + len(vectors)
+            if end > self._capacity:
+                self._grow(end)
+            self.matrix[self.size:end] = vectors
+            self.keys[self.size:end, 0] = semester_ids
+            self.keys[self.size:end, 1] = post_ids
+            self.size = end
+            if ids is not None and len(ids):
+                self.last_id = max(self.last_id, int(max(ids)))
+                self.id_sum += int(sum(ids))
+
+    def refresh(self, SQL: PGQ, chunk_size: int = LOAD_CHUNK_SIZE) -> int:
+        """
+        Brings the index up to date with the Embeddings table.
+        Returns:
+            The number of rows loaded: the new rows, or every row after a rebuild.
+        """
+        try:
+            version = readDataVersion(SQL)
+            if version is not None and version == self.version:
+                return 0
+            if self.size and not self._holds_current_rows(SQL):
+                loaded = self._rebuild(SQL, chunk_size)
+            else:
+                loaded = self._load_after(SQL, self.last_id, chunk_size)
+            # Read before the rows: a bump during the load is seen by the next refresh
+            self.version = version
+            return loaded
+        finally:
+            SQL.rollback()
+
+    def _holds_current_rows(self, SQL: PGQ) -> bool:
+        """
+        Whether the rows up to last_id are still exactly the ones loaded.
+        """
+        count, id_sum = SQL.SELECT(
+            ['COUNT(*)', 'COALESCE(SUM(id), 0)']
+        ).FROM(
+            ['Embeddings']
+        ).WHERE(
+            'id <= %s', [int(self.last_id)]
+        ).execute_fetch(raise_errors=True)[0]
+        return count == self.size and int(id_sum) == self.id_sum
+
+    def _rebuild(self, SQL: PGQ, chunk_size: int) -> int:
+        # Searches keep using the current rows until the new ones are swapped in,
+        # so both copies are held for the length of the load
+        mmap_path = self.mmap_path + '.rebuild' if self.mmap_path is not None else None
+        fresh = LocalVectorIndex(self.dim, mmap_path=mmap_path, initial_capacity=max(self.size, INITIAL_CAPACITY))
+        loaded = fresh._load_after(SQL, 0, chunk_size)
+        if mmap_path is not None:
+            fresh.close()
+            # Searches still reading the old file keep it mapped until they finish
+            os.replace(mmap_path, self.mmap_path)
+        with self._lock:
+            self.matrix, self.keys, self.size, self._capacity = fresh.matrix, fresh.keys, fresh.size, fresh._capacity
+            self.last_id, self.id_sum = fresh.last_id, fresh.id_sum
+        return loaded
+
+    def _load_after(self, SQL: PGQ, after_id: int, chunk_size: int) -> int:
+        """
+        Appends every Embeddings row with an id above after_id.
+        """
+        added = 0
+        # One streamed query instead of LIMIT pages: memory stays at chunk_size rows
+        # and the vectors arrive already parsed into NumPy arrays
+        stream = SQL.SELECT(
+            ['id', 'semester_id', 'post_id', 'embedding']
+        ).FROM(
+            ['Embeddings']
+        ).WHERE(
+            'id > %s', [int(after_id)]
+        ).ORDER_BY(
+            ['id']
+        ).execute_stream(itersize=chunk_size, decode_vectors=True, batches=True)
+        try:
+            for rows in stream:
+                vectors = np.stack([row[3] for row in rows])
+                self.add(vectors, [row[1] for row in rows], [row[2] for row in rows], ids=[row[0] for row in rows])
+                added += len(rows)
+        finally:
+            stream.close()
+        return added
+
+    def search(self, query: np.ndarray, k: int = 10, threshold: float = None,
+               candidates: int = 100, semester_ids=None) -> List[Tuple[int, int, float]]:
+        """
+        Returns up to k (semester_id, post_id, similarity) tuples, one per post,
+        best first. The top `candidates` sentences are considered so that several
+        sentences of the same post do not crowd out other posts.
+        With semester_ids the rows of other semesters score -inf and are never returned.
+        """
+        with self._lock:
+            matrix, keys, size = self.matrix, self.keys, self.size
+        if size == 0:
+            return []
+
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        # Scoring every row beats gathering the semester's rows: matrix[rows] would copy them per request
+        scores = matrix[:size] @ query
+        matching = size
+        if semester_ids is not None:
+            in_semesters = np.isin(keys[:size, 0], np.asarray(semester_ids, dtype=np.int32))
+            matching = int(np.count_nonzero(in_semesters))
+            if matching == 0:
+                return []
+            scores[~in_semesters] = -np.inf
+
+        # Capped at the matching rows, so no -inf score is ever among the candidates
+        candidates = min(matching, max(k, candidates))
+        if candidates < size:
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+        else:
+            top = np.arange(size)
+        top = top[np.argsort(-scores[top])]
+
+        results, seen = [], set()
+        for row in top:
+            similarity = float(scores[row])
+            if threshold is not None and similarity <= threshold:
+                break
+            key = (int(keys[row, 0]), int(keys[row, 1]))
+            if key in seen:
+                continue
+            seen.add(key)
+            results.append((key[0], key[1], similarity))
+            if len(results) == k:
+                break
+        return results
+
+    def memory_bytes(self) -> int:
+        return self.matrix.nbytes + self.keys.nbytes
+
+    def close(self):
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
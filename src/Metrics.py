@@ -0,0 +1,238 @@
+import time
+import bisect
+import threading
+from typing import Dict, Tuple
+
+'''
+Small in-process metrics registry.
+
+Counters and histograms are cheap enough to update on every request:
+a lock, a bisect over the bucket bounds and two additions.
+Metrics are identified by name plus an optional set of labels.
+The registry renders as JSON (snapshot) or in the Prometheus text format (prometheus_text).
+'''
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Request stages such as JSON parsing take well under a millisecond
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005) + DEFAULT_BUCKETS
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+STAGE_SECONDS = 'request_stage_seconds'
+
+
+class Counter:
+    def __init__(self, name: str, help: str = '', labels: Dict[str, str] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus_lines(self):
+        return [f'{self.name}{format_labels(self.labels)} {format_value(self.value)}']
+
+
+class Gauge:
+    def __init__(self, name: str, help: str = '', labels: Dict[str, str] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus_lines(self):
+        return [f'{self.name}{format_labels(self.labels)} {format_value(self.value)}']
+
+
+class Histogram:
+    def __init__(self, name: str, help: str = '', buckets: Tuple[float, ...] = DEFAULT_BUCKETS, labels: Dict[str, str] = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        # One extra slot for observations above the largest bound (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, value_sum = self.count, self.sum
+        cumulative, running = {}, 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative['+Inf' if bound == float('inf') else str(bound)] = running
+        return {'buckets': cumulative, 'count': total, 'sum': value_sum}
+
+    def prometheus_lines(self):
+        snapshot = self.snapshot()
+        lines = [
+            f'{self.name}_bucket{format_labels(dict(self.labels, le=bound))} {count}'
+            for bound, count in snapshot['buckets'].items()
+        ]
+        lines.append(f'{self.name}_sum{format_labels(self.labels)} {format_value(snapshot["sum"])}')
+        lines.append(f'{self.name}_count{format_labels(self.labels)} {snapshot["count"]}')
+        return lines
+
+
+PROMETHEUS_TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Holds every metric by (name, labels) so modules can look up the same metric
+    without passing objects around.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, labels=labels, **kwargs)
+                self._metrics[key] = metric
+            return metric
+
+    def counter(self, name: str, help: str = '', labels: Dict[str, str] = None) -> Counter:
+        return self._get_or_create(Counter, name, labels, help=help)
+
+    def gauge(self, name: str, help: str = '', labels: Dict[str, str] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, labels, help=help)
+
+    def histogram(self, name: str, help: str = '', buckets: Tuple[float, ...] = DEFAULT_BUCKETS, labels: Dict[str, str] = None) -> Histogram:
+        return self._get_or_create(Histogram, name, labels, help=help, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self) -> dict:
+        """
+        Returns every metric as JSON-serialisable data, keyed by name then by label string.
+        """
+        output = {}
+        for metric in self.metrics():
+            label_key = ','.join(f'{k}={v}' for k, v in sorted(metric.labels.items()))
+            output.setdefault(metric.name, {})[label_key] = metric.snapshot()
+        return output
+
+    def prometheus_text(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        by_name = {}
+        for metric in self.metrics():
+            by_name.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name in sorted(by_name):
+            metrics = by_name[name]
+            help = next((metric.help for metric in metrics if metric.help), name)
+            help = help.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {PROMETHEUS_TYPES[type(metrics[0])]}")
+            for metric in metrics:
+                lines.extend(metric.prometheus_lines())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class StageTimer:
+    """
+    Latency of the stages of one endpoint's requests, as request_stage_seconds{endpoint, stage}.
+    The histograms are looked up once per stage, not once per request.
+
+        stages = stage_timer('360PiazzaDatabase')
+        with stages.stage('sql_execution'):
+            ...
+        stages.observe('json_parse', seconds)
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._histograms = {}
+
+    def histogram(self, stage: str) -> Histogram:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = REGISTRY.histogram(
+                STAGE_SECONDS, 'Time spent in each stage of a request', LATENCY_BUCKETS,
+                {'endpoint': self.endpoint, 'stage': stage},
+            )
+        return histogram
+
+    def observe(self, stage: str, seconds: float):
+        self.histogram(stage).observe(seconds)
+
+    def stage(self, stage: str) -> 'StageClock':
+        return StageClock(self.histogram(stage))
+
+
+class StageClock:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+_stage_timers = {}
+
+
+def stage_timer(endpoint: str) -> StageTimer:
+    timer = _stage_timers.get(endpoint)
+    if timer is None:
+        timer = _stage_timers.setdefault(endpoint, StageTimer(endpoint))
+    return timer
@@ -0,0 +1,114 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Any
+
+from ConcurrentServing import QueueFullError
+from Metrics import REGISTRY, SIZE_BUCKETS
+
+_STOP = object()
+
+
+class InferenceBatcher:
+    """
+    Gathers concurrent inference requests into batches for a single forward pass.
+
+    The worker thread waits for the first item, then keeps collecting until either
+    max_batch_size items are queued or max_wait_ms has passed since the first one.
+    batch_fn receives the list of items and must return one result per item, in order.
+    When a batch fails, its items are retried one at a time, so an item that breaks
+    batch_fn fails its own future only.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 16,
+                 max_wait_ms: float = 10, max_queue: int = 256, name: str = 'batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_queue)
+
+        self.batch_size_histogram = REGISTRY.histogram(
+            'inference_batch_size', 'Items per forward pass', buckets=SIZE_BUCKETS, labels={'batcher': name})
+        self.queue_time_histogram = REGISTRY.histogram(
+            'inference_queue_seconds', 'Time from submit to start of forward pass', labels={'batcher': name})
+        self.batch_time_histogram = REGISTRY.histogram(
+            'inference_batch_seconds', 'Duration of one batched forward pass', labels={'batcher': name})
+        self.batch_retries = REGISTRY.counter(
+            'inference_batch_retries_total', 'Failed batches retried one item at a time', labels={'batcher': name})
+
+        self._thread = threading.Thread(target=self._loop, name=f'{name}-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        """
+        Queues one item for the next batch.
+        Raises:
+            QueueFullError: max_queue items are already waiting.
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            raise QueueFullError(f"{self.name} batch queue is full")
+        return future
+
+    def run(self, item, timeout: float = None):
+        """
+        Queues one item and blocks until its result is ready.
+        """
+        return self.submit(item).result(timeout)
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                # Put the sentinel back so the loop exits after this batch
+                self._queue.put(_STOP)
+                break
+            batch.append(entry)
+        return batch
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+
+            batch = self._collect(first)
+            start = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.queue_time_histogram.observe(start - enqueued)
+            self.batch_size_histogram.observe(len(batch))
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    self.batch_retries.inc()
+                    for entry in batch:
+                        try:
+                            self._run_batch([entry])
+                        except Exception as e:
+                            entry[1].set_exception(e)
+            self.batch_time_histogram.observe(time.perf_counter() - start)
+
+    def _run_batch(self, batch):
+        results = self.batch_fn([item for item, _, _ in batch])
+        if len(results) != len(batch):
+            raise RuntimeError(f"{self.name} returned {len(results)} results for {len(batch)} items")
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
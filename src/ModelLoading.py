@@ -0,0 +1,137 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from Metrics import REGISTRY
+
+'''
+Background model loading for a fast cold start.
+
+The server binds its socket first and answers pings while the models load on their
+own threads. A request that needs a model that is not ready yet gets
+ModelNotReadyError, which the server turns into a 503 readiness response.
+Every loading phase is timed and exported as a startup_phase_seconds gauge.
+'''
+
+# Taken when this module is first imported, i.e. early in the server's start
+PROCESS_START = time.perf_counter()
+
+
+class ModelNotReadyError(Exception):
+    """
+    Raised for a request whose model is still loading (or failed to load).
+    """
+    def __init__(self, name: str, status: Dict[str, str]):
+        super().__init__(f"Model {name} is not ready: {status.get(name, 'unknown')}")
+        self.name = name
+        self.status = status
+
+
+class StartupPhases:
+    def __init__(self):
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = seconds
+        REGISTRY.gauge('startup_phase_seconds', 'Duration of each start-up phase', {'phase': name}).set(seconds)
+
+    def mark(self, name: str):
+        """
+        Records the time from process start until now, e.g. 'bound' or 'ready'.
+        """
+        self.record(name, time.perf_counter() - PROCESS_START)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.phases)
+
+
+class ModelLoader:
+    """
+    Runs named load functions, each on its own thread, and tracks their state.
+
+        loader.register('arxiv', load_arxiv_model)
+        loader.start()                  # returns at once
+        loader.require('arxiv')         # raises ModelNotReadyError until loaded
+    """
+
+    LOADING = 'loading'
+    READY = 'ready'
+
+    def __init__(self, phases: StartupPhases = None):
+        self.phases = phases or StartupPhases()
+        self._loaders = {}
+        self._status = {}
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, load: Callable[[], None]):
+        with self._lock:
+            self._loaders[name] = load
+            self._status[name] = 'pending'
+            self._events[name] = threading.Event()
+
+    def _run(self, name: str, load: Callable[[], None]):
+        try:
+            with self.phases.phase(name):
+                load()
+            status = self.READY
+        except Exception as e:
+            print(f"Loading {name} failed: {e}")
+            status = f'failed: {e}'
+        with self._lock:
+            self._status[name] = status
+            # Whoever finishes last sees every status settled
+            all_ready = all(other == self.READY for other in self._status.values())
+        self._events[name].set()
+        if all_ready:
+            self.phases.mark('ready')
+
+    def start(self, background: bool = True):
+        """
+        Starts every registered loader in parallel. With background=False
+        it also waits for all of them.
+        """
+        threads = []
+        with self._lock:
+            loaders = [(name, load) for name, load in self._loaders.items() if self._status[name] == 'pending']
+            for name, _ in loaders:
+                self._status[name] = self.LOADING
+        for name, load in loaders:
+            thread = threading.Thread(target=self._run, args=(name, load), name=f'load-{name}', daemon=True)
+            thread.start()
+            threads.append(thread)
+        if not background:
+            for thread in threads:
+                thread.join()
+
+    def wait(self, name: str, timeout: float = None) -> bool:
+        return self._events[name].wait(timeout) and self.is_ready(name)
+
+    def is_ready(self, name: str) -> bool:
+        with self._lock:
+            return self._status.get(name) == self.READY
+
+    def all_ready(self) -> bool:
+        with self._lock:
+            return all(status == self.READY for status in self._status.values())
+
+    def require(self, *names: str):
+        for name in names:
+            if not self.is_ready(name):
+                raise ModelNotReadyError(name, self.status())
+
+    def status(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._status)
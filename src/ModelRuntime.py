@@ -0,0 +1,223 @@
+import os
+import time
+import numpy as np
+import torch
+from typing import Dict, List
+from transformers import AutoConfig, AutoModelForSequenceClassification
+
+'''
+Runtime backends for the ArXiv sequence classifier on CPU.
+
+    eager        fp32 model run under torch.inference_mode()
+    int8         dynamic int8 quantization of the Linear layers (weights int8, activations quantized on the fly)
+    torchscript  traced and frozen TorchScript graph
+    onnx         ONNX export run by onnxruntime (optional dependency)
+
+Every backend takes the tokenizer's output (PyTorch tensors) and returns logits as a
+NumPy array, so callers do not change with the backend. check_accuracy() compares a
+backend against the fp32 eager outputs before it is trusted.
+'''
+
+RUNTIME_BACKENDS = ('eager', 'int8', 'torchscript', 'onnx')
+
+# A backend is accepted when it predicts the same label as fp32 on nearly every sample
+# and its logits stay close
+MIN_ARGMAX_AGREEMENT = 0.99
+MAX_ABS_LOGIT_DIFF = 0.5
+
+# Inputs the exported graphs take, in the order of BertForSequenceClassification.forward
+GRAPH_INPUTS = ('input_ids', 'attention_mask', 'token_type_ids')
+
+# Texts for tracing and for the start-up accuracy check when no others are given
+SAMPLE_TEXTS = [
+    "We prove that every finitely generated module over a Noetherian ring has a finite free resolution.",
+    "A convolutional network for semantic segmentation of street scenes trained end to end.",
+    "We study the sample complexity of reinforcement learning agents in partially observable environments.",
+    "A distributed control law stabilizes the network of coupled oscillators under communication delays.",
+    "We classify the finite simple groups whose Sylow 2-subgroups are abelian.",
+    "An amortized analysis of a self-adjusting binary search tree with logarithmic access time.",
+    "A finite element solver for incompressible flow on adaptive meshes is presented.",
+    "We give a type system for a functional language with effect handlers and prove it sound.",
+    "Capacity bounds for the Gaussian broadcast channel with feedback are derived.",
+    "Spiking neural networks are trained with surrogate gradients on neuromorphic hardware.",
+    "We derive minimax rates for nonparametric regression under heavy-tailed noise.",
+]
+
+
+class EagerRuntime:
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def predict_logits(self, inputs: Dict[str, torch.Tensor]) -> np.ndarray:
+        # inference_mode skips autograd bookkeeping entirely, no .detach() needed afterwards
+        with torch.inference_mode():
+            return self.model(**inputs).logits.numpy()
+
+
+class TorchScriptRuntime:
+    def __init__(self, graph, input_names: List[str]):
+        self.graph = graph
+        self.input_names = input_names
+
+    def predict_logits(self, inputs: Dict[str, torch.Tensor]) -> np.ndarray:
+        with torch.inference_mode():
+            return self.graph(*[inputs[name] for name in self.input_names])[0].numpy()
+
+
+class OnnxRuntime:
+    def __init__(self, session):
+        self.session = session
+        self.input_names = [graph_input.name for graph_input in session.get_inputs()]
+
+    def predict_logits(self, inputs: Dict[str, torch.Tensor]) -> np.ndarray:
+        feed = {name: inputs[name].numpy() for name in self.input_names}
+        return self.session.run(None, feed)[0]
+
+
+def _example_inputs(tokenizer, texts: List[str] = None) -> Dict[str, torch.Tensor]:
+    return dict(tokenizer(texts or SAMPLE_TEXTS[:2], max_length=512, truncation=True, padding=True, return_tensors="pt"))
+
+
+def _graph_input_names(example: Dict[str, torch.Tensor]) -> List[str]:
+    return [name for name in GRAPH_INPUTS if name in example]
+
+
+def save_state_dict(model_dir: str, num_labels: int, path: str):
+    """
+    Writes the classifier's weights and buffers to one file that load_model() can mmap.
+    """
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir, num_labels=num_labels)
+    torch.save({'state': model.state_dict(), 'buffers': dict(model.named_buffers())}, path)
+
+
+def load_model(model_dir: str, num_labels: int, state_dict_path: str = None, **config_kwargs):
+    """
+    Loads the classifier from model_dir, or, when state_dict_path exists, builds it on the
+    meta device and assigns tensors memory-mapped from that file: no random initialisation,
+    no copy of the weights, pages are read in as they are first touched.
+    """
+    if not state_dict_path or not os.path.exists(state_dict_path):
+        return AutoModelForSequenceClassification.from_pretrained(model_dir, num_labels=num_labels, force_download=False, **config_kwargs)
+
+    config = AutoConfig.from_pretrained(model_dir, num_labels=num_labels, **config_kwargs)
+    with torch.device('meta'):
+        model = AutoModelForSequenceClassification.from_config(config)
+    saved = torch.load(state_dict_path, mmap=True, weights_only=True)
+    model.load_state_dict(saved['state'], assign=True)
+    # Non-persistent buffers (e.g. position_ids) are not part of a state dict
+    for name, buffer in saved['buffers'].items():
+        module_name, _, buffer_name = name.rpartition('.')
+        model.get_submodule(module_name)._buffers[buffer_name] = buffer
+    return model
+
+
+def load_runtime(backend: str, model_dir: str, num_labels: int, tokenizer, onnx_path: str = None, threads: int = None,
+                 state_dict_path: str = None):
+    """
+    Loads the classifier in model_dir for the given backend.
+    Args:
+        tokenizer: used to build example inputs for tracing and export.
+        onnx_path: where the ONNX export is cached, defaults to model_dir/model.onnx.
+        threads: intra-op threads for torch / onnxruntime, None keeps the library default.
+        state_dict_path: optional file from save_state_dict(), memory-mapped instead of loading model_dir.
+    """
+    if backend not in RUNTIME_BACKENDS:
+        raise ValueError(f"Unknown model runtime: {backend}")
+    if threads:
+        torch.set_num_threads(threads)
+
+    if backend == 'eager':
+        return EagerRuntime(load_model(model_dir, num_labels, state_dict_path))
+
+    if backend == 'int8':
+        model = load_model(model_dir, num_labels, state_dict_path)
+        quantized = torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+        return EagerRuntime(quantized)
+
+    # torchscript=True makes the model return plain tuples, which tracing and export need
+    model = load_model(model_dir, num_labels, state_dict_path, torchscript=True).eval()
+    example = _example_inputs(tokenizer)
+    input_names = _graph_input_names(example)
+    example_args = tuple(example[name] for name in input_names)
+
+    if backend == 'torchscript':
+        with torch.inference_mode():
+            graph = torch.jit.trace(model, example_args, strict=False)
+        graph = torch.jit.optimize_for_inference(torch.jit.freeze(graph))
+        return TorchScriptRuntime(graph, input_names)
+
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnx backend needs the onnxruntime package")
+
+    onnx_path = onnx_path or os.path.join(model_dir, 'model.onnx')
+    if not os.path.exists(onnx_path):
+        torch.onnx.export(
+            model,
+            example_args,
+            onnx_path,
+            input_names=input_names,
+            output_names=['logits'],
+            dynamic_axes=dict({name: {0: 'batch', 1: 'sequence'} for name in input_names}, logits={0: 'batch'}),
+            opset_version=14,
+        )
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+    return OnnxRuntime(session)
+
+
+def check_accuracy(reference, candidate, tokenizer, texts: List[str] = None, batch_size: int = 8,
+                   min_agreement: float = MIN_ARGMAX_AGREEMENT, max_abs_diff: float = MAX_ABS_LOGIT_DIFF) -> dict:
+    """
+    Runs both runtimes on the same texts and compares their logits.
+    Returns:
+        Dictionary with argmax agreement, largest absolute logit difference and 'ok'.
+    """
+    texts = texts or SAMPLE_TEXTS
+    expected, actual = [], []
+    for start in range(0, len(texts), batch_size):
+        inputs = _example_inputs(tokenizer, texts[start:start + batch_size])
+        expected.append(reference.predict_logits(inputs))
+        actual.append(candidate.predict_logits(inputs))
+    expected, actual = np.concatenate(expected), np.concatenate(actual)
+
+    agreement = float(np.mean(np.argmax(expected, axis=1) == np.argmax(actual, axis=1)))
+    abs_diff = float(np.max(np.abs(expected - actual)))
+    return {
+        'samples'           : len(texts),
+        'argmax_agreement'  : agreement,
+        'max_abs_diff'      : abs_diff,
+        'ok'                : agreement >= min_agreement and abs_diff <= max_abs_diff,
+    }
+
+
+def benchmark_runtime(runtime, tokenizer, texts: List[str], batch_size: int = 1, repeats: int = 20) -> dict:
+    """
+    Latency percentiles and throughput of runtime.predict_logits on batches of texts.
+    Tokenization is done up front and not timed.
+    """
+    batches = [_example_inputs(tokenizer, texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+    runtime.predict_logits(batches[0])  # warm-up, first calls allocate and pick kernels
+
+    latencies = []
+    items = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for inputs in batches:
+            batch_start = time.perf_counter()
+            runtime.predict_logits(inputs)
+            latencies.append(time.perf_counter() - batch_start)
+            items += inputs['input_ids'].shape[0]
+    seconds = time.perf_counter() - start
+
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'batch_size'        : batch_size,
+        'p50_ms'            : float(np.percentile(latencies, 50)),
+        'p99_ms'            : float(np.percentile(latencies, 99)),
+        'texts_per_second'  : items / seconds,
+    }
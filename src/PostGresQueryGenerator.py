@@ -1,10 +1,51 @@
+import io
+import re
+import itertools
+import time
+import struct
+import hashlib
+import weakref
+import threading
 import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+import numpy as np
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from typing import List, Dict
+from Metrics import REGISTRY
 __package__ = 'PostGresQueryGenerator'
 
+# Binary COPY framing, see "Binary Format" in the PostgreSQL COPY documentation
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PGCOPY_NULL = struct.pack('!i', -1)
+
+# Queries built with bind parameters run as server-side prepared statements,
+# PREPAREd once per connection and EXECUTEd after that
+USE_PREPARED_STATEMENTS = True
+# Prepared statements kept per connection, least recently used ones are DEALLOCATEd
+PREPARED_STATEMENTS_PER_CONNECTION = 256
+
+# Rows fetched per round trip by execute_stream's server-side cursors
+STREAM_ITERSIZE = 2000
+STREAM_IDS = itertools.count()
+
+# %s is a placeholder, %% a literal %
+PLACEHOLDER = re.compile(r'%[s%]')
+
+# Query shapes: literals replaced so that queries differing only in values share a histogram
+SHAPE_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+SHAPE_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+EXECUTION_TIME = re.compile(r'Execution Time: ([\d.]+) ms')
+
 class PGQuery:
-    def __init__(self):
+    def __init__(self, connection=None):
         self.query = []
+        self.params = []
+        # A connection can be handed in directly, e.g. one borrowed from PGConnectionPool
+        if connection is not None:
+            self.connection = connection
 
     def __str__(self):
         return self.query_string()
@@ -12,6 +53,34 @@ class PGQuery:
     def query_string(self):
         return ' '.join(self.query) + ';'
 
+    def _append(self, fragment: str, params: list = None):
+        '''
+        Adds a fragment whose %s placeholders are bound to params, in order.
+        A query with params must write a literal % as %%.
+        '''
+        self.query.append(fragment)
+        if params:
+            self.params.extend(params)
+        return self
+
+    def _execute(self, cursor):
+        '''
+        Sends the built query: literal SQL when there are no params, otherwise a prepared
+        statement (or client-side binding with USE_PREPARED_STATEMENTS off).
+        '''
+        sql = ' '.join(self.query)
+        params, self.params = self.params, []
+        start = time.perf_counter()
+        if not params:
+            cursor.execute(sql + ';')
+        elif USE_PREPARED_STATEMENTS:
+            PREPARED_STATEMENTS.execute(self.connection, cursor, sql, params)
+        else:
+            cursor.execute(sql + ';', [PGQuery.toParam(param) for param in params])
+
+        if QUERY_INSTRUMENTATION is not None:
+            QUERY_INSTRUMENTATION.record(self.connection, sql, cursor.query, time.perf_counter() - start)
+
     def login(self, login: Dict[str, str]):
         if login is None:
             return False
@@ -19,30 +88,186 @@ class PGQuery:
         self.connection = psycopg2.connect(**login)
         return True
 
-    def execute_nofetch(self):
+    def execute_nofetch(self, raise_errors: bool = False):
         try:
             cursor = self.connection.cursor()
-            cursor.execute(' '.join(self.query) + ';')
+            self._execute(cursor)
             cursor.close()
         except Exception as e:
             print(e)
             self.connection.rollback()
+            if raise_errors:
+                self.query = []
+                raise
         
         self.query = []
 
-    def execute_fetch(self):
+    def execute_fetch(self, raise_errors: bool = False):
+        # None when the query fails and raise_errors is off
+        data = None
         try:
             cursor = self.connection.cursor()
-            cursor.execute(' '.join(self.query) + ';')
+            self._execute(cursor)
             data = cursor.fetchall()
             cursor.close()
         except Exception as e:
             print(e)
             self.connection.rollback()
+            if raise_errors:
+                self.query = []
+                raise
         
         self.query = []
         return data
 
+    def numbered(self):
+        """
+        The built query with $1..$n placeholders and its values in order, for a driver
+        that binds natively (asyncpg) instead of running it here. Clears the builder.
+        """
+        sql = ' '.join(self.query)
+        statement, values = number_placeholders(sql, self.params)
+        self.query, self.params = [], []
+        return statement, values
+
+    def execute_stream(self, itersize: int = STREAM_ITERSIZE, decode_vectors: bool = False, batches: bool = False):
+        """
+        Runs the built query through a named server-side cursor and yields its rows
+        (or lists of up to itersize rows with batches=True), pulling itersize rows per
+        round trip so memory stays flat however large the result is.
+
+        decode_vectors=True turns pgvector columns into float32 NumPy arrays while the rows
+        are read. On an autocommit connection the cursor is declared WITH HOLD; otherwise it
+        lives in the current transaction, which the caller ends as usual.
+        """
+        sql = ' '.join(self.query)
+        params = [PGQuery.toParam(param) for param in self.params]
+        self.query, self.params = [], []
+
+        cursor = None
+        try:
+            vector_type = PGQuery._vector_type(self.connection) if decode_vectors else None
+            withhold = self.connection.autocommit
+            cursor = self.connection.cursor(name=f'pgq_stream_{next(STREAM_IDS)}', withhold=withhold)
+            cursor.itersize = itersize
+            if vector_type is not None:
+                psycopg2.extensions.register_type(vector_type, cursor)
+            # DECLARE only takes a plain query, so parameters are bound client-side here
+            cursor.execute(sql, params or None)
+
+            if batches:
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield rows
+            else:
+                yield from cursor
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+            raise
+        finally:
+            if cursor is not None and not cursor.closed:
+                cursor.close()
+
+    def _vector_type(connection):
+        '''
+        psycopg2 type caster that parses pgvector text into NumPy arrays, or None if the
+        extension is not installed.
+        '''
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regtype('vector')::oid;")
+        oid = cursor.fetchone()[0]
+        cursor.close()
+        if oid is None:
+            return None
+        return psycopg2.extensions.new_type(
+            (oid,), 'VECTOR', lambda value, cursor: None if value is None else PGQuery.fromVector(value)
+        )
+
+    def copy_rows(self, table_name: str, columns: List[str], rows, binary: bool = True) -> dict:
+        """
+        Loads rows with a single COPY ... FROM STDIN in the current transaction (no commit).
+
+        NumPy arrays are sent as pgvector values, ints as INT, floats as DOUBLE PRECISION,
+        everything else as text. Binary COPY sends 768-d vectors as 3 KB of float32
+        instead of ~9 KB of text and skips float formatting and parsing.
+        Returns:
+            Dictionary with rows, bytes sent and seconds taken.
+        """
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        row_count = 0
+        if binary:
+            buffer.write(PGCOPY_HEADER)
+            field_count = struct.pack('!h', len(columns))
+            for row in rows:
+                buffer.write(field_count)
+                for value in row:
+                    buffer.write(PGQuery.toCopyBinary(value))
+                row_count += 1
+            buffer.write(PGCOPY_TRAILER)
+        else:
+            for row in rows:
+                buffer.write(('\t'.join(PGQuery.toCopyText(value) for value in row) + '\n').encode('utf-8'))
+                row_count += 1
+
+        sent = buffer.tell()
+        buffer.seek(0)
+        statement = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN{' WITH (FORMAT binary)' if binary else ''}"
+        try:
+            cursor = self.connection.cursor()
+            cursor.copy_expert(statement, buffer)
+            cursor.close()
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+            raise
+
+        return PGQuery._bulk_stats(table_name, 'copy_binary' if binary else 'copy_text', row_count, sent, start)
+
+    def insert_rows(self, table_name: str, columns: List[str], rows, page_size: int = 1000, on_conflict: str = None) -> dict:
+        """
+        Inserts rows with multi-row INSERT ... VALUES statements of page_size rows each,
+        values bound through psycopg2 instead of pasted into the SQL. No commit.
+        on_conflict is appended as is, e.g. 'ON CONFLICT (id) DO UPDATE SET ...'.
+        Returns:
+            Dictionary with rows, bytes sent and seconds taken.
+        """
+        start = time.perf_counter()
+        rows = [[PGQuery.toVectorText(v) if isinstance(v, np.ndarray) else v for v in row] for row in rows]
+        sent = 0
+        try:
+            cursor = self.connection.cursor()
+            for page_start in range(0, len(rows), page_size):
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s{' ' + on_conflict if on_conflict else ''}",
+                    rows[page_start:page_start + page_size],
+                    page_size=page_size,
+                )
+                sent += len(cursor.query)
+            cursor.close()
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+            raise
+
+        return PGQuery._bulk_stats(table_name, 'execute_values', len(rows), sent, start)
+
+    def _bulk_stats(table_name: str, method: str, row_count: int, sent: int, start: float) -> dict:
+        seconds = time.perf_counter() - start
+        labels = {'table': table_name.lower(), 'method': method}
+        REGISTRY.counter('pg_bulk_rows_total', 'Rows written by bulk loads', labels).inc(row_count)
+        REGISTRY.counter('pg_bulk_bytes_total', 'Bytes sent by bulk loads', labels).inc(sent)
+        return {
+            'rows'              : row_count,
+            'bytes'             : sent,
+            'seconds'           : seconds,
+            'rows_per_second'   : row_count / seconds if seconds > 0 else float('inf'),
+        }
+
     def commit(self):
         self.connection.commit()
         return self
@@ -56,11 +281,11 @@ class PGQuery:
 
     def clear(self):
         self.query = []
+        self.params = []
         return self
 
-    def SELECT(self, columns: List[str]):
-        self.query.append(f"SELECT {', '.join(columns)}")
-        return self
+    def SELECT(self, columns: List[str], params: list = None):
+        return self._append(f"SELECT {', '.join(columns)}", params)
     
     def WITH(self, table):
         self.query.append(f"WITH {table}")
@@ -78,13 +303,11 @@ class PGQuery:
         self.query.append(f"FULL OUTER JOIN {table_name}")
         return self
 
-    def HAVING(self, condition: str):
-        self.query.append(f"HAVING {condition}")
-        return self
+    def HAVING(self, condition: str, params: list = None):
+        return self._append(f"HAVING {condition}", params)
 
-    def ON(self, condition: str):
-        self.query.append(f"ON {condition}")
-        return self
+    def ON(self, condition: str, params: list = None):
+        return self._append(f"ON {condition}", params)
 
     def NOT(self):
         self.query.append("NOT")
@@ -98,30 +321,44 @@ class PGQuery:
         self.query.append(f"FROM {', '.join(table_names)}")
         return self
 
-    def WHERE(self, condition: str):
-        self.query.append(f"WHERE {condition}")
-        return self
+    def WHERE(self, condition: str, params: list = None):
+        return self._append(f"WHERE {condition}", params)
 
-    def AND(self, condition: str):
-        self.query.append(f"AND {condition}")
-        return self
+    def AND(self, condition: str, params: list = None):
+        return self._append(f"AND {condition}", params)
     
-    def OR(self, condition: str):
-        self.query.append(f"OR {condition}")
-        return self
+    def OR(self, condition: str, params: list = None):
+        return self._append(f"OR {condition}", params)
     
     def INSERT_INTO(self, table_name: str, columns: List[str]):
         self.query.append(f"INSERT INTO {table_name} ({', '.join(columns)})")
         return self
 
-    def VALUES(self, values: List[List[str]]):
+    def VALUES(self, values: List[List[str]], params: list = None):
         values = [f"({', '.join(value)})" for value in values]
-        self.query.append(f"VALUES {', '.join(values)}")
-        return self
+        return self._append(f"VALUES {', '.join(values)}", params)
     
-    def ORDER_BY(self, columns: List[str]):
-        self.query.append(f"ORDER BY {', '.join(columns)}")
+    def UPDATE(self, table_name: str):
+        self.query.append(f"UPDATE {table_name}")
+        return self
+
+    def SET(self, assignments: List[str], params: list = None):
+        return self._append(f"SET {', '.join(assignments)}", params)
+
+    def ON_CONFLICT(self, columns: List[str], action: str = 'DO NOTHING'):
+        self.query.append(f"ON CONFLICT ({', '.join(columns)}) {action}")
+        return self
+
+    def RETURNING(self, columns: List[str]):
+        self.query.append(f"RETURNING {', '.join(columns)}")
+        return self
+
+    def DELETE_FROM(self, table_name: str):
+        self.query.append(f"DELETE FROM {table_name}")
         return self
+
+    def ORDER_BY(self, columns: List[str], params: list = None):
+        return self._append(f"ORDER BY {', '.join(columns)}", params)
     
     def GROUP_BY(self, columns: List[str]):
         self.query.append(f"GROUP BY {', '.join(columns)}")
@@ -131,8 +368,38 @@ class PGQuery:
         self.query.append(f"LIMIT {limit}")
         return self
 
-    def CREATE_TABLE(self, table_name: str, columns: List[str]):
-        self.query.append(f"CREATE TABLE {table_name} ({', '.join(columns)})")
+    def CREATE_TABLE(self, table_name: str, columns: List[str], if_not_exists: bool = False):
+        if_not_exists = ' IF NOT EXISTS' if if_not_exists else ''
+        self.query.append(f"CREATE TABLE{if_not_exists} {table_name} ({', '.join(columns)})")
+        return self
+
+    def ALTER_TABLE(self, table_name: str):
+        self.query.append(f"ALTER TABLE {table_name}")
+        return self
+
+    def ADD_COLUMN(self, column: str, if_not_exists: bool = False):
+        self.query.append(f"ADD COLUMN{' IF NOT EXISTS' if if_not_exists else ''} {column}")
+        return self
+
+    def RENAME_TO(self, new_name: str):
+        self.query.append(f"RENAME TO {new_name}")
+        return self
+
+    def PARTITION_BY(self, method: str, columns: List[str]):
+        self.query.append(f"PARTITION BY {method} ({', '.join(columns)})")
+        return self
+
+    def CREATE_PARTITION(self, partition_name: str, table_name: str, values: List[str], if_not_exists: bool = False):
+        if_not_exists = ' IF NOT EXISTS' if if_not_exists else ''
+        self.query.append(f"CREATE TABLE{if_not_exists} {partition_name} PARTITION OF {table_name} FOR VALUES IN ({', '.join(values)})")
+        return self
+
+    def ATTACH_PARTITION(self, partition_name: str, values: List[str]):
+        self.query.append(f"ATTACH PARTITION {partition_name} FOR VALUES IN ({', '.join(values)})")
+        return self
+
+    def DETACH_PARTITION(self, partition_name: str, concurrently: bool = False):
+        self.query.append(f"DETACH PARTITION {partition_name}{' CONCURRENTLY' if concurrently else ''}")
         return self
 
     def DROP_TABLE(self, table_names: List[str] = []):
@@ -155,6 +422,30 @@ class PGQuery:
         self.query.append(f"CREATE EXTENSION {extension}")
         return self
 
+    def CREATE_INDEX(self, index_name: str, table_name: str, columns: List[str], using: str = None, concurrently: bool = False,
+                     if_not_exists: bool = False):
+        concurrently = ' CONCURRENTLY' if concurrently else ''
+        if_not_exists = ' IF NOT EXISTS' if if_not_exists else ''
+        using = f" USING {using}" if using else ''
+        self.query.append(f"CREATE INDEX{concurrently}{if_not_exists} {index_name} ON {table_name}{using} ({', '.join(columns)})")
+        return self
+
+    def STORAGE_PARAMETERS(self, parameters: Dict[str, object]):
+        self.query.append(f"WITH ({', '.join(f'{k} = {v}' for k, v in parameters.items())})")
+        return self
+
+    def DROP_INDEX(self, index_names: List[str] = [], concurrently: bool = False):
+        self.query.append(f"DROP INDEX{' CONCURRENTLY' if concurrently else ''} {', '.join(index_names)}")
+        return self
+
+    def REINDEX_INDEX(self, index_name: str, concurrently: bool = False):
+        self.query.append(f"REINDEX INDEX{' CONCURRENTLY' if concurrently else ''} {index_name}")
+        return self
+
+    def SET_LOCAL(self, setting: str, value):
+        self.query.append(f"SET LOCAL {setting} = {value}")
+        return self
+
     def P(self):
         self.query.append('(')
         return self
@@ -163,11 +454,500 @@ class PGQuery:
         self.query.append(')')
         return self
 
+    def AS(self, alias: str):
+        self.query.append(f"AS {alias}")
+        return self
+
     def toVector(list: List[float]):
         return '\'[' + ','.join(map(str, list)) + ']\''
 
+    def toVectorText(vector) -> str:
+        """
+        Formats a vector as pgvector text input without quotes, e.g. [0.1,0.2].
+        '%.9g' round-trips float32 exactly and is faster than str() on NumPy scalars.
+        """
+        return '[' + ','.join(['%.9g' % x for x in np.asarray(vector, dtype=np.float32).tolist()]) + ']'
+
+    def toCopyText(value) -> str:
+        """
+        Formats one value for text-format COPY.
+        """
+        if value is None:
+            return '\\N'
+        if isinstance(value, np.ndarray):
+            return PGQuery.toVectorText(value)
+        if isinstance(value, str):
+            return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        return str(value)
+
+    def toCopyBinary(value) -> bytes:
+        """
+        Encodes one value as a binary COPY field: int32 length followed by the data.
+        Vectors use pgvector's wire format (int16 dim, int16 unused, big-endian float32s).
+        """
+        if value is None:
+            return PGCOPY_NULL
+        if isinstance(value, np.ndarray):
+            data = struct.pack('!hh', value.shape[0], 0) + value.astype('>f4').tobytes()
+        elif isinstance(value, (bool, np.bool_)):
+            data = b'\x01' if value else b'\x00'
+        elif isinstance(value, (int, np.integer)):
+            data = struct.pack('!i', int(value))
+        elif isinstance(value, (float, np.floating)):
+            data = struct.pack('!d', float(value))
+        else:
+            data = str(value).encode('utf-8')
+        return struct.pack('!i', len(data)) + data
+
+    def fromVector(text: str):
+        """
+        Parses a pgvector text value such as '[0.1,0.2]' into a float32 NumPy array.
+        """
+        return np.fromstring(text[1:-1], sep=',', dtype=np.float32)
+
+    def toParam(value):
+        """
+        Converts a bind parameter to something psycopg2 can adapt.
+        Vectors go out as pgvector text ('%.9g' per component) rather than as float lists.
+        """
+        if isinstance(value, np.ndarray):
+            return PGQuery.toVectorText(value)
+        if isinstance(value, np.integer):
+            return int(value)
+        if isinstance(value, np.floating):
+            return float(value)
+        return value
+
     def toString(string: str):
-        return "'{}'".format(string.replace("'", ''))
+        # Standard SQL escaping: a quote inside a literal is doubled
+        return "'{}'".format(string.replace("'", "''"))
     
     def toInt(num: int):
         return str(num)
+
+
+
+def number_placeholders(sql: str, params: list):
+    '''
+    Rewrites %s placeholders to $1..$n, one number per distinct parameter object.
+    Returns:
+        (statement text, values in $n order)
+    '''
+    numbers = {}
+    values = []
+    params = iter(params)
+
+    def replace(match):
+        if match.group() == '%%':
+            return '%'
+        param = next(params)
+        if id(param) not in numbers:
+            values.append(param)
+            numbers[id(param)] = len(values)
+        return f'${numbers[id(param)]}'
+
+    return PLACEHOLDER.sub(replace, sql), values
+
+
+class PreparedStatementCache:
+    """
+    Server-side prepared statements, tracked per connection.
+
+    The first execution of a query text on a connection sends PREPARE, later ones only
+    EXECUTE with the bound values, so Postgres skips parsing and analysis and can reuse a
+    cached plan. A parameter object used several times in one query (e.g. the query vector
+    in both SELECT and ORDER BY) is bound once and referenced as the same $n.
+    """
+
+    def __init__(self, per_connection: int = PREPARED_STATEMENTS_PER_CONNECTION):
+        self.per_connection = per_connection
+        self._statements = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = REGISTRY.counter('pg_prepared_hits_total', 'Executions of an already prepared statement')
+        self.misses = REGISTRY.counter('pg_prepared_misses_total', 'Statements prepared on a connection')
+        self.evictions = REGISTRY.counter('pg_prepared_evictions_total', 'Prepared statements deallocated to stay under the per-connection limit')
+        self.hit_ratio = REGISTRY.gauge('pg_prepared_hit_ratio', 'Share of parameterized executions that reused a prepared statement')
+
+    def execute(self, connection, cursor, sql: str, params: list):
+        statement, values = number_placeholders(sql, params)
+        name = 'pgq_' + hashlib.blake2b(statement.encode('utf-8'), digest_size=8).hexdigest()
+
+        with self._lock:
+            prepared = self._statements.setdefault(connection, OrderedDict())
+            hit = name in prepared
+            if hit:
+                prepared.move_to_end(name)
+            evicted = prepared.popitem(last=False)[0] if not hit and len(prepared) >= self.per_connection else None
+
+        if not hit:
+            if evicted is not None:
+                cursor.execute(f'DEALLOCATE {evicted};')
+                self.evictions.inc()
+            # Survives a statement that failed after a PREPARE, or a cache that lost track
+            cursor.execute('SELECT 1 FROM pg_prepared_statements WHERE name = %s;', (name,))
+            if cursor.fetchone() is None:
+                cursor.execute(f'PREPARE {name} AS {statement};')
+            with self._lock:
+                self._statements.setdefault(connection, OrderedDict())[name] = statement
+
+        (self.hits if hit else self.misses).inc()
+        total = self.hits.value + self.misses.value
+        self.hit_ratio.set(self.hits.value / total)
+
+        arguments = f" ({', '.join(['%s'] * len(values))})" if values else ''
+        cursor.execute(f'EXECUTE {name}{arguments};', [PGQuery.toParam(value) for value in values])
+
+    def stats(self) -> dict:
+        with self._lock:
+            statements = sum(len(prepared) for prepared in self._statements.values())
+        return {
+            'statements'    : statements,
+            'hits'          : self.hits.value,
+            'misses'        : self.misses.value,
+            'hit_ratio'     : self.hit_ratio.value,
+            'evictions'     : self.evictions.value,
+        }
+
+
+PREPARED_STATEMENTS = PreparedStatementCache()
+
+
+class QueryInstrumentation:
+    """
+    Opt-in timing of every PGQuery execution, see enable_instrumentation().
+
+    Each execution lands in the pg_query_seconds histogram of its query shape (the SQL with
+    literals replaced by ?). Statements slower than slow_seconds go into a bounded slow log;
+    read-only ones are run once more under EXPLAIN (ANALYZE, BUFFERS) on the same connection
+    and transaction, at most once per shape every explain_interval seconds, so the log shows
+    which plan node took the time and how much of it was spent outside the server.
+    """
+
+    def __init__(self, slow_seconds: float = 0.25, explain: bool = True, slow_log_size: int = 50,
+                 explain_interval: float = 60.0):
+        self.slow_seconds = slow_seconds
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.slow_log = deque(maxlen=slow_log_size)
+        self._shapes = {}
+        self._last_explained = {}
+        self._lock = threading.Lock()
+        self.slow_counter = REGISTRY.counter('pg_slow_queries_total', 'Statements slower than the slow-query threshold')
+
+    def shape(sql: str) -> str:
+        return SHAPE_LISTS.sub('?', SHAPE_LITERALS.sub('?', sql))
+
+    def record(self, connection, sql: str, executed, seconds: float):
+        shape = QueryInstrumentation.shape(sql)
+        shape_id = 'q' + hashlib.blake2b(shape.encode('utf-8'), digest_size=4).hexdigest()
+        with self._lock:
+            if shape_id not in self._shapes:
+                self._shapes[shape_id] = (shape, REGISTRY.histogram(
+                    'pg_query_seconds', 'PGQuery execution time by query shape', labels={'shape': shape_id}
+                ))
+            histogram = self._shapes[shape_id][1]
+        histogram.observe(seconds)
+
+        if seconds < self.slow_seconds:
+            return
+        self.slow_counter.inc()
+        entry = {
+            'shape'     : shape_id,
+            'seconds'   : seconds,
+            'statement' : executed.decode('utf-8', 'replace')[:2000] if isinstance(executed, bytes) else str(executed)[:2000],
+            'at'        : time.time(),
+        }
+        if self.explain and self._should_explain(shape_id, sql, connection):
+            entry.update(self._explain(connection, executed, seconds))
+        with self._lock:
+            self.slow_log.append(entry)
+        print(f"Slow query {shape_id} took {seconds * 1000:.1f} ms: {shape[:200]}")
+
+    def _should_explain(self, shape_id: str, sql: str, connection) -> bool:
+        # EXPLAIN ANALYZE executes the statement again, so only for reads and only in a healthy transaction
+        if sql.lstrip().split(' ', 1)[0].upper() not in ('SELECT', 'WITH'):
+            return False
+        if connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_explained.get(shape_id, float('-inf')) < self.explain_interval:
+                return False
+            self._last_explained[shape_id] = now
+        return True
+
+    def _explain(self, connection, executed, seconds: float) -> dict:
+        executed = executed.decode('utf-8') if isinstance(executed, bytes) else executed
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + executed)
+            plan = [row[0] for row in cursor.fetchall()]
+            cursor.close()
+        except Exception as e:
+            return {'explain_error': str(e)}
+
+        explained = {'plan': plan}
+        server = EXECUTION_TIME.search(plan[-1] if plan else '')
+        if server:
+            explained['server_seconds'] = float(server.group(1)) / 1000
+            # Round trip, result transfer and client-side decoding
+            explained['outside_server_seconds'] = max(0.0, seconds - explained['server_seconds'])
+        return explained
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            shapes = dict(self._shapes)
+            slow = list(self.slow_log)
+        return {
+            'slow_seconds'  : self.slow_seconds,
+            'shapes'        : {
+                shape_id: dict(histogram.snapshot(), shape=shape)
+                for shape_id, (shape, histogram) in shapes.items()
+            },
+            'slow_queries'  : slow,
+        }
+
+
+QUERY_INSTRUMENTATION = None
+
+
+def enable_instrumentation(slow_seconds: float = 0.25, explain: bool = True, slow_log_size: int = 50) -> QueryInstrumentation:
+    """
+    Turns on timing for every PGQuery execution in this process.
+    """
+    global QUERY_INSTRUMENTATION
+    QUERY_INSTRUMENTATION = QueryInstrumentation(slow_seconds, explain, slow_log_size)
+    return QUERY_INSTRUMENTATION
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PGConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Keeps between min_size and max_size connections open. Connections idle for longer than
+    max_idle_seconds are closed down to min_size, connections older than max_lifetime_seconds
+    are replaced, and a connection that sat idle for health_check_seconds is pinged with
+    SELECT 1 before it is handed out.
+
+    Usage:
+        with pool.query() as SQL:
+            rows = SQL.SELECT(['*']).FROM(['Posts']).execute_fetch()
+    """
+
+    def __init__(self, login: Dict[str, str], min_size: int = 1, max_size: int = 10,
+                 max_idle_seconds: float = 300, max_lifetime_seconds: float = 3600,
+                 health_check_seconds: float = 30, checkout_timeout: float = 30, name: str = None):
+        self.login = dict(login)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.health_check_seconds = health_check_seconds
+        self.checkout_timeout = checkout_timeout
+        self.name = name or self.login.get('dbname', 'default')
+
+        # Idle connections as (connection, created_at, last_used), most recently used on the right
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._checked_out = set()
+        self._closed = False
+        self._condition = threading.Condition()
+
+        labels = {'pool': self.name}
+        self.wait_histogram = REGISTRY.histogram('pg_pool_wait_seconds', 'Time spent waiting to check out a connection', labels=labels)
+        self.in_use_gauge = REGISTRY.gauge('pg_pool_in_use', 'Connections currently checked out', labels)
+        self.size_gauge = REGISTRY.gauge('pg_pool_size', 'Open connections, idle or in use', labels)
+        self.checkouts = REGISTRY.counter('pg_pool_checkouts_total', 'Connections handed out', labels)
+        self.timeouts = REGISTRY.counter('pg_pool_timeouts_total', 'Checkouts that gave up waiting', labels)
+        self.replaced = REGISTRY.counter('pg_pool_replaced_total', 'Connections closed for failing a health check or ageing out', labels)
+
+    def prefill(self):
+        """
+        Opens connections until min_size are available.
+        """
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            connection = self._connect()
+            self.putconn(connection)
+
+    def _connect(self):
+        try:
+            connection = psycopg2.connect(**self.login)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._update_gauges()
+                self._condition.notify()
+            raise
+        self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    def _close(self, connection):
+        self._created_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _recycle_idle(self):
+        """
+        Closes connections idle for longer than max_idle_seconds while above min_size.
+        The least recently used connections are on the left of the deque.
+        Must be called with the condition held.
+        """
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][2] > self.max_idle_seconds:
+            connection, _, _ = self._idle.popleft()
+            self._size -= 1
+            self._close(connection)
+
+    def _is_healthy(self, connection, created_at: float, last_used: float) -> bool:
+        now = time.monotonic()
+        if connection.closed or now - created_at > self.max_lifetime_seconds:
+            return False
+        if now - last_used < self.health_check_seconds:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1;')
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self, timeout: float = None):
+        """
+        Checks out a connection, opening a new one if the pool is below max_size.
+        Raises:
+            PoolTimeoutError: no connection became free within timeout (default checkout_timeout).
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+
+        while True:
+            entry = None
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError(f"pool {self.name} is closed")
+                    self._recycle_idle()
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._condition.wait(remaining):
+                        if not self._idle and self._size >= self.max_size:
+                            self.timeouts.inc()
+                            raise PoolTimeoutError(f"no connection available in pool {self.name} after {timeout}s")
+
+            if entry is None:
+                connection = self._connect()
+                break
+
+            connection, created_at, last_used = entry
+            if self._is_healthy(connection, created_at, last_used):
+                break
+
+            # Replace the broken or expired connection and try again
+            self.replaced.inc()
+            self._close(connection)
+            with self._condition:
+                self._size -= 1
+
+        with self._condition:
+            self._checked_out.add(id(connection))
+            self._update_gauges()
+        self.checkouts.inc()
+        self.wait_histogram.observe(time.perf_counter() - start)
+        return connection
+
+    def putconn(self, connection, discard: bool = False):
+        """
+        Returns a connection to the pool. Open transactions are rolled back and
+        autocommit is reset. Broken connections, or discard=True, close it instead.
+        """
+        if not discard and not connection.closed:
+            try:
+                status = connection.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                if not discard and connection.autocommit:
+                    connection.autocommit = False
+            except Exception:
+                discard = True
+
+        with self._condition:
+            self._checked_out.discard(id(connection))
+            if discard or connection.closed or self._closed:
+                self._size -= 1
+                self._close(connection)
+            else:
+                self._idle.append((connection, self._created_at[id(connection)], time.monotonic()))
+            self._update_gauges()
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        Borrows a connection for the duration of the with block.
+        A connection that raised a psycopg2 connection error is discarded instead of reused.
+        """
+        connection = self.getconn(timeout)
+        discard = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(connection, discard=discard)
+
+    @contextmanager
+    def query(self, timeout: float = None):
+        """
+        Borrows a connection wrapped in a PGQuery builder.
+        """
+        with self.connection(timeout) as connection:
+            yield PGQuery(connection)
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                connection, _, _ = self._idle.pop()
+                self._size -= 1
+                self._close(connection)
+            self._update_gauges()
+            self._condition.notify_all()
+
+    def _update_gauges(self):
+        self.in_use_gauge.set(len(self._checked_out))
+        self.size_gauge.set(self._size)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'size'          : self._size,
+                'idle'          : len(self._idle),
+                'in_use'        : len(self._checked_out),
+                'max_size'      : self.max_size,
+                'utilization'   : len(self._checked_out) / self.max_size,
+                'checkouts'     : self.checkouts.value,
+                'timeouts'      : self.timeouts.value,
+                'wait_seconds'  : self.wait_histogram.snapshot(),
+            }
@@ -0,0 +1,195 @@
+import os
+import gc
+import time
+import signal
+import threading
+import traceback
+from typing import Callable, Dict, List
+
+from Metrics import REGISTRY
+
+'''
+Pre-fork serving: one supervisor process, N worker processes, one listening socket.
+
+The supervisor binds the socket and (optionally) loads the models, then forks the
+workers. Every worker accepts connections from the inherited socket and serves them
+with its own threads, so CPU-bound work (tokenization, post-processing, the model
+itself) runs on N interpreters instead of behind one GIL.
+
+Model weights loaded before the fork are shared copy-on-write: inference never writes
+to them, so the pages stay shared and an extra worker costs its own heap and
+activations, not another copy of the weights. Weights memory-mapped from a file
+(ModelRuntime.load_model with a state dict) are shared through the page cache even
+when every worker maps them itself.
+
+The supervisor restarts workers that exit and backs off when they keep crashing.
+SIGTERM or SIGINT to the supervisor stops the workers and exits.
+'''
+
+# A worker that keeps dying is restarted at most MAX_RESTARTS times per RESTART_WINDOW_SECONDS,
+# after that the supervisor waits RESTART_BACKOFF_SECONDS before each restart
+MAX_RESTARTS = 10
+RESTART_WINDOW_SECONDS = 60
+RESTART_BACKOFF_SECONDS = 5.0
+SHUTDOWN_TIMEOUT_SECONDS = 10
+PARENT_CHECK_SECONDS = 1.0
+
+
+def exit_description(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        return f"killed by signal {os.WTERMSIG(status)}"
+    return f"exit code {os.WEXITSTATUS(status)}"
+
+
+def watch_parent(parent_pid: int, interval: float = PARENT_CHECK_SECONDS):
+    """
+    Exits the worker once its supervisor is gone (re-parented to init),
+    so a killed supervisor does not leave workers holding the port.
+    """
+    def watch():
+        while True:
+            time.sleep(interval)
+            if os.getppid() != parent_pid:
+                os._exit(0)
+
+    threading.Thread(target=watch, name='watch-supervisor', daemon=True).start()
+
+
+def process_memory(pid: int) -> Dict[str, int]:
+    """
+    Resident and proportional set size of a process in bytes, from /proc (Linux only).
+    PSS splits every shared page between the processes mapping it, so summing PSS
+    over the workers counts shared weights once.
+    """
+    memory = {}
+    with open(f'/proc/{pid}/smaps_rollup') as smaps:
+        for line in smaps:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'Shared_Clean', 'Private_Dirty'):
+                memory[key.lower()] = int(value.split()[0]) * 1024
+    return memory
+
+
+class PreforkSupervisor:
+    """
+    Forks `workers` processes that each run server.serve_forever() on the same socket.
+
+        server = make_server((host, port))          # binds and listens once
+        load_models()                               # optional, shared copy-on-write
+        PreforkSupervisor(server, 4, worker_init=start_worker).run()
+
+    worker_init(worker_index) runs in each new worker before it serves: start threads,
+    open database connections and anything else that does not survive a fork there.
+    """
+
+    def __init__(self, server, workers: int, worker_init: Callable[[int], None] = None,
+                 max_restarts: int = MAX_RESTARTS, restart_window: float = RESTART_WINDOW_SECONDS,
+                 restart_backoff: float = RESTART_BACKOFF_SECONDS, shutdown_timeout: float = SHUTDOWN_TIMEOUT_SECONDS):
+        if workers < 1:
+            raise ValueError(f"Need at least one worker, got {workers}")
+        self.server = server
+        self.workers = workers
+        self.worker_init = worker_init
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.restart_backoff = restart_backoff
+        self.shutdown_timeout = shutdown_timeout
+        self.pid = os.getpid()
+        self.children = {}          # pid -> worker index
+        self._restarts = []         # times of recent restarts
+        self._stopping = False
+
+        self.workers_gauge = REGISTRY.gauge('prefork_workers', 'Worker processes alive')
+        self.restarts_counter = REGISTRY.counter('prefork_worker_restarts_total', 'Workers restarted after exiting')
+
+    def _serve(self, index: int):
+        # Runs in the child and never returns
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group, the supervisor decides when workers stop
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            watch_parent(self.pid)
+            if self.worker_init is not None:
+                self.worker_init(index)
+            self.server.serve_forever()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            self._serve(index)
+        self.children[pid] = index
+        self.workers_gauge.set(len(self.children))
+
+    def _stop(self, signum=None, frame=None):
+        self._stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _restart_delay(self) -> float:
+        now = time.monotonic()
+        self._restarts = [at for at in self._restarts if now - at < self.restart_window]
+        self._restarts.append(now)
+        return self.restart_backoff if len(self._restarts) > self.max_restarts else 0.0
+
+    def worker_pids(self) -> List[int]:
+        return list(self.children)
+
+    def run(self):
+        """
+        Forks the workers and supervises them until SIGTERM / SIGINT.
+        """
+        # Move everything allocated so far out of the collector's reach: collections in the
+        # workers would otherwise write to the GC headers and un-share those pages
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        # Workers race for each accept(), the losers must not block in it
+        self.server.socket.setblocking(False)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._spawn(index)
+        print(f"Supervisor {self.pid} started {self.workers} workers: {self.worker_pids()}")
+
+        deadline = None
+        while self.children:
+            if self._stopping and deadline is None:
+                deadline = time.monotonic() + self.shutdown_timeout
+            if deadline is not None and time.monotonic() > deadline:
+                for pid in list(self.children):
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG if self._stopping else 0)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.1)
+                continue
+
+            index = self.children.pop(pid, None)
+            self.workers_gauge.set(len(self.children))
+            if index is None or self._stopping:
+                continue
+
+            print(f"Worker {index} (pid {pid}) stopped: {exit_description(status)}, restarting")
+            self.restarts_counter.inc()
+            delay = self._restart_delay()
+            if delay:
+                print(f"Workers are crashing repeatedly, waiting {delay:.0f} s before restarting")
+                time.sleep(delay)
+            if not self._stopping:
+                self._spawn(index)
+
+        self.server.server_close()
+        print("Supervisor stopped")
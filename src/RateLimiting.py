@@ -0,0 +1,181 @@
+import time
+import random
+import threading
+from typing import Callable, Dict
+
+from Metrics import REGISTRY
+
+'''
+Client-side rate limiting for the Piazza fetcher.
+
+A token bucket spaces requests out at rate_per_minute with room for a short burst.
+Errors back off exponentially with jitter and halve the bucket's rate; every
+recover_after successes in a row give back recover_step requests/minute until the
+configured rate is reached again (additive increase, multiplicative decrease).
+'''
+
+WAIT_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 900.0)
+
+DEFAULT_RATE_LIMIT = {
+    'rate_per_minute'       : 10.0,     # steady request rate
+    'burst'                 : 3,        # requests allowed back to back after idling
+    'min_rate_per_minute'   : 0.5,      # floor after repeated errors
+    'recover_after'         : 20,       # successes in a row before raising the rate again
+    'recover_step'          : 1.0,      # requests/minute added per recovery
+    'backoff_base_seconds'  : 30.0,
+    'backoff_max_seconds'   : 60.0 * 15,
+}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available
+    and returns how long it waited.
+    """
+
+    def __init__(self, rate_per_second: float, burst: int = 1,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate_per_second: float):
+        with self._lock:
+            self._refill(self.clock())
+            self.rate = rate_per_second
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+
+class ExponentialBackoff:
+    """
+    Delay before retry number `attempt` (0-based): base * 2**attempt capped at max_seconds,
+    with "equal jitter" so it is never shorter than half of that.
+    """
+
+    def __init__(self, base_seconds: float, max_seconds: float, rng: random.Random = None):
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.rng = rng or random.Random()
+
+    def delay(self, attempt: int) -> float:
+        ceiling = min(self.max_seconds, self.base_seconds * 2 ** attempt)
+        return ceiling / 2 + self.rng.uniform(0, ceiling / 2)
+
+
+class PiazzaRateLimiter:
+    """
+    Rate limit, backoff and adaptive rate for one Piazza network.
+
+        limiter.acquire()                  # before each request
+        limiter.success()                  # after a request went through
+        limiter.failure(attempt)           # after a failed request, sleeps the backoff
+        limiter.failure(attempt, False)    # after the last attempt: no retry to back off for
+
+    Wait times, backoffs, errors and the current rate are exported as metrics
+    labelled with the network name.
+    """
+
+    def __init__(self, name: str = 'default', rate_per_minute: float = DEFAULT_RATE_LIMIT['rate_per_minute'],
+                 burst: int = DEFAULT_RATE_LIMIT['burst'],
+                 min_rate_per_minute: float = DEFAULT_RATE_LIMIT['min_rate_per_minute'],
+                 recover_after: int = DEFAULT_RATE_LIMIT['recover_after'],
+                 recover_step: float = DEFAULT_RATE_LIMIT['recover_step'],
+                 backoff_base_seconds: float = DEFAULT_RATE_LIMIT['backoff_base_seconds'],
+                 backoff_max_seconds: float = DEFAULT_RATE_LIMIT['backoff_max_seconds'],
+                 sleep: Callable[[float], None] = time.sleep):
+        self.name = name
+        self.max_rate_per_minute = rate_per_minute
+        self.min_rate_per_minute = min(min_rate_per_minute, rate_per_minute)
+        self.rate_per_minute = rate_per_minute
+        self.recover_after = recover_after
+        self.recover_step = recover_step
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate_per_minute / 60, burst, sleep=sleep)
+        self.backoff = ExponentialBackoff(backoff_base_seconds, backoff_max_seconds)
+        self._successes = 0
+        self._lock = threading.Lock()
+
+        labels = {'network': name}
+        self.wait_histogram = REGISTRY.histogram('piazza_rate_limit_wait_seconds', 'Time spent waiting for a request token', WAIT_BUCKETS, labels)
+        self.backoff_histogram = REGISTRY.histogram('piazza_backoff_seconds', 'Backoff slept after a failed request', WAIT_BUCKETS, labels)
+        self.requests_counter = REGISTRY.counter('piazza_requests_total', 'Piazza requests sent', labels)
+        self.errors_counter = REGISTRY.counter('piazza_request_errors_total', 'Piazza requests that failed', labels)
+        self.rate_gauge = REGISTRY.gauge('piazza_rate_per_minute', 'Current Piazza request rate', labels)
+        self.rate_gauge.set(rate_per_minute)
+
+    @classmethod
+    def from_config(cls, name: str, config: Dict[str, float] = None, **kwargs) -> 'PiazzaRateLimiter':
+        """
+        Builds a limiter from DEFAULT_RATE_LIMIT overridden by config.
+        """
+        settings = dict(DEFAULT_RATE_LIMIT)
+        settings.update(config or {})
+        settings.update(kwargs)
+        return cls(name, **settings)
+
+    def _set_rate(self, rate_per_minute: float):
+        self.rate_per_minute = rate_per_minute
+        self.bucket.set_rate(rate_per_minute / 60)
+        self.rate_gauge.set(rate_per_minute)
+
+    def acquire(self) -> float:
+        waited = self.bucket.acquire()
+        self.wait_histogram.observe(waited)
+        self.requests_counter.inc()
+        return waited
+
+    def success(self):
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.recover_after and self.rate_per_minute < self.max_rate_per_minute:
+                self._successes = 0
+                self._set_rate(min(self.max_rate_per_minute, self.rate_per_minute + self.recover_step))
+
+    def failure(self, attempt: int, backoff: bool = True) -> float:
+        """
+        Halves the rate and sleeps the backoff for retry number `attempt`.
+        With backoff=False (no retry follows) the error is counted and the rate halved,
+        but nothing is slept: the lower rate spaces out the next requests.
+        Returns:
+            Seconds slept.
+        """
+        with self._lock:
+            self._successes = 0
+            self._set_rate(max(self.min_rate_per_minute, self.rate_per_minute / 2))
+        self.errors_counter.inc()
+        if not backoff:
+            return 0.0
+
+        delay = self.backoff.delay(attempt)
+        self.backoff_histogram.observe(delay)
+        self.sleep(delay)
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            'rate_per_minute'   : self.rate_per_minute,
+            'requests'          : self.requests_counter.value,
+            'errors'            : self.errors_counter.value,
+            'wait_seconds'      : self.wait_histogram.snapshot()['sum'],
+            'backoff_seconds'   : self.backoff_histogram.snapshot()['sum'],
+        }
@@ -0,0 +1,168 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+from Metrics import REGISTRY
+
+'''
+Cache of serialized search responses, invalidated by the data version.
+
+The search corpus only changes when ingestion writes to it, and every such write bumps
+DataVersion (ScrapePipeline.bumpDataVersion). Entries are stored with the version they
+were computed at; a lookup at a newer version drops the whole cache, so a response
+never outlives the data it came from by more than one poll of the version.
+Entries hold the JSON bytes that go on the wire, a hit skips json.dumps as well.
+'''
+
+# Rough per-entry bookkeeping cost on top of the body and key (dict slot, tuple, bytes header)
+ENTRY_OVERHEAD_BYTES = 200
+DATA_VERSION_POLL_SECONDS = 5
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of response bodies with a memory budget.
+
+        body = cache.get(key, version)              # None on a miss
+        cache.put(key, version, body)
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 24 * 3600, name: str = 'piazza_search',
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.name = name
+        self.clock = clock
+        self.bytes = 0
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        labels = {'cache': name}
+        self.hits = REGISTRY.counter('response_cache_hits_total', 'Responses served from the cache', labels)
+        self.misses = REGISTRY.counter('response_cache_misses_total', 'Responses that had to be computed', labels)
+        self.evictions = REGISTRY.counter('response_cache_evictions_total', 'Entries dropped to stay within max_bytes', labels)
+        self.expirations = REGISTRY.counter('response_cache_expirations_total', 'Entries dropped after the TTL', labels)
+        self.invalidations = REGISTRY.counter('response_cache_invalidations_total', 'Cache flushes after the data version changed', labels)
+        self.entries_gauge = REGISTRY.gauge('response_cache_entries', 'Entries currently cached', labels)
+        self.bytes_gauge = REGISTRY.gauge('response_cache_bytes', 'Approximate memory held by the cache', labels)
+        self.hit_ratio_gauge = REGISTRY.gauge('response_cache_hit_ratio', 'Share of lookups answered from the cache', labels)
+
+    def _check_version(self, version: int):
+        # Called with the lock held
+        if version == self.version:
+            return
+        if self.version is not None and version < self.version:
+            # A lookup that read the version before a newer put; it must not flush newer entries
+            return
+        if self._entries:
+            self.invalidations.inc()
+        self._entries.clear()
+        self.bytes = 0
+        self.version = version
+        self._update_gauges()
+
+    def get(self, key: Hashable, version: int) -> Optional[bytes]:
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key) if version == self.version else None
+            if entry is not None:
+                body, expires_at = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits.inc()
+                    self._update_hit_ratio()
+                    return body
+                self._remove(key)
+                self.expirations.inc()
+            self.misses.inc()
+            self._update_hit_ratio()
+            return None
+
+    def put(self, key: Hashable, version: int, body: bytes):
+        with self._lock:
+            self._check_version(version)
+            if version != self.version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, self.clock() + self.ttl)
+            self.bytes += self._entry_bytes(key, body)
+
+            while self.bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions.inc()
+            self._update_gauges()
+
+    def _remove(self, key: Hashable):
+        body, _ = self._entries.pop(key)
+        self.bytes -= self._entry_bytes(key, body)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        self.entries_gauge.set(len(self._entries))
+        self.bytes_gauge.set(self.bytes)
+
+    def _update_hit_ratio(self):
+        lookups = self.hits.value + self.misses.value
+        self.hit_ratio_gauge.set(self.hits.value / lookups)
+
+    @staticmethod
+    def _entry_bytes(key: Hashable, body: bytes) -> int:
+        return len(body) + len(repr(key)) + ENTRY_OVERHEAD_BYTES
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self._update_gauges()
+
+    def stats(self) -> dict:
+        lookups = self.hits.value + self.misses.value
+        return {
+            'version'       : self.version,
+            'entries'       : len(self._entries),
+            'bytes'         : self.bytes,
+            'max_bytes'     : self.max_bytes,
+            'hits'          : self.hits.value,
+            'misses'        : self.misses.value,
+            'evictions'     : self.evictions.value,
+            'expirations'   : self.expirations.value,
+            'invalidations' : self.invalidations.value,
+            'hit_ratio'     : (self.hits.value / lookups) if lookups else 0.0,
+        }
+
+
+class DataVersionPoller:
+    """
+    Reads the data version every interval on a daemon thread, so request threads
+    (and the asyncio loop) only read an attribute. `version` is None until the first
+    successful read and whenever the version can not be read; callers skip the cache then.
+    """
+
+    def __init__(self, read_version: Callable[[], Optional[int]], interval: float = DATA_VERSION_POLL_SECONDS):
+        self.read_version = read_version
+        self.interval = interval
+        self.version = None
+        self._thread = None
+
+    def poll(self) -> Optional[int]:
+        try:
+            self.version = self.read_version()
+        except Exception as e:
+            print(e)
+            self.version = None
+        return self.version
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def poll_forever():
+            while True:
+                self.poll()
+                time.sleep(self.interval)
+
+        self._thread = threading.Thread(target=poll_forever, name='data-version', daemon=True)
+        self._thread.start()
@@ -0,0 +1,641 @@
+import re
+import time
+import hashlib
+import queue
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from BatchEncoding import SentenceBatchEncoder, post_sentences
+from RateLimiting import PiazzaRateLimiter
+from HybridSearch import create_search_vector
+
+'''
+Staged, resumable ingestion of one Piazza semester.
+
+    fetch ──queue──> clean ──queue──> embed ──queue──> load
+
+Each stage runs on its own thread and the queues between them are bounded, so
+encoding and database writes overlap with the rate-limited fetching while a slow
+stage still pushes back on the ones before it.
+
+The load stage writes Posts, Embeddings and the IngestCheckpoints rows of a batch in
+one transaction. A restart reads the checkpoints and only fetches the posts that are
+not done yet, so an interrupted semester resumes exactly where it stopped.
+
+IncrementalSyncPipeline runs the same stages over a semester that is already loaded.
+Posts whose feed timestamp moved are fetched again; a post whose content hash is
+unchanged is left alone, otherwise only sentences with a new hash are encoded and
+Embeddings rows whose sentence disappeared are deleted in the same transaction.
+
+The Piazza side is anything with get_post(post_id) (and get_feed() for syncing),
+e.g. piazza_api's Network or FakePiazza.FakePiazzaNetwork for tests.
+'''
+
+POSTS_INSERT_COLUMNS = ['semester_id', 'post_id', 'post_title', 'post_content', 'instructor_answer', 'student_answer']
+EMBEDDINGS_INSERT_COLUMNS = ['embedding', 'semester_id', 'post_id', 'sentence_hash']
+# Posts columns written by the pipeline on top of the content
+POSTS_LOAD_COLUMNS = POSTS_INSERT_COLUMNS + ['content_hash', 'piazza_updated']
+
+"""
+"IngestCheckpoints" Table (
+  semester_id     INT             NOT NULL,
+  post_id         INT             NOT NULL,
+  status          VARCHAR(16)     NOT NULL,   -- loaded | skipped | failed
+  attempts        INT             NOT NULL,
+  updated_at      TIMESTAMPTZ     NOT NULL,
+  piazza_updated  TEXT,                       -- feed update time when checkpointed
+  PRIMARY KEY(semester_id, post_id),
+  FOREIGN KEY(semester_id) REFERENCES Semesters(semester_id),
+)
+"""
+CHECKPOINTS_COLUMN = [
+                    'semester_id INT NOT NULL',
+                    'post_id INT NOT NULL',
+                    'status VARCHAR(16) NOT NULL',
+                    'attempts INT NOT NULL DEFAULT 1',
+                    'updated_at TIMESTAMPTZ NOT NULL DEFAULT now()',
+                    'piazza_updated TEXT',
+                    'PRIMARY KEY(semester_id, post_id)',
+                    'FOREIGN KEY(semester_id) REFERENCES Semesters(semester_id)'
+                    ]
+
+"""
+"DataVersion" Table (
+  id          INT         PRIMARY KEY,    -- a single row, id 1
+  version     BIGINT      NOT NULL,
+)
+Bumped in the same transaction as every write that changes searchable data, so the
+web server's response cache can tell when its entries went stale.
+"""
+DATA_VERSION_COLUMN = [
+                    'id INT PRIMARY KEY',
+                    'version BIGINT NOT NULL DEFAULT 0'
+                    ]
+
+CHECKPOINT_LOADED = 'loaded'
+CHECKPOINT_SKIPPED = 'skipped'
+CHECKPOINT_FAILED = 'failed'
+
+# Posts that failed this many runs in a row are given up on (usually ids that do not exist)
+MAX_FETCH_ATTEMPTS = 3
+FETCH_RETRIES = 2
+# The session is kept across errors; only this many failures in a row trigger a re-login
+RELOGIN_AFTER_FAILURES = 3
+
+STAGE_QUEUE_SIZE = 64
+LOAD_BATCH_POSTS = 25
+# An embed batch is also cut after this long, so slow fetching does not hold posts back
+LOAD_BATCH_MAX_WAIT_SECONDS = 120
+
+FILTER_HTML_TAGS = re.compile(r'<[^>]*>')
+
+_DONE = object()
+
+
+FEED_LIMIT = 100000
+
+
+def ensureIngestSchema(SQL: PGQ):
+    '''
+    Creates IngestCheckpoints, DataVersion, the Semesters.ingest_complete flag, the
+    change-detection columns and the full-text search column on databases created before they existed.
+    '''
+    SQL.CREATE_TABLE('IngestCheckpoints', CHECKPOINTS_COLUMN, if_not_exists=True).execute_nofetch()
+    SQL.CREATE_TABLE('DataVersion', DATA_VERSION_COLUMN, if_not_exists=True).execute_nofetch()
+    SQL.INSERT_INTO('DataVersion', ['id', 'version']).VALUES([('1', '0')]).ON_CONFLICT(['id']).execute_nofetch()
+    SQL.ALTER_TABLE('Semesters').ADD_COLUMN('ingest_complete BOOLEAN NOT NULL DEFAULT FALSE', if_not_exists=True).execute_nofetch()
+    SQL.ALTER_TABLE('Posts').ADD_COLUMN('content_hash TEXT', if_not_exists=True).execute_nofetch()
+    SQL.ALTER_TABLE('Posts').ADD_COLUMN('piazza_updated TEXT', if_not_exists=True).execute_nofetch()
+    SQL.ALTER_TABLE('IngestCheckpoints').ADD_COLUMN('piazza_updated TEXT', if_not_exists=True).execute_nofetch()
+    SQL.ALTER_TABLE('Embeddings').ADD_COLUMN('sentence_hash TEXT', if_not_exists=True).execute_nofetch()
+    # Incremental sync deletes and reads Embeddings per post
+    SQL.CREATE_INDEX('embeddings_post_idx', 'Embeddings', ['semester_id', 'post_id'], if_not_exists=True).execute_nofetch()
+    # Lexical candidates for the hybrid search
+    create_search_vector(SQL)
+    SQL.commit()
+
+
+def bumpDataVersion(SQL: PGQ):
+    '''
+    Marks the searchable data as changed. Call inside the transaction that changes it.
+    '''
+    SQL.UPDATE('DataVersion').SET(['version = version + 1']).WHERE('id = 1').execute_nofetch(raise_errors=True)
+
+
+def readDataVersion(SQL: PGQ) -> int:
+    '''
+    The current data version, None when the DataVersion table does not exist yet.
+    '''
+    try:
+        rows = SQL.SELECT(['version']).FROM(['DataVersion']).WHERE('id = 1').execute_fetch(raise_errors=True)
+    except Exception:
+        # execute_fetch has already printed the error and rolled back
+        return None
+    return rows[0][0] if rows else None
+
+
+def contentHash(*fields: str) -> str:
+    '''
+    Stable hash of a post's cleaned fields or of a single sentence.
+    '''
+    return hashlib.blake2b('\x1f'.join(fields).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def feedUpdates(network) -> Dict[int, str]:
+    '''
+    Post number -> last update time, from one request for the class feed.
+    Returns an empty dictionary when the feed can not be read.
+    '''
+    try:
+        feed = network.get_feed(limit=FEED_LIMIT, offset=0)
+    except Exception as e:
+        print(f"Error reading the feed: {e}")
+        return {}
+    return {item['nr']: item.get('updated') for item in feed.get('feed', []) if 'nr' in item}
+
+
+def changedPostIds(SQL: PGQ, semester_id: int, updates: Dict[int, str]) -> List[int]:
+    '''
+    Post ids from the feed that are new or whose update time differs from the stored one.
+    Private posts and regrade requests have no Posts row; their update time is the one
+    checkpointed when they were skipped.
+    '''
+    skipped = SQL.SELECT(
+        ['post_id', 'piazza_updated']
+        ).FROM(
+            ['IngestCheckpoints']
+        ).WHERE(
+            f'semester_id = {PGQ.toInt(semester_id)}'
+        ).AND(
+            f'status = {PGQ.toString(CHECKPOINT_SKIPPED)}'
+        ).execute_fetch(raise_errors=True)
+    loaded = SQL.SELECT(
+        ['post_id', 'piazza_updated']
+        ).FROM(
+            ['Posts']
+        ).WHERE(
+            f'semester_id = {PGQ.toInt(semester_id)}'
+        ).execute_fetch(raise_errors=True)
+    SQL.rollback()
+    stored = dict(skipped)
+    stored.update(loaded)
+    return sorted(post_id for post_id, updated in updates.items() if post_id not in stored or stored[post_id] != updated)
+
+
+def storedPostHashes(SQL: PGQ, semester_id: int, post_ids: List[int]) -> Dict[int, Tuple[str, set]]:
+    '''
+    Post id -> (content_hash, set of sentence hashes) of the stored posts among post_ids.
+    '''
+    if not post_ids:
+        return {}
+    rows = SQL.SELECT(
+        ['p.post_id', 'p.content_hash', 'e.sentence_hash']
+        ).FROM(
+            ['Posts AS p']
+        ).LEFT_JOIN(
+            'Embeddings AS e'
+        ).ON(
+            'e.semester_id = p.semester_id AND e.post_id = p.post_id'
+        ).WHERE(
+            f'p.semester_id = {PGQ.toInt(semester_id)}'
+        ).AND(
+            f"p.post_id IN ({', '.join(PGQ.toInt(post_id) for post_id in post_ids)})"
+        ).execute_fetch()
+    SQL.rollback()
+
+    stored = {}
+    for post_id, content_hash, sentence_hash in rows:
+        _, sentence_hashes = stored.setdefault(post_id, (content_hash, set()))
+        if sentence_hash is not None:
+            sentence_hashes.add(sentence_hash)
+    return stored
+
+
+def completedPostIds(SQL: PGQ, semester_id: int, max_attempts: int = MAX_FETCH_ATTEMPTS) -> set:
+    '''
+    Post ids of the semester that need no more work: checkpointed as loaded or skipped,
+    failed max_attempts times, or already in Posts from before checkpointing existed.
+    '''
+    done = SQL.SELECT(
+        ['post_id']
+        ).FROM(
+            ['IngestCheckpoints']
+        ).WHERE(
+            f'semester_id = {PGQ.toInt(semester_id)}'
+        ).AND(
+            f"(status <> {PGQ.toString(CHECKPOINT_FAILED)} OR attempts >= {PGQ.toInt(max_attempts)})"
+        ).UNION(
+        ).SELECT(
+            ['post_id']
+        ).FROM(
+            ['Posts']
+        ).WHERE(
+            f'semester_id = {PGQ.toInt(semester_id)}'
+        ).execute_fetch()
+    SQL.rollback()
+    return {row[0] for row in done}
+
+
+def cleanPost(post: dict):
+    '''
+    Pulls title, content and the endorsed answers out of a raw Piazza post and strips HTML.
+    Returns:
+        (title, content, instructor_answer, student_answer), or None for posts that
+        should not be indexed (regrade requests and private posts).
+    '''
+    if 'regrade' in post.get('folders', []) or post.get('status') == 'private':
+        return None
+
+    title = ''
+    content = ''
+    instructor_answer = ''
+    student_answer = ''
+
+    if 'history' in post and post['history']:
+        if 'subject' in post['history'][0]:
+            title = post['history'][0]['subject']
+
+        if 'content' in post['history'][0]:
+            content = post['history'][0]['content']
+
+    if 'children' in post:
+        for child_post in post['children']:
+            if 'type' in child_post and child_post['type'] == 'i_answer':
+                instructor_answer = ' ' + child_post['history'][0]['content']
+                if len(student_answer) > 0:
+                    break
+
+            elif child_post.get('type') == 's_answer' and child_post.get('is_tag_endorse'):
+                student_answer = child_post['history'][0]['content']
+                if len(instructor_answer) > 0:
+                    break
+
+    # Removing HTML tags and trailing whitespace from the data
+    return (
+        FILTER_HTML_TAGS.sub('', title.strip()),
+        FILTER_HTML_TAGS.sub('', content.strip()),
+        FILTER_HTML_TAGS.sub('', instructor_answer.strip()),
+        FILTER_HTML_TAGS.sub('', student_answer.strip()),
+    )
+
+
+def postSentenceHashes(post: tuple) -> List[Tuple[str, str]]:
+    '''
+    (sentence_hash, sentence) pairs of one Posts row.
+    '''
+    _, _, title, content, instructor_answer, student_answer = post
+    return [(contentHash(sentence), sentence) for _, sentence in post_sentences(title, content, instructor_answer, student_answer)]
+
+
+def embeddingRows(sentence_encoder: SentenceBatchEncoder, posts: List[tuple], known: Dict[int, set] = None) -> List[tuple]:
+    '''
+    Encodes every sentence of the given Posts rows in one batched pass,
+    leaving out sentences whose hash is in known[post_id].
+    Returns:
+        (embedding, semester_id, post_id, sentence_hash) rows ready for the Embeddings table.
+    '''
+    known = known or {}
+    items = []
+    for post in posts:
+        semester_id, post_id = post[0], post[1]
+        skip = known.get(post_id, ())
+        for sentence_hash, sentence in postSentenceHashes(post):
+            if sentence_hash not in skip:
+                items.append(((semester_id, post_id, sentence_hash), sentence))
+
+    rows = [(embedding, semester_id, post_id, sentence_hash)
+            for (semester_id, post_id, sentence_hash), embedding in sentence_encoder.encode(items)]
+    stats = sentence_encoder.last_stats
+    if items and stats:
+        print(f"Encoded {stats['unique_sentences']} sentences from {len(posts)} posts "
+              f"({stats['sentences_per_second']:.0f} sentences/s)")
+    return rows
+
+
+class ScrapePipeline:
+    def __init__(self, network, SQL: PGQ, sentence_encoder: SentenceBatchEncoder, semester_id: int,
+                 post_ids: Iterable[int], rate_limiter: PiazzaRateLimiter = None,
+                 reconnect: Callable[[], object] = None, queue_size: int = STAGE_QUEUE_SIZE,
+                 batch_posts: int = LOAD_BATCH_POSTS, batch_max_wait: float = LOAD_BATCH_MAX_WAIT_SECONDS,
+                 fetch_retries: int = FETCH_RETRIES, relogin_after: int = RELOGIN_AFTER_FAILURES,
+                 updates: Dict[int, str] = None):
+        '''
+        Args:
+            network: object with get_post(post_id).
+            post_ids: ids to ingest, usually everything not in completedPostIds().
+            rate_limiter: paces fetches and backs off on errors.
+            reconnect: returns a fresh network (e.g. re-login) after relogin_after failures in a row.
+            updates: feed update times stored with each post for later incremental syncs.
+        '''
+        self.network = network
+        self.SQL = SQL
+        self.sentence_encoder = sentence_encoder
+        self.semester_id = semester_id
+        self.post_ids = list(post_ids)
+        self.rate_limiter = rate_limiter or PiazzaRateLimiter.from_config(str(semester_id))
+        self.reconnect = reconnect
+        self.batch_posts = batch_posts
+        self.batch_max_wait = batch_max_wait
+        self.fetch_retries = fetch_retries
+        self.relogin_after = relogin_after
+        self.updates = updates or {}
+        self._consecutive_failures = 0
+
+        self.fetched = queue.Queue(maxsize=queue_size)
+        self.cleaned = queue.Queue(maxsize=queue_size)
+        self.embedded = queue.Queue(maxsize=max(1, queue_size // batch_posts))
+        self.stats = {'fetched': 0, 'failed': 0, 'skipped': 0, 'loaded': 0, 'embeddings': 0, 'load_errors': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _drain(self, stage_queue: queue.Queue):
+        '''
+        Consumes a queue up to _DONE, so the stage feeding it is not left blocked on a
+        full queue after the stage reading it has died.
+        '''
+        while stage_queue.get() is not _DONE:
+            pass
+
+    ######## FETCH ########
+    def _fetch_stage(self):
+        # Every stage passes _DONE on however it ends, or the stages after it wait forever
+        try:
+            for post_id in self.post_ids:
+                post = self._fetch(post_id)
+                if post is None:
+                    self._count('failed')
+                    self.fetched.put((post_id, None))
+                else:
+                    self._count('fetched')
+                    self.fetched.put((post_id, post))
+        finally:
+            self.fetched.put(_DONE)
+
+    def _fetch(self, post_id: int):
+        for attempt in range(self.fetch_retries + 1):
+            try:
+                self.rate_limiter.acquire()
+                post = self.network.get_post(post_id)
+                self.rate_limiter.success()
+                self._consecutive_failures = 0
+                return post
+            except Exception as e:
+                print(f"Error fetching post {post_id} (attempt {attempt + 1}): {e}")
+                self._consecutive_failures += 1
+                # The last failure still slows the rate down, it only has no retry to back off for
+                retry = attempt < self.fetch_retries
+                self.rate_limiter.failure(attempt, backoff=retry)
+                if retry and self.reconnect is not None and self._consecutive_failures >= self.relogin_after:
+                    self._relogin()
+        return None
+
+    def _relogin(self):
+        print("Logging in to Piazza again")
+        try:
+            self.network = self.reconnect()
+            self._consecutive_failures = 0
+        except Exception as e:
+            # Piazza is likely down or limiting: the next attempt uses the old session,
+            # and relogin_after more failures try again
+            print(f"Error logging in to Piazza: {e}")
+            self._consecutive_failures = 0
+
+    ######## CLEAN ########
+    def _clean_stage(self):
+        finished = False
+        try:
+            while True:
+                item = self.fetched.get()
+                if item is _DONE:
+                    finished = True
+                    return
+                self.cleaned.put(self._clean(*item))
+        finally:
+            self.cleaned.put(_DONE)
+            if not finished:
+                self._drain(self.fetched)
+
+    def _clean(self, post_id: int, post: dict) -> tuple:
+        if post is None:
+            return post_id, CHECKPOINT_FAILED, None
+        try:
+            cleaned = cleanPost(post)
+        except Exception as e:
+            print(f"Error cleaning post {post_id}: {e}")
+            return post_id, CHECKPOINT_FAILED, None
+
+        if cleaned is None:
+            return post_id, CHECKPOINT_SKIPPED, None
+        return post_id, CHECKPOINT_LOADED, (self.semester_id, post_id) + cleaned
+
+    ######## EMBED ########
+    def _next_batch(self):
+        '''
+        Collects up to batch_posts cleaned posts, cutting the batch early after batch_max_wait.
+        Returns:
+            (batch, done) where done means the clean stage has finished.
+        '''
+        first = self.cleaned.get()
+        if first is _DONE:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.batch_max_wait
+        while len(batch) < self.batch_posts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.cleaned.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _embed_stage(self):
+        done = False
+        try:
+            while not done:
+                batch, done = self._next_batch()
+                if not batch:
+                    continue
+
+                posts = [row for _, status, row in batch if status == CHECKPOINT_LOADED]
+                checkpoints = [(post_id, status) for post_id, status, _ in batch]
+                try:
+                    embeddings = self._embed(posts)
+                except Exception as e:
+                    print(f"Error encoding posts: {e}")
+                    posts, embeddings = [], []
+                    checkpoints = [(post_id, CHECKPOINT_FAILED) for post_id, _ in checkpoints]
+                self.embedded.put((posts, embeddings, checkpoints))
+        finally:
+            self.embedded.put(_DONE)
+            if not done:
+                self._drain(self.cleaned)
+
+    def _embed(self, posts: List[tuple]) -> List[tuple]:
+        return embeddingRows(self.sentence_encoder, posts)
+
+    ######## LOAD ########
+    def _post_rows(self, posts: List[tuple]) -> List[tuple]:
+        return [post + (contentHash(*post[2:]), self.updates.get(post[1])) for post in posts]
+
+    def _feed_time(self, post_id: int) -> str:
+        updated = self.updates.get(post_id)
+        return PGQ.toString(updated) if updated is not None else 'NULL'
+
+    def _write_checkpoints(self, checkpoints: List[Tuple[int, str]]):
+        if not checkpoints:
+            return
+        self.SQL.INSERT_INTO(
+            'IngestCheckpoints', ('semester_id', 'post_id', 'status', 'piazza_updated')
+            ).VALUES([
+                (PGQ.toInt(self.semester_id), PGQ.toInt(post_id), PGQ.toString(status), self._feed_time(post_id))
+                for post_id, status in checkpoints
+            ]).ON_CONFLICT(
+                ['semester_id', 'post_id'],
+                'DO UPDATE SET status = EXCLUDED.status, attempts = IngestCheckpoints.attempts + 1, updated_at = now(), '
+                'piazza_updated = EXCLUDED.piazza_updated'
+            ).execute_nofetch(raise_errors=True)
+
+    def _write(self, posts: List[tuple], embeddings: List[tuple], checkpoints: List[Tuple[int, str]]):
+        if posts:
+            self.SQL.copy_rows('Posts', POSTS_LOAD_COLUMNS, self._post_rows(posts))
+            self.SQL.copy_rows('Embeddings', EMBEDDINGS_INSERT_COLUMNS, embeddings)
+            bumpDataVersion(self.SQL)
+        self._write_checkpoints(checkpoints)
+
+    def _load_stage(self):
+        finished = False
+        try:
+            while True:
+                item = self.embedded.get()
+                if item is _DONE:
+                    finished = True
+                    return
+                self._load(*item)
+        finally:
+            if not finished:
+                self._drain(self.embedded)
+
+    def _load(self, posts: List[tuple], embeddings: List[tuple], checkpoints: List[Tuple[int, str]]):
+        autocommit = None
+        try:
+            autocommit = self.SQL.connection.autocommit
+            self.SQL.connection.autocommit = False
+            self._write(posts, embeddings, checkpoints)
+            self.SQL.commit()
+            self.SQL.connection.autocommit = autocommit
+        except Exception as e:
+            # Nothing of this batch was committed, a restart fetches these posts again
+            print(f"Error loading posts {[post_id for post_id, _ in checkpoints]}: {e}")
+            self._count('load_errors')
+            try:
+                self.SQL.rollback()
+                if autocommit is not None:
+                    self.SQL.connection.autocommit = autocommit
+            except Exception as rollback_error:
+                # e.g. the connection dropped: the following batches fail the same way
+                print(f"Error rolling back: {rollback_error}")
+            return
+
+        self._count('loaded', len(posts))
+        self._count('skipped', sum(1 for _, status in checkpoints if status == CHECKPOINT_SKIPPED))
+        self._count('embeddings', len(embeddings))
+
+    def run(self) -> dict:
+        '''
+        Runs all four stages to completion.
+        Returns:
+            Counters of fetched, failed, skipped and loaded posts.
+        '''
+        start = time.perf_counter()
+        stages = [
+            threading.Thread(target=self._fetch_stage, name='scrape-fetch', daemon=True),
+            threading.Thread(target=self._clean_stage, name='scrape-clean', daemon=True),
+            threading.Thread(target=self._embed_stage, name='scrape-embed', daemon=True),
+            threading.Thread(target=self._load_stage, name='scrape-load', daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        self.stats['seconds'] = time.perf_counter() - start
+        self.stats['rate_limiter'] = self.rate_limiter.stats()
+        return dict(self.stats)
+
+
+class IncrementalSyncPipeline(ScrapePipeline):
+    """
+    Re-ingests changed posts of a loaded semester. post_ids are usually changedPostIds().
+
+    Per post in one transaction: the Posts row is upserted, sentences with a new hash are
+    encoded and inserted, Embeddings rows whose hash is gone are deleted. Posts that turned
+    private or into regrade requests lose their Posts and Embeddings rows; posts that can not
+    be fetched keep their old rows.
+    """
+
+    def __init__(self, network, SQL: PGQ, sentence_encoder: SentenceBatchEncoder, semester_id: int,
+                 post_ids: Iterable[int], updates: Dict[int, str], **kwargs):
+        super().__init__(network, SQL, sentence_encoder, semester_id, post_ids, updates=updates, **kwargs)
+        self.stored = storedPostHashes(SQL, semester_id, self.post_ids)
+        self.stats.update({'unchanged': 0, 'sentences_added': 0, 'sentences_removed': 0, 'removed': 0})
+
+    def _changed(self, post: tuple) -> bool:
+        stored = self.stored.get(post[1])
+        return stored is None or stored[0] != contentHash(*post[2:])
+
+    def _embed(self, posts: List[tuple]) -> List[tuple]:
+        known = {post_id: sentence_hashes for post_id, (_, sentence_hashes) in self.stored.items()}
+        return embeddingRows(self.sentence_encoder, [post for post in posts if self._changed(post)], known)
+
+    def _write(self, posts: List[tuple], embeddings: List[tuple], checkpoints: List[Tuple[int, str]]):
+        semester_id = PGQ.toInt(self.semester_id)
+        changed = [post for post in posts if self._changed(post)]
+        unchanged = [post for post in posts if not self._changed(post)]
+
+        if posts:
+            # Unchanged posts only get their feed timestamp moved forward
+            self.SQL.insert_rows('Posts', POSTS_LOAD_COLUMNS, self._post_rows(posts), on_conflict=(
+                'ON CONFLICT (semester_id, post_id) DO UPDATE SET '
+                + ', '.join(f'{column} = EXCLUDED.{column}' for column in POSTS_LOAD_COLUMNS[2:])
+            ))
+
+        removed_sentences = 0
+        for post in changed:
+            keep = {sentence_hash for sentence_hash, _ in postSentenceHashes(post)}
+            gone = self.stored.get(post[1], (None, set()))[1] - keep
+            # Rows loaded before sentence hashes existed can not be matched and are replaced
+            self.SQL.DELETE_FROM('Embeddings').WHERE(f'semester_id = {semester_id}').AND(
+                f'post_id = {PGQ.toInt(post[1])}'
+            ).AND(
+                f"(sentence_hash IS NULL OR sentence_hash NOT IN ({', '.join(PGQ.toString(h) for h in keep) or 'NULL'}))"
+            ).execute_nofetch(raise_errors=True)
+            removed_sentences += len(gone)
+        if embeddings:
+            self.SQL.copy_rows('Embeddings', EMBEDDINGS_INSERT_COLUMNS, embeddings)
+
+        removed = [post_id for post_id, status in checkpoints if status == CHECKPOINT_SKIPPED and post_id in self.stored]
+        if removed:
+            for table in ('Embeddings', 'Posts'):
+                self.SQL.DELETE_FROM(table).WHERE(f'semester_id = {semester_id}').AND(
+                    f"post_id IN ({', '.join(PGQ.toInt(post_id) for post_id in removed)})"
+                ).execute_nofetch(raise_errors=True)
+        if posts or removed:
+            bumpDataVersion(self.SQL)
+
+        # A failed refetch must not mark an already loaded post as failed
+        self._write_checkpoints([(post_id, status) for post_id, status in checkpoints if status != CHECKPOINT_FAILED])
+
+        self._count('unchanged', len(unchanged))
+        self._count('sentences_added', len(embeddings))
+        self._count('sentences_removed', removed_sentences)
+        self._count('removed', len(removed))
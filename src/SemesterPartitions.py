@@ -0,0 +1,297 @@
+import sys
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from VectorIndex import create_vector_index, execute_maintenance
+from ScrapePipeline import bumpDataVersion
+
+'''
+Embeddings partitioned by semester, and the live view of the Semesters table.
+
+Embeddings is declared PARTITION BY LIST (semester_id) with one partition per semester,
+embeddings_s<semester_id>. The vector index and the (semester_id, post_id) index are
+created on the parent, so Postgres builds a separate copy on every partition, including
+the ones created later. A search scoped to some semesters (semester_id = ANY(...)) is
+pruned to their partitions, at run time for prepared statements, and walks only their
+indexes; an unscoped search merges the per-partition index scans.
+
+Retiring a semester is a catalog change instead of a DELETE over the whole table:
+detaching its partition takes it out of every search (its Posts rows stay, but have no
+embeddings to match), attaching puts it back, dropping the detached table frees the space.
+
+    python SemesterPartitions.py show
+    python SemesterPartitions.py detach <semester_id>
+    python SemesterPartitions.py attach <semester_id>
+    python SemesterPartitions.py drop <semester_id>
+
+Indexes on a partitioned table can not be built CONCURRENTLY, so creating the parent
+vector index blocks writes to Embeddings while it builds.
+'''
+
+EMBEDDINGS_TABLE = 'Embeddings'
+PARTITION_KEY = 'semester_id'
+# Name the flat table is renamed to while its rows are copied into the partitions
+UNPARTITIONED_TABLE = 'embeddings_unpartitioned'
+EMBEDDINGS_COPY_COLUMNS = ['id', 'embedding', 'semester_id', 'post_id', 'sentence_hash']
+
+SEMESTERS_POLL_SECONDS = 60
+# Names the search responses used for the first semesters before they came from
+# Semesters.semester_name; name_legacy_semesters() writes them into the table
+LEGACY_SEMESTER_NAMES = {
+    1: "Fall 2023",
+    3: "Spring 2023",
+    4: "Spring 2024",
+}
+# Accepted in a search's semester filter for the most recently added semester
+CURRENT_SEMESTER = 'current'
+
+
+def partition_name(semester_id: int) -> str:
+    return f'embeddings_s{int(semester_id)}'
+
+
+def embeddings_partitioned(SQL: PGQ, table_name: str = EMBEDDINGS_TABLE) -> bool:
+    return bool(SQL.SELECT(['1']).FROM(['pg_partitioned_table']).WHERE(
+        'partrelid = to_regclass(%s)', [table_name.lower()]
+    ).execute_fetch())
+
+
+def list_partitions(SQL: PGQ, table_name: str = EMBEDDINGS_TABLE) -> List[Tuple[str, str, int]]:
+    """
+    Returns:
+        (partition name, partition bound, estimated rows) of each attached partition.
+    """
+    return [tuple(row) for row in SQL.SELECT([
+        'c.relname',
+        'pg_get_expr(c.relpartbound, c.oid)',
+        'c.reltuples::bigint'
+    ]).FROM([
+        'pg_inherits AS i',
+        'pg_class AS c'
+    ]).WHERE(
+        'i.inhrelid = c.oid'
+    ).AND(
+        'i.inhparent = to_regclass(%s)', [table_name.lower()]
+    ).ORDER_BY([
+        'c.relname'
+    ]).execute_fetch()]
+
+
+def create_semester_partition(SQL: PGQ, semester_id: int, table_name: str = EMBEDDINGS_TABLE):
+    """
+    Creates the partition of a semester if it does not exist yet. Its indexes come
+    from the parent's. Runs in the current transaction.
+    """
+    SQL.CREATE_PARTITION(
+        partition_name(semester_id), table_name, [PGQ.toInt(int(semester_id))], if_not_exists=True
+    ).execute_nofetch(raise_errors=True)
+
+
+def migrate_embeddings(SQL: PGQ, columns: List[str], method: str = 'hnsw', options: Dict[str, object] = None):
+    """
+    Turns a flat Embeddings table into the partitioned one, in one transaction:
+    the old table is renamed, every Semesters row gets a partition, the rows are copied
+    over (ids and the id sequence are kept) and the indexes are built once the data is in.
+    Args:
+        columns: column definitions of the partitioned table; the primary key must include semester_id.
+        method, options: vector index, see VectorIndex.create_vector_index.
+    """
+    if embeddings_partitioned(SQL):
+        return
+
+    autocommit = SQL.connection.autocommit
+    SQL.connection.autocommit = False
+    try:
+        SQL.ALTER_TABLE(EMBEDDINGS_TABLE).RENAME_TO(UNPARTITIONED_TABLE).execute_nofetch(raise_errors=True)
+        # Renaming a table keeps the names of its sequence and indexes, and those names are per
+        # schema: free them for the new table (ALTER TABLE ... RENAME TO accepts any relation)
+        for relation in ('embeddings_id_seq', 'embeddings_pkey'):
+            SQL.ALTER_TABLE(relation).RENAME_TO(relation.replace('embeddings', UNPARTITIONED_TABLE, 1)).execute_nofetch(raise_errors=True)
+        for index_name in ('embeddings_embedding_idx', 'embeddings_post_idx'):
+            SQL.DROP_INDEX().IF_EXISTS(index_name).execute_nofetch(raise_errors=True)
+
+        SQL.CREATE_TABLE(EMBEDDINGS_TABLE, columns).PARTITION_BY('LIST', [PARTITION_KEY]).execute_nofetch(raise_errors=True)
+        for (semester_id,) in SQL.SELECT(['semester_id']).FROM(['Semesters']).execute_fetch():
+            create_semester_partition(SQL, semester_id)
+
+        SQL.INSERT_INTO(EMBEDDINGS_TABLE, EMBEDDINGS_COPY_COLUMNS).SELECT(
+            EMBEDDINGS_COPY_COLUMNS
+        ).FROM(
+            [UNPARTITIONED_TABLE]
+        ).execute_nofetch(raise_errors=True)
+        SQL.SELECT([
+            f"setval(pg_get_serial_sequence('{EMBEDDINGS_TABLE.lower()}', 'id'), COALESCE(MAX(id), 0) + 1, false)"
+        ]).FROM([EMBEDDINGS_TABLE]).execute_fetch()
+        SQL.DROP_TABLE([UNPARTITIONED_TABLE]).execute_nofetch(raise_errors=True)
+
+        SQL.CREATE_INDEX('embeddings_post_idx', EMBEDDINGS_TABLE, ['semester_id', 'post_id']).execute_nofetch(raise_errors=True)
+        # Commits the migration
+        create_vector_index(SQL, method, options)
+        print(f"Partitioned {EMBEDDINGS_TABLE}: {len(list_partitions(SQL))} semesters")
+    except Exception:
+        SQL.rollback()
+        raise
+    finally:
+        SQL.connection.autocommit = autocommit
+
+
+def detach_semester(SQL: PGQ, semester_id: int, concurrently: bool = True, drop: bool = False):
+    """
+    Takes a semester out of the search by detaching its partition; with drop=True the
+    detached table is dropped as well. CONCURRENTLY only waits for running queries
+    instead of locking the whole of Embeddings.
+    """
+    name = partition_name(semester_id)
+    SQL.ALTER_TABLE(EMBEDDINGS_TABLE).DETACH_PARTITION(name, concurrently=concurrently)
+    execute_maintenance(SQL, concurrently)
+    bumpDataVersion(SQL)
+    if drop:
+        SQL.DROP_TABLE([name]).execute_nofetch(raise_errors=True)
+    SQL.commit()
+
+
+def attach_semester(SQL: PGQ, semester_id: int):
+    """
+    Puts a detached semester back. Postgres scans the partition once to check its rows.
+    """
+    SQL.ALTER_TABLE(EMBEDDINGS_TABLE).ATTACH_PARTITION(
+        partition_name(semester_id), [PGQ.toInt(int(semester_id))]
+    ).execute_nofetch(raise_errors=True)
+    bumpDataVersion(SQL)
+    SQL.commit()
+
+
+def name_legacy_semesters(SQL: PGQ):
+    """
+    Sets semester_name of the semesters in LEGACY_SEMESTER_NAMES, so responses keep
+    naming them as they did. Safe to run on every deploy: ids that do not exist or
+    already have their name are left alone, and the data version only moves on a rename.
+    """
+    renamed = []
+    for semester_id, name in LEGACY_SEMESTER_NAMES.items():
+        renamed += SQL.UPDATE('Semesters').SET(['semester_name = %s'], [name]).WHERE(
+            f'semester_id = {PGQ.toInt(semester_id)}'
+        ).AND(
+            'semester_name IS DISTINCT FROM %s', [name]
+        ).RETURNING(
+            ['semester_id']
+        ).execute_fetch(raise_errors=True)
+    if renamed:
+        # Cached responses carry the old names
+        bumpDataVersion(SQL)
+    SQL.commit()
+
+
+def read_semesters(SQL: PGQ) -> List[Tuple[int, str, str]]:
+    """
+    Returns:
+        (semester_id, semester_name, semester_piazza_code) of every semester.
+    """
+    return [tuple(row) for row in SQL.SELECT([
+        'semester_id',
+        'semester_name',
+        'semester_piazza_code'
+    ]).FROM([
+        'Semesters'
+    ]).ORDER_BY([
+        'semester_id'
+    ]).execute_fetch()]
+
+
+class SemesterDirectory:
+    """
+    The Semesters table, re-read every interval on a daemon thread, so the search
+    names semesters and resolves semester filters without a query per request.
+
+        directory.name(4)                                   # semester_name, or '4' if unknown
+        directory.resolve(['Spring 2024', 3, 'current'])    # (3, 4)
+    """
+
+    def __init__(self):
+        self.semesters = {}
+        self._thread = None
+
+    def poll(self, read_semesters: Callable[[], List[Tuple[int, str, str]]]):
+        try:
+            self.semesters = {int(row[0]): (row[1], row[2]) for row in read_semesters()}
+        except Exception as e:
+            # The last good copy keeps serving
+            print(e)
+
+    def start(self, read_semesters: Callable[[], List[Tuple[int, str, str]]], interval: float = SEMESTERS_POLL_SECONDS):
+        if self._thread is not None:
+            return
+
+        # The first read is synchronous, so a server that starts answering already has the names
+        self.poll(read_semesters)
+
+        def poll_forever():
+            while True:
+                time.sleep(interval)
+                self.poll(read_semesters)
+
+        self._thread = threading.Thread(target=poll_forever, name='semesters', daemon=True)
+        self._thread.start()
+
+    def name(self, semester_id: int) -> str:
+        name, _ = self.semesters.get(semester_id, (None, None))
+        return name if name else str(semester_id)
+
+    def resolve(self, selection) -> Optional[Tuple[int, ...]]:
+        """
+        Resolves a search's semester filter: one or a list of semester ids, semester
+        names, Piazza codes or CURRENT_SEMESTER (the highest semester_id).
+        Returns:
+            Sorted semester ids, None for an empty selection (search every semester).
+        Raises:
+            ValueError: a name or code matches no semester.
+        """
+        if not isinstance(selection, (list, tuple)):
+            selection = [selection]
+
+        by_label = {}
+        for semester_id, (name, code) in self.semesters.items():
+            for label in (name, code):
+                if label:
+                    by_label[label.lower()] = semester_id
+
+        semester_ids = set()
+        for item in selection:
+            if isinstance(item, int) and not isinstance(item, bool):
+                semester_ids.add(item)
+            elif isinstance(item, str) and item.strip().isdigit():
+                semester_ids.add(int(item))
+            elif isinstance(item, str) and item.lower() == CURRENT_SEMESTER and self.semesters:
+                semester_ids.add(max(self.semesters))
+            elif isinstance(item, str) and item.strip().lower() in by_label:
+                semester_ids.add(by_label[item.strip().lower()])
+            else:
+                raise ValueError(f"Unknown semester: {item!r}")
+        return tuple(sorted(semester_ids)) or None
+
+
+if __name__ == "__main__":
+    from WebServer import POSTGRES_LOGIN
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    SQL = PGQ()
+    SQL.login(POSTGRES_LOGIN)
+
+    if not embeddings_partitioned(SQL):
+        print(f"{EMBEDDINGS_TABLE} is not partitioned, see scrapeAndDeploy.PARTITION_EMBEDDINGS")
+        sys.exit(1)
+
+    if command == 'detach':
+        detach_semester(SQL, int(sys.argv[2]))
+    elif command == 'attach':
+        attach_semester(SQL, int(sys.argv[2]))
+    elif command == 'drop':
+        detach_semester(SQL, int(sys.argv[2]), drop=True)
+    elif command != 'show':
+        print(f"Unknown command: {command}")
+        sys.exit(1)
+
+    for name, bound, rows in list_partitions(SQL):
+        print(f"{name:>20}  {bound}  ~{rows} rows")
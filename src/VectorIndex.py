@@ -0,0 +1,162 @@
+import sys
+import math
+from typing import Dict
+
+from PostGresQueryGenerator import PGQuery as PGQ
+
+'''
+Lifecycle of the pgvector ANN index on Embeddings.embedding.
+
+The search query orders by `embedding <=> q` (cosine distance), so the index is built
+with vector_cosine_ops. HNSW gives the best recall/latency trade-off and can be built
+on an empty table. IVFFlat builds faster and smaller but should be created after the
+data is loaded, since its lists are trained on the rows present at build time.
+
+    python VectorIndex.py create hnsw
+    python VectorIndex.py create ivfflat
+    python VectorIndex.py rebuild
+    python VectorIndex.py drop
+    python VectorIndex.py show
+'''
+
+VECTOR_INDEX_NAME = 'embeddings_embedding_idx'
+VECTOR_TABLE = 'Embeddings'
+VECTOR_COLUMN = 'embedding'
+VECTOR_OPCLASS = 'vector_cosine_ops'
+
+INDEX_METHODS = ('hnsw', 'ivfflat')
+HNSW_BUILD_OPTIONS = {'m': 16, 'ef_construction': 64}
+
+# Query-time knobs, applied per transaction with SET LOCAL
+HNSW_EF_SEARCH = 100
+IVFFLAT_PROBES = 10
+MAX_EF_SEARCH = 1000
+MAX_PROBES = 1000
+
+
+def recommended_ivfflat_lists(row_count: int) -> int:
+    """
+    pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) above that.
+    """
+    if row_count <= 1_000_000:
+        return max(1, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+def count_embeddings(SQL: PGQ, table_name: str = VECTOR_TABLE) -> int:
+    return SQL.SELECT(['COUNT(*)']).FROM([table_name]).execute_fetch(raise_errors=True)[0][0]
+
+
+def create_vector_index(SQL: PGQ, method: str = 'hnsw', options: Dict[str, object] = None,
+                        concurrently: bool = False, index_name: str = VECTOR_INDEX_NAME,
+                        table_name: str = VECTOR_TABLE, column: str = VECTOR_COLUMN, opclass: str = VECTOR_OPCLASS):
+    """
+    Creates the ANN index on the embedding column.
+    Args:
+        method: 'hnsw' or 'ivfflat'.
+        options: storage parameters, defaults to HNSW_BUILD_OPTIONS or a lists value sized to the table.
+        concurrently: build without blocking writes (runs outside a transaction).
+        column, opclass: another vector column and its distance, e.g. a CompactVectors column.
+    """
+    if method not in INDEX_METHODS:
+        raise ValueError(f"Unknown vector index method: {method}")
+
+    if options is None:
+        if method == 'hnsw':
+            options = HNSW_BUILD_OPTIONS
+        else:
+            options = {'lists': recommended_ivfflat_lists(count_embeddings(SQL, table_name))}
+
+    SQL.CREATE_INDEX(
+        index_name, table_name, [f'{column} {opclass}'], using=method, concurrently=concurrently
+    ).STORAGE_PARAMETERS(options)
+    execute_maintenance(SQL, concurrently)
+
+
+def drop_vector_index(SQL: PGQ, concurrently: bool = False, index_name: str = VECTOR_INDEX_NAME):
+    SQL.DROP_INDEX(concurrently=concurrently).IF_EXISTS(index_name)
+    execute_maintenance(SQL, concurrently)
+
+
+def rebuild_vector_index(SQL: PGQ, method: str = None, options: Dict[str, object] = None,
+                         concurrently: bool = True, index_name: str = VECTOR_INDEX_NAME,
+                         table_name: str = VECTOR_TABLE):
+    """
+    Rebuilds the index in place, or swaps it for a different method / options.
+    A plain REINDEX keeps the existing method and parameters; IVFFlat lists are
+    retrained on the current rows either way.
+    """
+    if method is None and options is None:
+        SQL.REINDEX_INDEX(index_name, concurrently=concurrently)
+        execute_maintenance(SQL, concurrently)
+        return
+
+    drop_vector_index(SQL, concurrently=concurrently, index_name=index_name)
+    create_vector_index(SQL, method or 'hnsw', options, concurrently=concurrently,
+                        index_name=index_name, table_name=table_name)
+
+
+def describe_vector_index(SQL: PGQ, index_name: str = VECTOR_INDEX_NAME):
+    """
+    Returns the CREATE INDEX statement of the index, or None if it does not exist.
+    """
+    rows = SQL.SELECT(['indexdef']).FROM(['pg_indexes']).WHERE(
+        f'indexname = {PGQ.toString(index_name.lower())}'
+    ).execute_fetch()
+    return rows[0][0] if rows else None
+
+
+def set_search_parameters(SQL: PGQ, ef_search: int = None, probes: int = None):
+    """
+    Sets the ANN search breadth for the current transaction only.
+    ef_search should be at least the LIMIT of the nearest-neighbour query,
+    otherwise HNSW returns fewer rows than asked for.
+    """
+    for setting, value in search_settings(ef_search, probes).items():
+        SQL.SET_LOCAL(setting, PGQ.toInt(value)).execute_nofetch()
+
+
+def search_settings(ef_search: int = None, probes: int = None) -> Dict[str, int]:
+    """
+    The clamped SET LOCAL values for a search, defaults filled in.
+    """
+    ef_search = HNSW_EF_SEARCH if ef_search is None else ef_search
+    probes = IVFFLAT_PROBES if probes is None else probes
+    return {
+        'hnsw.ef_search'    : max(1, min(int(ef_search), MAX_EF_SEARCH)),
+        'ivfflat.probes'    : max(1, min(int(probes), MAX_PROBES)),
+    }
+
+
+def execute_maintenance(SQL: PGQ, concurrently: bool):
+    # CONCURRENTLY variants refuse to run inside a transaction block
+    if concurrently and not SQL.connection.autocommit:
+        SQL.toggleAutoCommit()
+        SQL.execute_nofetch()
+        SQL.toggleAutoCommit()
+    else:
+        SQL.execute_nofetch()
+        SQL.commit()
+
+
+if __name__ == "__main__":
+    from WebServer import POSTGRES_LOGIN
+    from SemesterPartitions import embeddings_partitioned
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    SQL = PGQ()
+    SQL.login(POSTGRES_LOGIN)
+    # Postgres can not build or drop the index of a partitioned table CONCURRENTLY
+    concurrently = not embeddings_partitioned(SQL)
+
+    if command == 'create':
+        create_vector_index(SQL, sys.argv[2] if len(sys.argv) > 2 else 'hnsw', concurrently=concurrently)
+    elif command == 'rebuild':
+        rebuild_vector_index(SQL, sys.argv[2] if len(sys.argv) > 2 else None, concurrently=concurrently)
+    elif command == 'drop':
+        drop_vector_index(SQL, concurrently=concurrently)
+    elif command != 'show':
+        print(f"Unknown command: {command}")
+        sys.exit(1)
+
+    print(describe_vector_index(SQL))
@@ -1,19 +1,61 @@
 import os
+import sys
 import json
+import time
 import numpy as np
 import http.server
-import requests
 import threading
 import socketserver
+from typing import List
 from collections import defaultdict
-from PostGresQueryGenerator import PGQuery as PGQ
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from ModelLoading import ModelLoader, ModelNotReadyError, StartupPhases
+from PreforkServing import PreforkSupervisor
+import PostGresQueryGenerator
+from PostGresQueryGenerator import PGQuery as PGQ, PGConnectionPool, PoolTimeoutError, enable_instrumentation
+from ConcurrentServing import BoundedExecutor, QueueFullError
+from MicroBatching import InferenceBatcher
+from EmbeddingCache import EmbeddingCache, normalize_query
+from ResponseCache import ResponseCache, DataVersionPoller
+from ScrapePipeline import readDataVersion
+from VectorIndex import set_search_parameters, HNSW_EF_SEARCH
+from LocalVectorIndex import LocalVectorIndex
+from HybridSearch import hybrid_search
+from SemesterPartitions import SemesterDirectory, read_semesters
+from CompactVectors import coarse_candidates
+from Metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, LATENCY_BUCKETS, stage_timer
+# torch, transformers and sentence_transformers are imported by the model loaders,
+# so that the socket can bind before they are
 
 ########## SERVING CONFIGURATIONS ##########
 PORT = 8000
 DEFAULT_IP = '0.0.0.0'
 
+# 'serial' serves one connection at a time (the original behaviour),
+# 'threaded' hands connections to a bounded I/O pool and model calls to a bounded inference queue
+SERVING_MODE = 'threaded'
+IO_POOL_WORKERS = 16
+IO_POOL_QUEUE = 64
+INFERENCE_WORKERS = 1
+INFERENCE_QUEUE = 32
+RETRY_AFTER_SECONDS = 2
+LISTEN_BACKLOG = 128
+
+# PREFORK_WORKERS > 0 runs that many worker processes on one listening socket
+# (os.cpu_count() for one per core), each serving in SERVING_MODE.
+# PREFORK_PRELOAD loads the models once in the supervisor before forking, so the
+# workers share the weights copy-on-write instead of loading their own copies.
+PREFORK_WORKERS = 0
+PREFORK_PRELOAD = True
+# Intra-op threads per worker: the workers already use the cores
+PREFORK_TORCH_THREADS = 1
+
+# 'background' binds the socket first and loads the models on parallel threads,
+# requests for a model still loading get NOT_READY_RESPONSE (503).
+# 'blocking' loads everything before binding, like before.
+STARTUP_MODE = 'background'
+startup_phases = StartupPhases()
+model_loader = ModelLoader(startup_phases)
+
 
 ########## DEFAULT RESPONSES ##########
 PING_REQUEST = {
@@ -22,6 +64,36 @@ PING_REQUEST = {
 BAD_REQUEST = {
     "message": "Bad Request"
 }
+BUSY_RESPONSE = {
+    "message": "Server busy, retry later"
+}
+NOT_READY_RESPONSE = {
+    "message": "Model loading, retry later"
+}
+
+
+class BadRequestError(ValueError):
+    """
+    A request body the endpoint cannot serve; answered with a 400 before any work is queued.
+    """
+
+########## REQUEST METRICS ##########
+# Every request is timed as http_request_seconds{method, endpoint, status}, and the stages of the
+# two resources as request_stage_seconds{endpoint, stage}: json_parse, tokenization, model_forward,
+# query_encoding, db_checkout, sql_execution, row_shaping and serialization.
+# GET /metrics serves the registry in the Prometheus text format, GET /stats as JSON.
+ARXIV_ENDPOINT = "arxivClassification"
+PIAZZA_ENDPOINT = '360PiazzaDatabase'
+METRICS_PATH = '/metrics'
+# Endpoint label of the GET paths; any other path is a ping
+GET_ENDPOINTS = {
+    '/stats'        : 'stats',
+    '/ready'        : 'ready',
+    '/debug/queries': 'debug_queries',
+    METRICS_PATH    : 'metrics',
+}
+arxiv_stages = stage_timer(ARXIV_ENDPOINT)
+piazza_stages = stage_timer(PIAZZA_ENDPOINT)
 
 ################# MODEL AND TOKENIZER #################
 ################# ARXIV CLASSIFICATION ################    
@@ -29,8 +101,36 @@ arxiv_classif_model = None
 arxiv_classif_tokenizer = None
 
 NUM_LABELS = 11
+
+# Classifier runtime: 'eager' (fp32), 'int8' (dynamic quantization), 'torchscript' or 'onnx'.
+# A non-eager runtime is compared with fp32 at start-up and replaced by eager if it
+# drifts past ModelRuntime's tolerances. bench_model_runtime.py compares them.
+MODEL_RUNTIME = 'eager'
+MODEL_RUNTIME_THREADS = None
+MODEL_RUNTIME_ACCURACY_CHECK = True
+
+# Inputs are padded per length bucket instead of to 512. Longer inputs are truncated, or
+# with 'chunk' split into overlapping 512-token windows whose logits are averaged.
+# ARXIV_TOKEN_BUDGET caps the tokens read from one request, ARXIV_MAX_BATCH_TOKENS the
+# padded tokens of one forward pass.
+ARXIV_MAX_LENGTH = 512
+ARXIV_LONG_INPUTS = 'truncate'
+ARXIV_TOKEN_BUDGET = 2048
+ARXIV_MAX_BATCH_TOKENS = 8192
+arxiv_classifier = None
+
+# Concurrent classification requests are padded together into one forward pass.
+# A batch runs once ARXIV_MAX_BATCH_SIZE requests are waiting or ARXIV_MAX_WAIT_MS
+# after the first one arrived, whichever comes first.
+ARXIV_BATCHING = True
+ARXIV_MAX_BATCH_SIZE = 16
+ARXIV_MAX_WAIT_MS = 10
+ARXIV_BATCH_QUEUE = 128
+arxiv_batcher = None
 PRED_MODEL_NAME = os.getcwd() + "/ArxivClassificationModel/"
 TOKENIZER_NAME = os.getcwd() + "/ArxivClassificationTokenizer/"
+# Written by download_models.py; memory-mapped at start-up when present
+ARXIV_STATE_DICT_PATH = PRED_MODEL_NAME + "state_dict.pt"
 
 
 ################ LABELS AND DESCRIPTIONS ################
@@ -54,6 +154,30 @@ LABEL_DESCRIPTIONS = [
 ############## TOKENIZER AND SQL CONNECTION ##############
 ############## 360 PIAZZA DATABASE #######################
 piazza_db_tokenizer = None
+SENTENCE_MODEL_NAME = 'bert-base-nli-mean-tokens'
+# Local copy saved by download_models.py, used instead of resolving the name through the hub cache
+SENTENCE_MODEL_PATH = os.getcwd() + "/PiazzaSentenceModel/"
+
+# Query embeddings are cached on normalised query text, misses that arrive together
+# are encoded in one batched SentenceTransformer.encode call
+QUERY_CACHE = True
+QUERY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+QUERY_CACHE_TTL_SECONDS = 6 * 3600
+QUERY_ENCODE_MAX_BATCH_SIZE = 32
+QUERY_ENCODE_MAX_WAIT_MS = 5
+# Search queries are short; longer ones are truncated to bound the encoding cost
+QUERY_MAX_SEQ_LENGTH = 128
+query_embedding_cache = None
+
+# Whole 360PiazzaDatabase responses (JSON bytes) cached on normalised query and search options.
+# Ingestion bumps DataVersion, which is polled every DATA_VERSION_POLL_SECONDS; a new
+# version drops every entry. Without a readable version nothing is cached.
+RESPONSE_CACHE = True
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600
+DATA_VERSION_POLL_SECONDS = 5
+response_cache = None
+data_version = None
 POSTGRES_LOGIN = {
     'port'      : '5432',
     'user'      : 'kannah',
@@ -61,16 +185,96 @@ POSTGRES_LOGIN = {
     'host'      : 'localhost',
     'dbname'    : 'piazzapostdata',
 }
-################# SEMESTERID TRANSLATIONS #################
-SEMESTERID_TRANSLATIONS = {
-    1: "Fall 2023",
-    3: "Spring 2023",
-    4: "Spring 2024",
-}
+# Search handlers borrow connections from one shared pool instead of logging in per request
+PG_POOL_MIN_SIZE = 1
+PG_POOL_MAX_SIZE = IO_POOL_WORKERS
+PG_POOL_MAX_IDLE_SECONDS = 300
+piazza_db_pool = None
+piazza_db_pool_lock = threading.Lock()
+
+def get_piazza_db_pool() -> PGConnectionPool:
+    """
+    Returns the shared Postgres pool, creating it on first use so the server can
+    start while the database is still coming up.
+    """
+    global piazza_db_pool
+
+    with piazza_db_pool_lock:
+        if piazza_db_pool is None:
+            piazza_db_pool = PGConnectionPool(
+                POSTGRES_LOGIN,
+                min_size=PG_POOL_MIN_SIZE,
+                max_size=PG_POOL_MAX_SIZE,
+                max_idle_seconds=PG_POOL_MAX_IDLE_SECONDS,
+                name='web',
+            )
+        return piazza_db_pool
+# The search pulls the SEARCH_CANDIDATES nearest sentence embeddings through the
+# ANN index, then applies the similarity threshold and joins their posts
+SEARCH_CANDIDATES = 100
+SEARCH_RESULTS = 10
+COSINE_SIMILARITY_THRESHOLD = 0.749999
+# None searches the float32 index. 'halfvec' or 'binary' takes the QUANTIZED_RERANK_CANDIDATES
+# nearest rows by that compact column's index (CompactVectors) and reranks them on the full vectors
+VECTOR_QUANTIZATION = None
+QUANTIZED_RERANK_CANDIDATES = 400
+# Optional per-request ANN knobs accepted next to 'data' in the POST body
+SEARCH_OPTION_KEYS = ('ef_search', 'probes')
+# Optional semester filter next to 'data': a semester id, name or Piazza code, 'current',
+# or a list of them (SemesterDirectory.resolve). Without it every semester is searched.
+SEMESTER_FILTER_KEY = 'semesters'
+
+# Opt-in PGQuery timing: per-query-shape histograms and a slow-query log with
+# EXPLAIN (ANALYZE, BUFFERS) output, served at GET /debug/queries
+QUERY_INSTRUMENTATION = False
+SLOW_QUERY_SECONDS = 0.2
+EXPLAIN_SLOW_QUERIES = True
+
+# 'vector' ranks by embedding similarity only. 'hybrid' takes the best lexical matches
+# (Posts.search_vector), scores only their embeddings and fuses both rankings, falling back
+# to 'vector' for queries with fewer than HYBRID_MIN_LEXICAL_HITS matching posts.
+# Hybrid results obey the same similarity cut as the vector search
+PIAZZA_SEARCH_MODE = 'vector'
+HYBRID_LEXICAL_CANDIDATES = 200
+HYBRID_MIN_LEXICAL_HITS = 5
+HYBRID_MIN_SIMILARITY = COSINE_SIMILARITY_THRESHOLD
+
+# 'sql' searches with pgvector, 'local' keeps every embedding in an in-process matrix
+# (LocalVectorIndex) and only reads the matching Posts rows from Postgres
+PIAZZA_SEARCH_BACKEND = 'sql'
+LOCAL_INDEX_MMAP_PATH = None
+LOCAL_INDEX_REFRESH_SECONDS = 300
+local_vector_index = None
+
+################# SEMESTERS #################
+# Responses name semesters by Semesters.semester_name; the table is read before serving and
+# re-read every SEMESTERS_POLL_SECONDS. Semesters 1, 3 and 4 keep their original labels
+# (SemesterPartitions.LEGACY_SEMESTER_NAMES, written by scrapeAndDeploy)
+SEMESTERS_POLL_SECONDS = 60
+semester_directory = SemesterDirectory()
+
+############## INFERENCE QUEUE ##############
+# Set by make_server() in threaded mode, None means models run on the request thread
+inference_pool = None
+
+def run_inference(fn, *args):
+    """
+    Runs a model call on the bounded inference queue when one is configured.
+    Raises:
+        QueueFullError: the inference queue is full.
+    """
+    if inference_pool is None:
+        return fn(*args)
+    return inference_pool.run(fn, *args)
 
 ########## CUSTOM HANDLER ##########
 class SidHubHttpServer(http.server.SimpleHTTPRequestHandler):
 
+    def send_response(self, code, message=None):
+        # Kept for the request metrics
+        self.response_status = code
+        super().send_response(code, message)
+
     def make_good_response(self, data):
         """
         Sends a good response with the given data.
@@ -81,10 +285,45 @@ class SidHubHttpServer(http.server.SimpleHTTPRequestHandler):
         Returns:
         None
         """
+        self.make_json_response(json.dumps(data).encode('utf-8'))
+
+    def make_json_response(self, body: bytes, content_type: str = "application/json"):
+        """
+        Sends a good response whose JSON (or other content_type) is already serialized.
+        """
         self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def make_busy_response(self):
+        """
+        Sends a 503 asking the client to retry after RETRY_AFTER_SECONDS.
+        """
+        self.send_response(503)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.end_headers()
+        self.wfile.write(json.dumps(BUSY_RESPONSE).encode('utf-8'))
+
+    def make_bad_request_response(self):
+        """
+        Sends a 400 with the BAD_REQUEST body.
+        """
+        self.send_response(400)
         self.send_header("Content-type", "application/json")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(json.dumps(BAD_REQUEST).encode('utf-8'))
+
+    def make_not_ready_response(self, status: dict):
+        """
+        Sends a 503 readiness response with the loading state of every model.
+        """
+        self.send_response(503)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.end_headers()
+        self.wfile.write(json.dumps(dict(NOT_READY_RESPONSE, models=status)).encode('utf-8'))
 
     def handle_arxiv_classification(data: str) -> dict:
         """
@@ -95,123 +334,131 @@ class SidHubHttpServer(http.server.SimpleHTTPRequestHandler):
         Returns:
             None
         Raises:
-            None
+            ModelNotReadyError: the classifier is still loading.
+            BadRequestError: data is not a non-empty string.
         """
-        global arxiv_classif_tokenizer
-        global arxiv_classif_model
-        tokenized_pt_tensor = arxiv_classif_tokenizer(data, max_length=512, truncation=True, return_tensors="pt")
-        
-        # get the output from the model 
-        outputs = arxiv_classif_model(**tokenized_pt_tensor)
-
-        # get the prediction from the output of the model
-        prediction = np.argmax(outputs.logits.detach().numpy())
-        
+        validate_text(data)
+        model_loader.require('arxiv')
+        if arxiv_batcher is not None:
+            prediction = arxiv_batcher.run(data)
+        else:
+            prediction = run_inference(classify_arxiv, data)
+
         # Defining the data to be returned
         response_json = {"message": LABEL_DESCRIPTIONS[prediction]}
         return response_json
 
-    def handle_360_Piazza_Database(query: str) -> dict:
+    def handle_360_Piazza_Database(query: str, ef_search: int = None, probes: int = None, semesters: tuple = None) -> dict:
         """
         Handles the 360PiazzaDatabase request.
         Args:
             data: The input data to be processed.
+            ef_search: HNSW search breadth for this request, defaults to VectorIndex.HNSW_EF_SEARCH.
+            probes: IVFFlat lists probed for this request, defaults to VectorIndex.IVFFLAT_PROBES.
+            semesters: semester ids to search, every semester when None.
         Returns:
             List of dictionaries of piazza posts
         Raises:
-            None
+            ModelNotReadyError: the sentence encoder (or the local index) is still loading.
         """
-        global piazza_db_tokenizer
-        piazza_db_connection = PGQ()
-        piazza_db_connection.login(POSTGRES_LOGIN)
+        model_loader.require('piazza', *(['local_index'] if PIAZZA_SEARCH_BACKEND == 'local' else []))
+
         # Get the embeddings for the data
-        COSINE_SIMILARITY_THRESHOLD = 0.749999
-    
-        query_embedding = piazza_db_tokenizer.encode(query)
-        database_response = piazza_db_connection.WITH(
-            "SimilarityEmbeddings AS"
-        ).P(
-        ).SELECT([
-            'post_id',
-            'semester_id',
-            f'1 - (embedding <=> {PGQ.toVector(query_embedding)}) AS similarity'
-        ]).FROM([
-            'embeddings'
-        ]).EP(
-        ).SELECT([
-            "DISTINCT p.semester_id",
-            "p.post_id",
-            "p.post_title",
-            "p.post_content",
-            "p.instructor_answer",
-            "p.student_answer",
-            "se.similarity",
-        ]).FROM([
-            'SimilarityEmbeddings AS se'
-        ]).LEFT_JOIN(
-            'posts AS p'
-        ).ON(
-            'p.post_id = se.post_id'
-        ).AND(
-            'p.semester_id = se.semester_id'
-        ).WHERE(
-            f'se.similarity > {COSINE_SIMILARITY_THRESHOLD}'
-        ).ORDER_BY([
-            'se.similarity DESC'
-        ]).LIMIT(
-            10
-        ).execute_fetch()
-        response_json = list()
-        for row in database_response:
-            response_json.append({
-                'semester_id'       : SEMESTERID_TRANSLATIONS[row[0]],
-                'post_id'           : row[1],
-                'post_title'        : row[2],
-                'post_content'      : row[3],
-                'instructor_answer' : row[4],
-                'student_answer'    : row[5],
-                'similarity'        : row[6]
-        })
-        
-        return {'response' : response_json}
+        with piazza_stages.stage('query_encoding'):
+            if query_embedding_cache is not None:
+                query_embedding = query_embedding_cache.get(query)
+            else:
+                query_embedding = run_inference(piazza_db_tokenizer.encode, query)
+
+        checkout_start = time.perf_counter()
+        with get_piazza_db_pool().query() as piazza_db_connection:
+            piazza_stages.observe('db_checkout', time.perf_counter() - checkout_start)
+            # Includes the in-process part of the hybrid and local searches
+            with piazza_stages.stage('sql_execution'):
+                database_response = None
+                if PIAZZA_SEARCH_MODE == 'hybrid':
+                    database_response = query_similar_posts_hybrid(piazza_db_connection, query, query_embedding, semesters)
+                if database_response is None and local_vector_index is not None:
+                    database_response = query_similar_posts_local(piazza_db_connection, query_embedding, semesters)
+                elif database_response is None:
+                    database_response = query_similar_posts_sql(piazza_db_connection, query_embedding, ef_search, probes, semesters)
+        with piazza_stages.stage('row_shaping'):
+            return posts_response(database_response)
     
     def do_POST(self):
+        start = time.perf_counter()
+        endpoint = 'ping'
+        self.response_status = None
         try:
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
+            parse_start = time.perf_counter()
             data = json.loads(post_data.decode('utf-8'))
+            endpoint = request_endpoint(data)
+            stage_timer(endpoint).observe('json_parse', time.perf_counter() - parse_start)
             print("Recieved a request")
             if 'resource' in data:
-                if data['resource'] == "arxivClassification" and 'data' in data:
+                if data['resource'] == ARXIV_ENDPOINT and 'data' in data:
                     print("Requested for arxiv classification")
                     output_json = SidHubHttpServer.handle_arxiv_classification(data['data'])
-                    self.make_good_response(output_json)
+                    self.make_json_response(serialize(arxiv_stages, output_json))
                     return
                 
-                elif data['resource'] == '360PiazzaDatabase' and 'data' in data:
+                elif data['resource'] == PIAZZA_ENDPOINT and 'data' in data:
                     print("Requested for 360PiazzaDatabase")
-                    output_json = SidHubHttpServer.handle_360_Piazza_Database(data['data'])
-                    self.make_good_response(output_json)
+                    options = search_options(data)
+                    key, version, body = search_cache_lookup(data['data'], options)
+                    if body is None:
+                        output_json = SidHubHttpServer.handle_360_Piazza_Database(data['data'], **options)
+                        body = search_cache_store(key, version, output_json)
+                    self.make_json_response(body)
                     return
                 
             print("Recieved a request but not for implemented endpoint, returning PING_REQUEST")
             self.make_good_response(PING_REQUEST)
+        except (QueueFullError, PoolTimeoutError) as e:
+            print(e)
+            self.make_busy_response()
+        except ModelNotReadyError as e:
+            print(e)
+            self.make_not_ready_response(e.status)
+        except BadRequestError as e:
+            print(e)
+            self.make_bad_request_response()
         except Exception as e:
             print(e)
             self.make_good_response(BAD_REQUEST)
+        finally:
+            observe_request('POST', endpoint, self.response_status, time.perf_counter() - start)
 
     def do_GET(self):
         """
         Handles the GET request.
         This method is called when a GET request is received by the server. 
         It processes the request and generates a response.
-        Currently it only returns a PING_REQUEST response, available for future implementation.
+        /stats returns the metrics registry (batch sizes, queue times, ...),
+        /metrics the same registry in the Prometheus text format,
+        /debug/queries the query instrumentation when QUERY_INSTRUMENTATION is on,
+        /ready is 200 once every model is loaded and 503 before, with phase timings,
+        every other path returns a PING_REQUEST response.
         Parameters:
         - self: The instance of the WebServer class.
         Returns:
         - None
         """
-        self.make_good_response(PING_REQUEST)
+        start = time.perf_counter()
+        self.response_status = None
+        try:
+            if self.path == METRICS_PATH:
+                self.make_json_response(REGISTRY.prometheus_text().encode('utf-8'), PROMETHEUS_CONTENT_TYPE)
+                return
+            status, data = get_response(self.path)
+            if status == 503:
+                self.make_not_ready_response(data['models'])
+            else:
+                self.make_good_response(data)
+        finally:
+            observe_request('GET', GET_ENDPOINTS.get(self.path, 'ping'), self.response_status, time.perf_counter() - start)
 
     def do_CONNECT(self):
         """
@@ -230,60 +477,580 @@ class SidHubHttpServer(http.server.SimpleHTTPRequestHandler):
 
 
 class CustomHTTPServer(socketserver.TCPServer):
+    # socketserver's default backlog of 5 drops connection bursts (clients retry the SYN
+    # after a second), and pre-fork workers all accept from this one queue
+    request_queue_size = LISTEN_BACKLOG
+
     def __init__(self, server_address, RequestHandlerClass):
         super().__init__(server_address, RequestHandlerClass)
         # Set a custom socket timeout
         self.socket.settimeout(120)  # Set timeout to 60 seconds
 
 
-def start_up():
+class ThreadPoolHTTPServer(CustomHTTPServer):
+    """
+    Serves each connection on a bounded I/O pool so a slow database query or
+    model pass no longer blocks GET pings and other clients.
+    When the pool and its queue are full the connection gets an immediate 503.
+    """
+    def __init__(self, server_address, RequestHandlerClass, max_workers=IO_POOL_WORKERS, max_queue=IO_POOL_QUEUE):
+        super().__init__(server_address, RequestHandlerClass)
+        self.pool = BoundedExecutor(max_workers, max_queue, name='io')
+
+    def process_request(self, request, client_address):
+        try:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        except QueueFullError:
+            self.reject_request(request)
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_request(self, request):
+        body = json.dumps(BUSY_RESPONSE).encode('utf-8')
+        header = (
+            "HTTP/1.0 503 Service Unavailable\r\n"
+            "Content-Type: application/json\r\n"
+            f"Retry-After: {RETRY_AFTER_SECONDS}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        ).encode('latin-1')
+        try:
+            # Drain what the client already sent so closing does not reset the connection
+            request.settimeout(0.05)
+            request.recv(65536)
+        except OSError:
+            pass
+        try:
+            request.sendall(header + body)
+        except OSError:
+            pass
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def make_server(server_address, mode: str = SERVING_MODE):
+    """
+    Builds the HTTP server for the requested SERVING_MODE.
+    Threaded mode also sets up the bounded inference queue used by run_inference().
+    """
+    global inference_pool
+
+    if mode == 'serial':
+        inference_pool = None
+        return CustomHTTPServer(server_address, SidHubHttpServer)
+
+    if mode == 'threaded':
+        inference_pool = BoundedExecutor(INFERENCE_WORKERS, INFERENCE_QUEUE, name='inference')
+        return ThreadPoolHTTPServer(server_address, SidHubHttpServer)
+
+    raise ValueError(f"Unknown serving mode: {mode}")
+
+
+def get_response(path: str):
+    """
+    Answers a GET for either front end.
+    Returns:
+        (status code, JSON data); a 503 carries the model loading state under 'models'.
+    """
+    if path == '/stats':
+        return 200, REGISTRY.snapshot()
+    if path == '/ready':
+        status = {'models': model_loader.status(), 'startup_seconds': startup_phases.snapshot()}
+        if model_loader.all_ready():
+            return 200, dict(status, ready=True)
+        return 503, dict(NOT_READY_RESPONSE, **status)
+    if path == '/debug/queries':
+        instrumentation = PostGresQueryGenerator.QUERY_INSTRUMENTATION
+        return 200, instrumentation.snapshot() if instrumentation is not None else {'enabled': False}
+    return 200, PING_REQUEST
+
+
+def search_cache_lookup(query: str, options: dict):
+    """
+    Looks a search up in the response cache.
+    Returns:
+        (key, data version, cached JSON bytes or None). key is None when the cache is off
+        or the data version is unknown.
+    """
+    version = data_version.version if data_version is not None else None
+    if response_cache is None or version is None:
+        return None, None, None
+    key = (normalize_query(query),) + tuple(sorted(options.items()))
+    if local_vector_index is not None:
+        # The local index catches up with a new data version up to LOCAL_INDEX_REFRESH_SECONDS
+        # after the cache flush; results from the old rows must not be served once it has
+        key += (('local_index_version', local_vector_index.version),)
+    return key, version, response_cache.get(key, version)
+
+
+def search_cache_store(key, version, data: dict) -> bytes:
+    """
+    Serializes a search response and caches it under the version read before computing it.
+    """
+    body = serialize(piazza_stages, data)
+    if key is not None:
+        response_cache.put(key, version, body)
+    return body
+
+
+def request_endpoint(data: dict) -> str:
+    """
+    The endpoint label of a parsed POST body: its resource, or 'ping'.
+    """
+    resource = data.get('resource') if isinstance(data, dict) else None
+    if resource in (ARXIV_ENDPOINT, PIAZZA_ENDPOINT) and 'data' in data:
+        return resource
+    return 'ping'
+
+
+def validate_text(data) -> str:
+    """
+    Checks the 'data' of an arxiv request before it joins a batch: one malformed
+    item would otherwise fail the forward pass for every request batched with it.
+    Raises:
+        BadRequestError: data is not a non-empty string.
+    """
+    if not isinstance(data, str) or not data.strip():
+        raise BadRequestError(f"expected a non-empty string to classify, got {type(data).__name__}")
+    return data
+
+
+def observe_request(method: str, endpoint: str, status: int, seconds: float):
+    REGISTRY.histogram(
+        'http_request_seconds', 'Time from reading a request to sending its response', LATENCY_BUCKETS,
+        {'method': method, 'endpoint': endpoint, 'status': str(status)},
+    ).observe(seconds)
+
+
+def serialize(stages, data) -> bytes:
+    with stages.stage('serialization'):
+        return json.dumps(data).encode('utf-8')
+
+
+def read_data_version():
+    with get_piazza_db_pool().query() as SQL:
+        return readDataVersion(SQL)
+
+
+def read_semester_rows():
+    with get_piazza_db_pool().query() as SQL:
+        return read_semesters(SQL)
+
+
+def posts_response(rows) -> dict:
+    """
+    Formats search result rows as the 360PiazzaDatabase response.
+    """
+    response_json = list()
+    for row in rows:
+        response_json.append({
+            'semester_id'       : semester_directory.name(row[0]),
+            'post_id'           : row[1],
+            'post_title'        : row[2],
+            'post_content'      : row[3],
+            'instructor_answer' : row[4],
+            'student_answer'    : row[5],
+            'similarity'        : row[6]
+        })
+    return {'response' : response_json}
+
+
+def search_ef(ef_search: int = None) -> int:
+    # HNSW needs ef_search >= the candidate LIMIT to return that many rows
+    limit = SEARCH_CANDIDATES if VECTOR_QUANTIZATION is None else QUANTIZED_RERANK_CANDIDATES
+    return max(ef_search or HNSW_EF_SEARCH, limit)
+
+
+def query_similar_posts_sql(piazza_db_connection: PGQ, query_embedding, ef_search: int = None, probes: int = None,
+                            semester_ids: tuple = None) -> list:
+    """
+    Finds the posts closest to query_embedding with pgvector, in semester_ids when given.
+    Returns:
+        Rows of (semester_id, post_id, post_title, post_content, instructor_answer, student_answer, similarity).
+    """
+    set_search_parameters(piazza_db_connection, ef_search=search_ef(ef_search), probes=probes)
+    return similar_posts_query(piazza_db_connection, query_embedding, semester_ids).execute_fetch()
+
+
+def similar_posts_query(piazza_db_connection: PGQ, query_embedding, semester_ids: tuple = None) -> PGQ:
+    """
+    Builds, without running, the nearest posts query used by query_similar_posts_sql.
+    """
+    # Nearest-neighbour CTE: ORDER BY the raw distance so pgvector can walk the index,
+    # thresholding happens on the small candidate set afterwards.
+    # The vector is a bind parameter: the statement is prepared once per connection
+    # and the same object in SELECT and ORDER BY is sent only once.
+    piazza_db_connection.WITH(
+        "NearestEmbeddings AS"
+    ).P(
+    ).SELECT([
+        'post_id',
+        'semester_id',
+        '1 - (embedding <=> %s) AS similarity'
+    ], [query_embedding])
+    if VECTOR_QUANTIZATION is not None:
+        # The index walk happens on the compact vectors, the exact ORDER BY below only reranks its rows
+        coarse_candidates(piazza_db_connection.FROM([]), VECTOR_QUANTIZATION, query_embedding,
+                          QUANTIZED_RERANK_CANDIDATES, semester_ids)
+    else:
+        piazza_db_connection.FROM([
+            'embeddings'
+        ])
+        if semester_ids is not None:
+            # Prunes the scan to those semesters' partitions, each searched through its own index
+            piazza_db_connection.WHERE('semester_id = ANY(%s::int[])', [[int(semester_id) for semester_id in semester_ids]])
+    return piazza_db_connection.ORDER_BY([
+        'embedding <=> %s'
+    ], [query_embedding]).LIMIT(
+        SEARCH_CANDIDATES
+    ).EP(
+    ).SELECT([
+        "DISTINCT p.semester_id",
+        "p.post_id",
+        "p.post_title",
+        "p.post_content",
+        "p.instructor_answer",
+        "p.student_answer",
+        "ne.similarity",
+    ]).FROM([
+        'NearestEmbeddings AS ne'
+    ]).LEFT_JOIN(
+        'posts AS p'
+    ).ON(
+        'p.post_id = ne.post_id'
+    ).AND(
+        'p.semester_id = ne.semester_id'
+    ).WHERE(
+        f'ne.similarity > {COSINE_SIMILARITY_THRESHOLD}'
+    ).ORDER_BY([
+        'ne.similarity DESC'
+    ]).LIMIT(
+        SEARCH_RESULTS
+    )
+
+
+def query_similar_posts_local(piazza_db_connection: PGQ, query_embedding, semester_ids: tuple = None) -> list:
+    """
+    Finds the closest posts in the in-process LocalVectorIndex and only reads
+    the winning Posts rows from Postgres.
+    Returns:
+        Rows in the same shape as query_similar_posts_sql, one per post.
+    """
+    hits = local_vector_index.search(
+        query_embedding, k=SEARCH_RESULTS, threshold=COSINE_SIMILARITY_THRESHOLD, candidates=SEARCH_CANDIDATES,
+        semester_ids=semester_ids,
+    )
+    return fetch_posts(piazza_db_connection, hits)
+
+
+def query_similar_posts_hybrid(piazza_db_connection: PGQ, query: str, query_embedding, semester_ids: tuple = None):
+    """
+    Hybrid lexical + vector search (HybridSearch.hybrid_search).
+    Returns:
+        Rows in the same shape as query_similar_posts_sql, or None when the query has
+        too few lexical hits and the vector search should answer it.
+    """
+    hits = hybrid_search(
+        piazza_db_connection, query, query_embedding, SEARCH_RESULTS,
+        candidates=HYBRID_LEXICAL_CANDIDATES, min_lexical_hits=HYBRID_MIN_LEXICAL_HITS, min_similarity=HYBRID_MIN_SIMILARITY,
+        semester_ids=semester_ids,
+    )
+    REGISTRY.counter('piazza_search_total', 'Piazza searches by retrieval path',
+                     {'path': 'vector_fallback' if hits is None else 'hybrid'}).inc()
+    if hits is None:
+        return None
+    return fetch_posts(piazza_db_connection, hits)
+
+
+def fetch_posts(piazza_db_connection: PGQ, hits) -> list:
+    """
+    Reads the Posts rows of (semester_id, post_id, similarity) hits.
+    Returns:
+        Rows in the same shape as query_similar_posts_sql, in the order of hits.
+    """
+    if not hits:
+        return []
+
+    # Keys go in as two arrays so the statement text, and its prepared plan, is the same for any number of hits
+    posts = piazza_db_connection.SELECT([
+        'semester_id',
+        'post_id',
+        'post_title',
+        'post_content',
+        'instructor_answer',
+        'student_answer',
+    ]).FROM([
+        'posts'
+    ]).WHERE(
+        '(semester_id, post_id) IN (SELECT * FROM unnest(%s::int[], %s::int[]))',
+        [[int(semester_id) for semester_id, _, _ in hits], [int(post_id) for _, post_id, _ in hits]]
+    ).execute_fetch()
+
+    posts_by_key = {(row[0], row[1]): row for row in posts}
+    return [
+        tuple(posts_by_key[(semester_id, post_id)]) + (similarity,)
+        for semester_id, post_id, similarity in hits
+        if (semester_id, post_id) in posts_by_key
+    ]
+
+
+def load_local_vector_index():
+    """
+    Builds the LocalVectorIndex from the Embeddings table and starts a daemon thread
+    that brings it up to date every LOCAL_INDEX_REFRESH_SECONDS (new rows are appended,
+    deleted or replaced ones trigger a rebuild).
+    """
+    global local_vector_index
+
+    index = LocalVectorIndex(mmap_path=LOCAL_INDEX_MMAP_PATH)
+    with get_piazza_db_pool().query() as SQL:
+        loaded = index.refresh(SQL)
+    print(f"Loaded {loaded} embeddings into the local vector index")
+    local_vector_index = index
+
+    def refresh_forever():
+        while True:
+            time.sleep(LOCAL_INDEX_REFRESH_SECONDS)
+            try:
+                with get_piazza_db_pool().query() as SQL:
+                    loaded = local_vector_index.refresh(SQL)
+                if loaded:
+                    print(f"Refreshed the local vector index: {loaded} embeddings loaded, {local_vector_index.size} held")
+            except Exception as e:
+                print(e)
+
+    threading.Thread(target=refresh_forever, name='local-index-refresh', daemon=True).start()
+
+
+def search_options(data: dict) -> dict:
+    """
+    Picks the optional search knobs (SEARCH_OPTION_KEYS) and the semester filter out of
+    a request body. The filter is resolved to a tuple of semester ids, so it can be part
+    of the response cache key.
+    Raises:
+        BadRequestError: an option is present but not an integer, or names an unknown semester.
+    """
+    try:
+        options = {key: int(data[key]) for key in SEARCH_OPTION_KEYS if data.get(key) is not None}
+        if data.get(SEMESTER_FILTER_KEY) is not None:
+            semesters = semester_directory.resolve(data[SEMESTER_FILTER_KEY])
+            if semesters is not None:
+                options['semesters'] = semesters
+    except (TypeError, ValueError) as e:
+        raise BadRequestError(str(e)) from e
+    return options
+
+
+def classify_arxiv_batch(texts: List[str]) -> List[int]:
+    """
+    Runs the arxiv classifier on a list of texts.
+    Texts are grouped by length and each group is padded only to its own longest text.
+    Returns:
+        The predicted label index for each text, in order.
+    """
+    logits = arxiv_classifier.logits(texts)
+
+    # get the prediction for each row of the output of the model
+    return [int(i) for i in np.argmax(logits, axis=1)]
+
+
+def classify_arxiv(data: str) -> int:
+    """
+    Runs the arxiv classifier on a single text and returns the predicted label index.
+    """
+    return classify_arxiv_batch([data])[0]
+
+
+def encode_queries(queries: List[str]) -> List[np.ndarray]:
+    """
+    Encodes a batch of search queries with the sentence encoder in one call.
+    """
+    from AdaptiveTokenization import encode_sentences
+    return encode_sentences(piazza_db_tokenizer, queries)
+
+
+def start_batchers():
+    """
+    Starts the micro-batching workers for arxiv classification (ARXIV_BATCHING)
+    and for query embedding behind the query cache (QUERY_CACHE).
+    These threads replace the inference queue for the requests they serve.
+    """
+    global arxiv_batcher
+    global query_embedding_cache
+
+    if ARXIV_BATCHING and arxiv_batcher is None:
+        arxiv_batcher = InferenceBatcher(
+            lambda texts: classify_arxiv_batch(texts),
+            max_batch_size=ARXIV_MAX_BATCH_SIZE,
+            max_wait_ms=ARXIV_MAX_WAIT_MS,
+            max_queue=ARXIV_BATCH_QUEUE,
+            name='arxiv',
+        )
+
+    if QUERY_CACHE and query_embedding_cache is None:
+        query_embedding_cache = EmbeddingCache(
+            lambda queries: encode_queries(queries),
+            max_bytes=QUERY_CACHE_MAX_BYTES,
+            ttl_seconds=QUERY_CACHE_TTL_SECONDS,
+            max_batch_size=QUERY_ENCODE_MAX_BATCH_SIZE,
+            max_wait_ms=QUERY_ENCODE_MAX_WAIT_MS,
+            name='piazza_query',
+        )
+
+
+def load_arxiv_model():
     global arxiv_classif_model
     global arxiv_classif_tokenizer
+    global arxiv_classifier
+
+    from transformers import AutoTokenizer
+    from ModelRuntime import load_runtime, check_accuracy
+    from AdaptiveTokenization import AdaptiveClassifier
+
+    with startup_phases.phase('arxiv_tokenizer'):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, force_download=False)
+    with startup_phases.phase('arxiv_weights'):
+        model = load_runtime(MODEL_RUNTIME, PRED_MODEL_NAME, NUM_LABELS, tokenizer, threads=MODEL_RUNTIME_THREADS,
+                             state_dict_path=ARXIV_STATE_DICT_PATH)
+    if MODEL_RUNTIME != 'eager' and MODEL_RUNTIME_ACCURACY_CHECK:
+        with startup_phases.phase('arxiv_accuracy_check'):
+            reference = load_runtime('eager', PRED_MODEL_NAME, NUM_LABELS, tokenizer, state_dict_path=ARXIV_STATE_DICT_PATH)
+            accuracy = check_accuracy(reference, model, tokenizer)
+        print(f"{MODEL_RUNTIME} runtime vs fp32: {accuracy}")
+        if not accuracy['ok']:
+            print(f"{MODEL_RUNTIME} runtime is outside tolerance, falling back to eager")
+            model = reference
+
+    arxiv_classif_tokenizer = tokenizer
+    arxiv_classif_model = model
+    arxiv_classifier = AdaptiveClassifier(
+        arxiv_classif_tokenizer,
+        arxiv_classif_model.predict_logits,
+        max_length=ARXIV_MAX_LENGTH,
+        long_inputs=ARXIV_LONG_INPUTS,
+        token_budget=ARXIV_TOKEN_BUDGET,
+        max_batch_tokens=ARXIV_MAX_BATCH_TOKENS,
+        endpoint=ARXIV_ENDPOINT,
+    )
+
+
+def load_piazza_encoder():
     global piazza_db_tokenizer
 
-    arxiv_classif_model = AutoModelForSequenceClassification.from_pretrained(PRED_MODEL_NAME, num_labels=NUM_LABELS, force_download=False)
-    arxiv_classif_model.eval()
-    arxiv_classif_tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, force_download=False)
+    from sentence_transformers import SentenceTransformer
+
+    # Pull from the local copy if available, else from the cache / hub by name
+    encoder = SentenceTransformer(SENTENCE_MODEL_PATH if os.path.isdir(SENTENCE_MODEL_PATH) else SENTENCE_MODEL_NAME)
+    encoder.eval()
+    encoder.max_seq_length = QUERY_MAX_SEQ_LENGTH
+    piazza_db_tokenizer = encoder
+
+
+def register_models():
+    """
+    Registers the loaders this configuration needs, skipping any already registered,
+    e.g. models a pre-fork worker inherited from the supervisor.
+    """
+    loaders = {'arxiv': load_arxiv_model, 'piazza': load_piazza_encoder}
+    if PIAZZA_SEARCH_BACKEND == 'local':
+        loaders['local_index'] = load_local_vector_index
+    registered = model_loader.status()
+    for name, load in loaders.items():
+        if name not in registered:
+            model_loader.register(name, load)
+
+
+def start_up(background: bool = False):
+    """
+    Loads the models (and the local vector index) on parallel threads and starts the batchers.
+    With background=True it returns at once; handlers check model_loader before using a model.
+    """
+    if QUERY_INSTRUMENTATION:
+        enable_instrumentation(SLOW_QUERY_SECONDS, explain=EXPLAIN_SLOW_QUERIES)
+
+    register_models()
+    model_loader.start(background=background)
+
+    start_batchers()
+    start_response_cache()
+    # Reads the Semesters table once before returning, then polls it
+    semester_directory.start(read_semester_rows, SEMESTERS_POLL_SECONDS)
+
+
+def start_response_cache():
+    """
+    Creates the search response cache and starts polling the data version.
+    """
+    global response_cache
+    global data_version
+
+    if RESPONSE_CACHE and response_cache is None:
+        response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS)
+        data_version = DataVersionPoller(read_data_version, DATA_VERSION_POLL_SECONDS)
+        data_version.start()
+
+
+def preload_models():
+    """
+    Loads the classifier and the sentence encoder in the pre-fork supervisor.
+    Runs no inference and opens no database connection: neither survives a fork.
+    """
+    model_loader.register('arxiv', load_arxiv_model)
+    model_loader.register('piazza', load_piazza_encoder)
+    model_loader.start(background=False)
+
+    # Put the weights in shared memory so no allocator write near them un-shares a page.
+    # Memory-mapped weights (ARXIV_STATE_DICT_PATH) are shared through the page cache already.
+    modules = [piazza_db_tokenizer]
+    if not os.path.exists(ARXIV_STATE_DICT_PATH):
+        modules.append(getattr(arxiv_classif_model, 'model', None))
+    for module in modules:
+        if hasattr(module, 'share_memory'):
+            module.share_memory()
+
 
-    # Pull from Cache if available, else download
-    piazza_db_tokenizer = SentenceTransformer('bert-base-nli-mean-tokens')
-    piazza_db_tokenizer.eval()
+def start_worker(worker_index: int):
+    """
+    Runs in each pre-fork worker before it serves: the threads, pools and connections
+    the supervisor must not create are made here.
+    """
+    if 'torch' in sys.modules and PREFORK_TORCH_THREADS:
+        sys.modules['torch'].set_num_threads(PREFORK_TORCH_THREADS)
+    startup_phases.mark(f'worker_{worker_index}_forked')
+    start_up(background=True)
 
-TEST_FLAG = False
 
 if __name__ == "__main__":
+    startup_phases.mark('imported')
 
-    start_up()
-
-    if TEST_FLAG:
-        print("Testing Arxiv Classification")
-        pred_string = "Neural Networks are a part of machine learning and AI"
-        ArxivTest = SidHubHttpServer.handle_arxiv_classification("pred_string")
-        print(f"Prediction for {pred_string} is {ArxivTest}")
-
-        print("Testing 360 Piazza Database")
-        pred_string = "Gradient Descent"
-        PiazzaDatabaseTest = SidHubHttpServer.handle_360_Piazza_Database(pred_string)
-        print(f"First Row of Database response for {pred_string} is: {PiazzaDatabaseTest['response'][0]}")
-
-        print("Testing WebServer")
-        server = CustomHTTPServer(('localhost', PORT), SidHubHttpServer)
-        thread = threading.Thread(target=server.serve_forever)
-        thread.start()
-
-        print("Testing arxiv Endpoint")
-        response = requests.post(f"http://localhost:{PORT}", json={"resource": "arxivClassification", "data": "Neural Networks are a part of machine learning and AI"}, timeout=120)
-        response_json = response.json()
-        print(response_json)
-
-        print("Testing piazza db endpoint")
-        response = requests.post(f"http://localhost:{PORT}", json={"resource": "360PiazzaDatabase", "data": "Gradient Descent"}, timeout=1200000)
-        response_json = response.json()
-        print(response_json['response'][0])
-        
-        server.shutdown()
+    if PREFORK_WORKERS:
+        server = make_server((DEFAULT_IP, PORT))
+        startup_phases.mark('bound')
+        if PREFORK_PRELOAD:
+            preload_models()
+        print(f"Serving on port {PORT} ({PREFORK_WORKERS} {SERVING_MODE} workers)")
+        PreforkSupervisor(server, PREFORK_WORKERS, worker_init=start_worker).run()
         exit(0)
 
-    server = CustomHTTPServer((DEFAULT_IP, PORT), SidHubHttpServer)
-    print(f"Serving on port {PORT}")
+    if STARTUP_MODE == 'background':
+        # Semester names are one quick query: read them before binding, so no response names a semester by its id
+        semester_directory.start(read_semester_rows, SEMESTERS_POLL_SECONDS)
+        # Bind first: pings and /ready are answered while the models load
+        server = make_server((DEFAULT_IP, PORT))
+        startup_phases.mark('bound')
+        start_up(background=True)
+    else:
+        start_up()
+        server = make_server((DEFAULT_IP, PORT))
+        startup_phases.mark('bound')
+    print(f"Serving on port {PORT} ({SERVING_MODE}, {STARTUP_MODE} start-up)")
     server.serve_forever()
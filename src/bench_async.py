@@ -0,0 +1,173 @@
+"""
+Connection scalability of the threaded server against the asyncio front end.
+
+Each run starts the server in its own process with simulated models (see
+bench_concurrency.simulate_backends) and opens --connections concurrent keep-alive
+connections from an asyncio client, each sending --requests requests of the usual mix,
+--pipeline at a time. The threaded server answers HTTP/1.0 and closes every connection,
+so its client reconnects for each request; the asyncio server keeps them open.
+
+    python bench_async.py --connections 10 100 1000 --requests 10 --pipeline 1
+"""
+import os
+import io
+import json
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import contextlib
+
+import WebServer
+from bench_concurrency import REQUEST_MIX, simulate_backends, percentile
+
+SERVERS = ('threaded', 'async')
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(kind: str, port: int, inference_ms: float, db_ms: float) -> int:
+    """
+    Forks a process serving on port. Returns its pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            WebServer.SidHubHttpServer.log_message = lambda *args: None
+            simulate_backends(inference_ms, db_ms)
+            if kind == 'threaded':
+                server = WebServer.make_server(('localhost', port), 'threaded')
+                WebServer.start_batchers()
+                server.serve_forever()
+            else:
+                import AsyncServing
+                WebServer.start_batchers()
+                asyncio.run(AsyncServing.serve('localhost', port))
+    finally:
+        os._exit(0)
+
+
+def encode_request(index: int) -> bytes:
+    if index % 5 == 4:
+        return b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    body = json.dumps(REQUEST_MIX[index % len(REQUEST_MIX)]).encode('utf-8')
+    return (
+        "POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode('latin-1') + body
+
+
+async def read_response(reader: asyncio.StreamReader):
+    """
+    Returns:
+        (status, whether the server keeps the connection open)
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    version, status = status_line.decode('latin-1').split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection') != 'close'
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        await reader.read()
+        keep_alive = False
+    return int(status), keep_alive
+
+
+async def run_connection(port: int, client: int, num_requests: int, pipeline: int, results: dict):
+    reader = writer = None
+    sent = 0
+    while sent < num_requests:
+        batch = list(range(sent, min(num_requests, sent + pipeline)))
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('localhost', port)
+                results['connects'] += 1
+            writer.write(b''.join(encode_request(client + i) for i in batch))
+            await writer.drain()
+            keep_alive = True
+            for _ in batch:
+                status, keep_alive = await read_response(reader)
+                results['latencies'].append(time.perf_counter() - start)
+                results['statuses'][status] = results['statuses'].get(status, 0) + 1
+                if not keep_alive:
+                    break
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            results['statuses']['error'] = results['statuses'].get('error', 0) + 1
+            keep_alive = False
+        sent += len(batch) if keep_alive or pipeline == 1 else 1
+        if not keep_alive and writer is not None:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def load(port: int, connections: int, num_requests: int, pipeline: int) -> dict:
+    results = {'latencies': [], 'statuses': {}, 'connects': 0}
+    start = time.perf_counter()
+    await asyncio.gather(*[run_connection(port, c, num_requests, pipeline, results) for c in range(connections)])
+    wall = time.perf_counter() - start
+    latencies = results['latencies']
+    return {
+        'connections'   : connections,
+        'responses'     : len(latencies),
+        'throughput'    : len(latencies) / wall,
+        'p50_ms'        : percentile(latencies, 50) * 1000,
+        'p99_ms'        : percentile(latencies, 99) * 1000,
+        'tcp_connects'  : results['connects'],
+        'statuses'      : results['statuses'],
+    }
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--requests', type=int, default=10, help='requests per connection')
+    parser.add_argument('--pipeline', type=int, default=1, help='requests sent before reading the responses')
+    parser.add_argument('--inference-ms', type=float, default=20)
+    parser.add_argument('--db-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    for kind in args.servers:
+        for connections in args.connections:
+            port = free_port()
+            pid = start_server(kind, port, args.inference_ms, args.db_ms)
+            try:
+                wait_for_port(port)
+                result = asyncio.run(load(port, connections, args.requests, args.pipeline))
+            finally:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            print(f"{kind:>9} {connections:>5} connections: {result['responses']} responses, {result['throughput']:.1f} req/s, "
+                  f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, "
+                  f"{result['tcp_connects']} TCP connects, statuses {result['statuses']}")
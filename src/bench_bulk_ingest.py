@@ -0,0 +1,157 @@
+"""
+Compares ways of writing scraped posts and their sentence embeddings:
+per-row INSERT with PGQuery.toVector (the old scraper path), multi-row
+execute_values, text COPY and binary COPY.
+
+By default rows go to a stand-in connection that accepts the statements and
+counts the bytes it would have sent, so the numbers show client-side
+serialisation cost and wire size without a database. --real writes to temporary
+tables in the database from POSTGRES_LOGIN instead.
+
+    python bench_bulk_ingest.py --posts 200 --sentences 12
+    python bench_bulk_ingest.py --real
+"""
+import time
+import argparse
+import numpy as np
+import psycopg2.extensions
+
+from PostGresQueryGenerator import PGQuery as PGQ
+
+POSTS_COLUMNS = ['semester_id', 'post_id', 'post_title', 'post_content', 'instructor_answer', 'student_answer']
+EMBEDDINGS_COLUMNS = ['embedding', 'semester_id', 'post_id']
+
+
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.query = b''
+
+    def mogrify(self, template, args):
+        if isinstance(template, str):
+            template = template.encode('utf-8')
+        return template % tuple(psycopg2.extensions.adapt(arg).getquoted() for arg in args)
+
+    def execute(self, sql, params=None):
+        if params is not None:
+            sql = self.mogrify(sql, params)
+        self.query = sql if isinstance(sql, bytes) else sql.encode('utf-8')
+        self.connection.bytes_sent += len(self.query)
+
+    def copy_expert(self, sql, file):
+        self.connection.bytes_sent += len(sql) + len(file.read())
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    """
+    Accepts statements like a psycopg2 connection and only counts the bytes sent.
+    """
+    encoding = 'UTF8'
+    autocommit = False
+    closed = 0
+
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def synthetic_rows(num_posts: int, sentences: int, rng: np.random.Generator):
+    posts, embeddings = [], []
+    for post_id in range(num_posts):
+        posts.append((1, post_id, f'Question {post_id} about gradient descent',
+                      'How does the learning rate affect convergence? ' * 8,
+                      'Try a smaller learning rate and plot the loss. ' * 4, ''))
+        for vector in rng.standard_normal((sentences, 768), dtype=np.float32):
+            embeddings.append((vector, 1, post_id))
+    return posts, embeddings
+
+
+def per_row_insert(SQL, posts, embeddings):
+    for post in posts:
+        SQL.INSERT_INTO('Posts', POSTS_COLUMNS).VALUES([
+            (PGQ.toInt(post[0]), PGQ.toInt(post[1])) + tuple(PGQ.toString(v) for v in post[2:])
+        ]).execute_nofetch()
+    for embedding, semester_id, post_id in embeddings:
+        SQL.INSERT_INTO('Embeddings', EMBEDDINGS_COLUMNS).VALUES([
+            (PGQ.toVector(embedding), PGQ.toInt(semester_id), PGQ.toInt(post_id))
+        ]).execute_nofetch()
+
+
+def execute_values(SQL, posts, embeddings):
+    SQL.insert_rows('Posts', POSTS_COLUMNS, posts)
+    SQL.insert_rows('Embeddings', EMBEDDINGS_COLUMNS, embeddings)
+
+
+def copy_text(SQL, posts, embeddings):
+    SQL.copy_rows('Posts', POSTS_COLUMNS, posts, binary=False)
+    SQL.copy_rows('Embeddings', EMBEDDINGS_COLUMNS, embeddings, binary=False)
+
+
+def copy_binary(SQL, posts, embeddings):
+    SQL.copy_rows('Posts', POSTS_COLUMNS, posts)
+    SQL.copy_rows('Embeddings', EMBEDDINGS_COLUMNS, embeddings)
+
+
+METHODS = {
+    'per_row_insert'    : per_row_insert,
+    'execute_values'    : execute_values,
+    'copy_text'         : copy_text,
+    'copy_binary'       : copy_binary,
+}
+
+
+def real_connection(login):
+    import psycopg2
+    connection = psycopg2.connect(**login)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE Posts (semester_id INT, post_id INT, post_title TEXT, post_content TEXT, '
+                   'instructor_answer TEXT, student_answer TEXT, PRIMARY KEY(semester_id, post_id));')
+    cursor.execute('CREATE TEMPORARY TABLE Embeddings (id SERIAL PRIMARY KEY, embedding vector(768) NOT NULL, '
+                   'semester_id INT NOT NULL, post_id INT NOT NULL);')
+    connection.commit()
+    return connection
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--sentences', type=int, default=12, help='embeddings per post')
+    parser.add_argument('--methods', nargs='+', choices=list(METHODS), default=list(METHODS))
+    parser.add_argument('--real', action='store_true', help='write to temporary tables in Postgres')
+    args = parser.parse_args()
+
+    posts, embeddings = synthetic_rows(args.posts, args.sentences, np.random.default_rng(0))
+    total_rows = len(posts) + len(embeddings)
+
+    login = None
+    if args.real:
+        from WebServer import POSTGRES_LOGIN
+        login = POSTGRES_LOGIN
+
+    for name in args.methods:
+        connection = real_connection(login) if login else StandInConnection()
+        SQL = PGQ(connection)
+        start = time.perf_counter()
+        METHODS[name](SQL, posts, embeddings)
+        connection.commit()
+        seconds = time.perf_counter() - start
+
+        if login:
+            cursor = connection.cursor()
+            cursor.execute('SELECT pg_total_relation_size(\'embeddings\');')
+            detail = f"embeddings table {cursor.fetchone()[0] / 1e6:.1f} MB"
+            connection.close()
+        else:
+            detail = f"{connection.bytes_sent / 1e6:8.1f} MB sent"
+        print(f"{name:>15}: {total_rows / seconds:10.0f} rows/s  {seconds:7.2f} s  {detail}")
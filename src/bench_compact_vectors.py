@@ -0,0 +1,151 @@
+"""
+Footprint, scan latency and recall of compact embeddings (halfvec, binary) with exact rerank.
+
+Runs on the fixture corpus of bench_hybrid_search. Each representation does the server's
+search: the --rerank nearest sentences by the compact vectors, reranked on the float32
+vectors, best sentence per post. float32 is the current search, scoring every sentence.
+Recall@k is measured against the exact ranking (every sentence scored in float32).
+
+Without --sql the scans run in NumPy: halfvec scores float16-rounded vectors, binary
+compares sign bits by Hamming distance. "read" is the vector bytes a query touches,
+the compact column plus the reranked float32 rows; NumPy has no fast float16 kernel,
+so the halfvec latency here says little, its bytes read do.
+
+With --sql the corpus goes into temporary Posts and Embeddings tables (they shadow the
+real ones for this session only) with the CompactVectors generated columns and an HNSW
+index on each, and the searches run WebServer.query_similar_posts_sql with every
+VECTOR_QUANTIZATION; the table and index sizes come from Postgres.
+
+    python bench_compact_vectors.py --posts 20000 --queries 100
+    python bench_compact_vectors.py --posts 20000 --queries 100 --sql
+"""
+import time
+import argparse
+import numpy as np
+
+from bench_hybrid_search import fixture_corpus, fixture_queries, exact_ranking, load_sql, summarize, EMBEDDING_DIM
+from CompactVectors import QUANTIZATIONS, RERANK_CANDIDATES, compact_column, compact_index_name, storage_footprint
+
+REPRESENTATIONS = ('float32',) + tuple(QUANTIZATIONS)
+SEARCH_CANDIDATES = 100
+# Bytes of one stored vector, pgvector's 8 byte header included
+VECTOR_BYTES = {
+    'float32'   : 8 + 4 * EMBEDDING_DIM,
+    'halfvec'   : 8 + 2 * EMBEDDING_DIM,
+    'binary'    : 8 + EMBEDDING_DIM // 8,
+}
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint16)
+
+
+class InMemoryScan:
+    """
+    The coarse pass and rerank of one representation over an in-memory table.
+    """
+
+    def __init__(self, representation: str, embeddings: np.ndarray, keys):
+        self.representation = representation
+        self.embeddings = embeddings
+        self.keys = keys
+        if representation == 'halfvec':
+            self.compact = embeddings.astype(np.float16)
+        elif representation == 'binary':
+            self.compact = np.packbits(embeddings > 0, axis=1)
+
+    def coarse_scores(self, query_vector: np.ndarray) -> np.ndarray:
+        # Higher is closer for every representation
+        if self.representation == 'halfvec':
+            return self.compact @ query_vector.astype(np.float16)
+        if self.representation == 'binary':
+            return -POPCOUNT[np.bitwise_xor(self.compact, np.packbits(query_vector > 0))].sum(axis=1, dtype=np.int32)
+        return self.embeddings @ query_vector
+
+    def search(self, query_vector: np.ndarray, k: int, rerank: int):
+        scores = self.coarse_scores(query_vector)
+        limit = SEARCH_CANDIDATES if self.representation == 'float32' else rerank
+        rows = np.argpartition(-scores, limit - 1)[:limit] if limit < len(scores) else np.arange(len(scores))
+        if self.representation != 'float32':
+            # Exact rerank of the coarse candidates, keeping the server's SEARCH_CANDIDATES sentences
+            exact = self.embeddings[rows] @ query_vector
+            keep = np.argsort(-exact)[:SEARCH_CANDIDATES]
+            rows, scores = rows[keep], exact[keep]
+        else:
+            scores = scores[rows]
+
+        best = {}
+        for row, score in zip(rows, scores):
+            key = self.keys[row]
+            best[key] = max(best.get(key, -2.0), float(score))
+        return sorted(best, key=best.get, reverse=True)[:k]
+
+    def bytes_read(self, rerank: int) -> int:
+        rows = len(self.embeddings)
+        if self.representation == 'float32':
+            return rows * VECTOR_BYTES['float32']
+        return rows * VECTOR_BYTES[self.representation] + min(rerank, rows) * VECTOR_BYTES['float32']
+
+
+def add_compact_columns(SQL):
+    from VectorIndex import create_vector_index
+
+    create_vector_index(SQL, 'hnsw', table_name='Embeddings')
+    for quantization, spec in QUANTIZATIONS.items():
+        SQL.ALTER_TABLE('Embeddings').ADD_COLUMN(compact_column(quantization)).execute_nofetch(raise_errors=True)
+        create_vector_index(SQL, 'hnsw', index_name=compact_index_name(quantization), table_name='Embeddings',
+                            column=spec['column'], opclass=spec['opclass'])
+    SQL.connection.cursor().execute('ANALYZE Embeddings;')
+    SQL.commit()
+
+
+def sql_search(SQL, representation: str, query_vector: np.ndarray, k: int, rerank: int):
+    import WebServer
+
+    WebServer.VECTOR_QUANTIZATION = None if representation == 'float32' else representation
+    WebServer.QUANTIZED_RERANK_CANDIDATES = rerank
+    WebServer.COSINE_SIMILARITY_THRESHOLD = -1.0
+    WebServer.SEARCH_CANDIDATES = SEARCH_CANDIDATES
+    WebServer.SEARCH_RESULTS = k
+    rows = WebServer.query_similar_posts_sql(SQL, query_vector)
+    SQL.rollback()
+    return [(row[0], row[1]) for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rerank', type=int, default=RERANK_CANDIDATES, help='coarse candidates reranked exactly')
+    parser.add_argument('--representations', nargs='+', choices=REPRESENTATIONS, default=list(REPRESENTATIONS))
+    parser.add_argument('--sql', action='store_true', help='run the searches in Postgres')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    posts, embeddings, keys, centroids, vocabularies = fixture_corpus(args.posts, args.topics, rng)
+    queries = [vector for _, vector in fixture_queries(args.queries, 0.0, centroids, vocabularies, rng)]
+    exact = [exact_ranking(embeddings, keys, query_vector, args.k) for query_vector in queries]
+    print(f"Fixture: {len(posts)} posts, {len(embeddings)} sentence embeddings, {len(queries)} queries, rerank {args.rerank}")
+
+    if args.sql:
+        SQL = load_sql(posts, embeddings, keys)
+        add_compact_columns(SQL)
+        for name, size in storage_footprint(SQL).items():
+            print(f"{name:>32}  {size / 1024 / 1024:9.1f} MB")
+
+    for representation in args.representations:
+        scan = InMemoryScan(representation, embeddings, keys)
+        latencies, recalls = [], []
+        for query_vector, expected in zip(queries, exact):
+            start = time.perf_counter()
+            if args.sql:
+                found = sql_search(SQL, representation, query_vector, args.k, args.rerank)
+            else:
+                found = scan.search(query_vector, args.k, args.rerank)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len(set(found) & set(expected)) / max(1, len(expected)))
+
+        footprint = f"{VECTOR_BYTES[representation]:5d} B/vector"
+        if not args.sql:
+            footprint += f"  read {scan.bytes_read(args.rerank) / 1024 / 1024:7.1f} MB/query"
+        print(f"{representation:>8}: recall@{args.k} {np.mean(recalls):.3f}  {footprint}  {summarize(latencies)}")
@@ -0,0 +1,142 @@
+"""
+Compares latency of the serial and threaded serving modes under N concurrent clients.
+
+By default the model and database work is simulated with sleeps, so the benchmark
+runs without the models or Postgres. Pass --real to load the models with start_up()
+and hit the real handlers.
+
+    python bench_concurrency.py --clients 16 --requests 20
+"""
+import io
+import json
+import time
+import contextlib
+import argparse
+import threading
+import http.client
+
+import WebServer
+
+REQUEST_MIX = [
+    {"resource": "arxivClassification", "data": "Neural Networks are a part of machine learning and AI"},
+    {"resource": "360PiazzaDatabase", "data": "Gradient Descent"},
+    {"resource": "ping"},
+]
+
+
+def simulate_backends(inference_ms: float, db_ms: float):
+    """
+    Replaces the model and database calls with sleeps of the given length.
+    Sleeping releases the GIL the same way torch kernels and socket reads do.
+    """
+    def classify_arxiv_batch(texts):
+        time.sleep(inference_ms / 1000)
+        return [0] * len(texts)
+
+    def encode(query):
+        time.sleep(inference_ms / 1000)
+        return [0.0] * 768
+
+    def handle_360_Piazza_Database(query, **kwargs):
+        WebServer.run_inference(encode, query)
+        time.sleep(db_ms / 1000)
+        return {'response': []}
+
+    WebServer.classify_arxiv_batch = classify_arxiv_batch
+    WebServer.SidHubHttpServer.handle_360_Piazza_Database = handle_360_Piazza_Database
+    # Nothing to load: mark the simulated models ready
+    WebServer.model_loader.register('arxiv', lambda: None)
+    WebServer.model_loader.register('piazza', lambda: None)
+    WebServer.model_loader.start(background=False)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_client(port, num_requests, client_index, latencies, statuses, lock):
+    for i in range(num_requests):
+        body = json.dumps(REQUEST_MIX[(client_index + i) % len(REQUEST_MIX)])
+        start = time.perf_counter()
+        try:
+            connection = http.client.HTTPConnection('localhost', port, timeout=120)
+            if i % 5 == 4:
+                connection.request('GET', '/')
+            else:
+                connection.request('POST', '/', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            connection.close()
+        except OSError:
+            status = 'error'
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+
+def bench_mode(mode, clients, num_requests):
+    server = WebServer.make_server(('localhost', 0), mode)
+    port = server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    latencies, statuses, lock = [], {}, threading.Lock()
+    threads = [
+        threading.Thread(target=run_client, args=(port, num_requests, c, latencies, statuses, lock))
+        for c in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    server.shutdown()
+    server.server_close()
+    return {
+        'mode'          : mode,
+        'clients'       : clients,
+        'requests'      : len(latencies),
+        'throughput'    : len(latencies) / wall,
+        'p50_ms'        : percentile(latencies, 50) * 1000,
+        'p99_ms'        : percentile(latencies, 99) * 1000,
+        'statuses'      : statuses,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--inference-ms', type=float, default=40)
+    parser.add_argument('--db-ms', type=float, default=150)
+    parser.add_argument('--no-batching', action='store_true', help='classify each request on its own')
+    parser.add_argument('--real', action='store_true', help='load the real models and database')
+    args = parser.parse_args()
+
+    if args.no_batching:
+        WebServer.ARXIV_BATCHING = False
+    if args.real:
+        WebServer.start_up()
+    else:
+        simulate_backends(args.inference_ms, args.db_ms)
+        WebServer.start_batchers()
+
+    # Keep the per-request prints and access logs out of the report
+    WebServer.SidHubHttpServer.log_message = lambda *args: None
+    for mode in ('serial', 'threaded'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = bench_mode(mode, args.clients, args.requests)
+        print(f"{result['mode']:>9}: {result['requests']} requests, {result['throughput']:.1f} req/s, "
+              f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, statuses {result['statuses']}")
+
+    batch_sizes = WebServer.REGISTRY.histogram('inference_batch_size', labels={'batcher': 'arxiv'})
+    if batch_sizes.count:
+        print(f"arxiv batches: {batch_sizes.count}, mean size {batch_sizes.sum / batch_sizes.count:.2f}")
@@ -0,0 +1,241 @@
+"""
+Recall and latency of the hybrid lexical + vector Piazza search on a fixture corpus.
+
+The corpus is synthetic: posts belong to topics, their text draws on the topic's words
+and their sentence embeddings sit around the topic's centroid. Queries are two topic
+words with an embedding near the centroid; --conceptual of them use words that appear
+in no post, so they exercise the fallback to the vector search.
+
+Recall@k is measured against the exact vector ranking (every sentence scored, best
+sentence per post). "scored" is the number of sentence embeddings compared with the
+query: the whole table for the vector search, the candidates' sentences for hybrid.
+
+Without --sql the lexical step runs on an in-memory term index weighted like
+ts_rank_cd's A/B/C labels. With --sql the corpus is loaded into temporary Posts and
+Embeddings tables (they shadow the real ones for this session only) in the database
+from POSTGRES_LOGIN and both searches run the server's own queries.
+
+    python bench_hybrid_search.py --posts 2000 --queries 100
+    python bench_hybrid_search.py --posts 20000 --queries 100 --sql
+"""
+import time
+import argparse
+import numpy as np
+
+import HybridSearch
+from HybridSearch import hybrid_search, LEXICAL_CANDIDATES, MIN_LEXICAL_HITS
+from PostGresQueryGenerator import PGQuery as PGQ
+
+EMBEDDING_DIM = 768
+SENTENCES_PER_POST = 6
+TOPIC_WORDS = 12
+COMMON_WORDS = ['question', 'answer', 'homework', 'lecture', 'please', 'thanks', 'code', 'error', 'example', 'week']
+FIELD_WEIGHTS = (1.0, 0.4, 0.2)     # title, content, answers: ts_rank's default A, B, C weights
+
+
+def fixture_corpus(num_posts: int, num_topics: int, rng: np.random.Generator):
+    """
+    Returns:
+        posts as (semester_id, post_id, title, content, instructor_answer, student_answer),
+        sentence embeddings, their (semester_id, post_id) keys, topic centroids and vocabularies.
+    """
+    vocabularies = [[f'topic{topic}term{word}' for word in range(TOPIC_WORDS)] for topic in range(num_topics)]
+    centroids = rng.standard_normal((num_topics, EMBEDDING_DIM)).astype(np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    posts, embeddings, keys = [], [], []
+    for post_id in range(num_posts):
+        topic = int(rng.integers(num_topics))
+        words = vocabularies[topic]
+
+        def text(length):
+            return ' '.join(words[int(rng.integers(TOPIC_WORDS))] if rng.random() < 0.4 else COMMON_WORDS[int(rng.integers(len(COMMON_WORDS)))]
+                            for _ in range(length))
+
+        posts.append((1, post_id, text(4), text(30), text(15), text(10)))
+        noise = rng.standard_normal((SENTENCES_PER_POST, EMBEDDING_DIM)).astype(np.float32) * 0.05
+        sentences = centroids[topic] + noise + rng.standard_normal(EMBEDDING_DIM).astype(np.float32) * 0.03
+        embeddings.append(sentences / np.linalg.norm(sentences, axis=1, keepdims=True))
+        keys.extend([(1, post_id)] * SENTENCES_PER_POST)
+    return posts, np.concatenate(embeddings), keys, centroids, vocabularies
+
+
+def fixture_queries(num_queries: int, conceptual: float, centroids, vocabularies, rng: np.random.Generator):
+    queries = []
+    for _ in range(num_queries):
+        topic = int(rng.integers(len(centroids)))
+        if rng.random() < conceptual:
+            text = 'unseen conceptual wording'
+        else:
+            text = ' '.join(rng.choice(vocabularies[topic], 2, replace=False))
+        vector = centroids[topic] + rng.standard_normal(EMBEDDING_DIM).astype(np.float32) * 0.05
+        queries.append((text, vector / np.linalg.norm(vector)))
+    return queries
+
+
+def exact_ranking(embeddings, keys, query_vector, k: int):
+    """
+    Best-sentence similarity per post over the whole table, top k posts.
+    """
+    similarities = embeddings @ query_vector
+    best = {}
+    for key, similarity in zip(keys, similarities):
+        if similarity > best.get(key, -2.0):
+            best[key] = float(similarity)
+    return sorted(best, key=best.get, reverse=True)[:k]
+
+
+class InMemoryLexicalIndex:
+    """
+    Stand-in for Posts.search_vector: posts matching any query term,
+    ranked by field-weighted term counts.
+    """
+
+    def __init__(self, posts):
+        self.postings = {}
+        for semester_id, post_id, *fields in posts:
+            fields = [fields[0], fields[1], fields[2] + ' ' + fields[3]]
+            for weight, field in zip(FIELD_WEIGHTS, fields):
+                for word in field.split():
+                    scores = self.postings.setdefault(word, {})
+                    scores[(semester_id, post_id)] = scores.get((semester_id, post_id), 0.0) + weight
+
+    def candidates(self, SQL, query: str, limit: int, semester_ids=None):
+        scores = {}
+        for word in query.split():
+            for key, score in self.postings.get(word, {}).items():
+                if semester_ids is None or key[0] in semester_ids:
+                    scores[key] = scores.get(key, 0.0) + score
+        return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+class InMemoryScorer:
+    """
+    Stand-in for score_candidates: best sentence similarity per candidate post.
+    """
+
+    def __init__(self, embeddings, keys):
+        self.embeddings = embeddings
+        self.keys = keys
+        self.rows = {}
+        for row, key in enumerate(keys):
+            self.rows.setdefault(key, []).append(row)
+
+    def score(self, SQL, query_vector, candidate_keys):
+        rows = [row for key in candidate_keys for row in self.rows.get(key, [])]
+        best = {}
+        for row, similarity in zip(rows, self.embeddings[rows] @ query_vector):
+            best[self.keys[row]] = max(best.get(self.keys[row], -2.0), float(similarity))
+        return best
+
+
+def load_sql(posts, embeddings, keys):
+    import WebServer
+    from HybridSearch import SEARCH_VECTOR_COLUMN, SEARCH_VECTOR_INDEX_NAME
+
+    SQL = PGQ()
+    SQL.login(WebServer.POSTGRES_LOGIN)
+    cursor = SQL.connection.cursor()
+    cursor.execute(
+        'CREATE TEMPORARY TABLE Posts (semester_id INT, post_id INT, post_title TEXT, post_content TEXT, '
+        f'instructor_answer TEXT, student_answer TEXT, {SEARCH_VECTOR_COLUMN}, PRIMARY KEY(semester_id, post_id));'
+    )
+    cursor.execute('CREATE TEMPORARY TABLE Embeddings (id SERIAL, embedding vector(768), semester_id INT, post_id INT);')
+    SQL.copy_rows('Posts', ['semester_id', 'post_id', 'post_title', 'post_content', 'instructor_answer', 'student_answer'], posts)
+    SQL.copy_rows('Embeddings', ['embedding', 'semester_id', 'post_id'],
+                  ((vector, semester_id, post_id) for vector, (semester_id, post_id) in zip(embeddings, keys)))
+    cursor.execute(f'CREATE INDEX {SEARCH_VECTOR_INDEX_NAME}_bench ON Posts USING gin (search_vector);')
+    cursor.execute('CREATE INDEX embeddings_post_idx_bench ON Embeddings (semester_id, post_id);')
+    cursor.execute('ANALYZE Posts; ANALYZE Embeddings;')
+    SQL.commit()
+    return SQL
+
+
+def vector_ranking_sql(SQL, query_vector, k: int):
+    # Exact scan, the same ranking exact_ranking computes
+    rows = SQL.SELECT([
+        'semester_id',
+        'post_id',
+        'MAX(1 - (embedding <=> %s)) AS similarity'
+    ], [query_vector]).FROM([
+        'Embeddings'
+    ]).GROUP_BY([
+        'semester_id',
+        'post_id'
+    ]).ORDER_BY([
+        'similarity DESC'
+    ]).LIMIT(
+        k
+    ).execute_fetch()
+    return [(row[0], row[1]) for row in rows]
+
+
+def summarize(latencies):
+    if not latencies:
+        return 'n/a'
+    latencies = np.asarray(latencies) * 1000
+    return f"p50 {np.percentile(latencies, 50):7.2f} ms  p99 {np.percentile(latencies, 99):7.2f} ms"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--topics', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--conceptual', type=float, default=0.2, help='share of queries with no lexical match')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--candidates', type=int, default=LEXICAL_CANDIDATES)
+    parser.add_argument('--min-lexical-hits', type=int, default=MIN_LEXICAL_HITS)
+    parser.add_argument('--sql', action='store_true', help='run the searches in Postgres')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    posts, embeddings, keys, centroids, vocabularies = fixture_corpus(args.posts, args.topics, rng)
+    queries = fixture_queries(args.queries, args.conceptual, centroids, vocabularies, rng)
+    print(f"Fixture: {len(posts)} posts, {len(embeddings)} sentence embeddings, {len(queries)} queries")
+
+    scorer = InMemoryScorer(embeddings, keys)
+    if args.sql:
+        SQL = load_sql(posts, embeddings, keys)
+        score = HybridSearch.score_candidates
+    else:
+        SQL = None
+        HybridSearch.lexical_candidates = InMemoryLexicalIndex(posts).candidates
+        score = scorer.score
+
+    # Counts the sentences each hybrid search scores and keeps its candidate set
+    seen = {'scored': 0, 'candidates': []}
+
+    def counted_score(SQL, query_vector, candidate_keys):
+        seen['scored'] += sum(len(scorer.rows.get(key, [])) for key in candidate_keys)
+        seen['candidates'] = candidate_keys
+        return score(SQL, query_vector, candidate_keys)
+
+    HybridSearch.score_candidates = counted_score
+
+    vector_latencies, hybrid_latencies = [], []
+    recalls, candidate_recalls, fallbacks = [], [], 0
+    for text, query_vector in queries:
+        start = time.perf_counter()
+        exact = vector_ranking_sql(SQL, query_vector, args.k) if args.sql else exact_ranking(embeddings, keys, query_vector, args.k)
+        vector_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hits = hybrid_search(SQL, text, query_vector, args.k, candidates=args.candidates,
+                             min_lexical_hits=args.min_lexical_hits, min_similarity=-1.0)
+        if hits is None:
+            fallbacks += 1
+            continue
+        hybrid_latencies.append(time.perf_counter() - start)
+        recalls.append(len({(s, p) for s, p, _ in hits} & set(exact)) / max(1, len(exact)))
+        candidate_recalls.append(len(set(seen['candidates']) & set(exact)) / max(1, len(exact)))
+
+    hybrid_queries = len(queries) - fallbacks
+    print(f"{'vector':>8}: recall@{args.k} 1.000  scored {len(embeddings):9d} per query  {summarize(vector_latencies)}")
+    if hybrid_queries:
+        print(f"{'hybrid':>8}: recall@{args.k} {np.mean(recalls):.3f}  scored {seen['scored'] / hybrid_queries:9.0f} per query  "
+              f"{summarize(hybrid_latencies)}  ({hybrid_queries} queries)")
+        # The part of the recall gap due to the lexical prefilter; the rest is the fused order
+        print(f"          exact top {args.k} found among the lexical candidates: {np.mean(candidate_recalls):.3f}")
+    print(f"fallback to vector: {fallbacks} of {len(queries)} queries had fewer than {args.min_lexical_hits} lexical hits")
@@ -0,0 +1,62 @@
+"""
+Compares the ArXiv classifier runtimes (eager fp32, dynamic int8, TorchScript, ONNX)
+on this machine: load time, agreement with the fp32 outputs, single-request latency
+and batched throughput. Prints the fastest backend that stays within tolerance,
+the value to put in WebServer.MODEL_RUNTIME.
+
+Needs the model and tokenizer from download_models.py in the working directory.
+
+    python bench_model_runtime.py
+    python bench_model_runtime.py --backends eager int8 --threads 4 --batch-size 16
+"""
+import time
+import argparse
+from transformers import AutoTokenizer
+
+from ModelRuntime import RUNTIME_BACKENDS, SAMPLE_TEXTS, load_runtime, check_accuracy, benchmark_runtime
+from WebServer import PRED_MODEL_NAME, TOKENIZER_NAME, NUM_LABELS
+
+
+def bench_texts(count: int):
+    # Abstract-length inputs: the sample sentences strung together, cycling through them
+    return [' '.join(SAMPLE_TEXTS[(i + j) % len(SAMPLE_TEXTS)] for j in range(8)) for i in range(count)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=RUNTIME_BACKENDS, default=list(RUNTIME_BACKENDS))
+    parser.add_argument('--texts', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME, force_download=False)
+    texts = bench_texts(args.texts)
+    reference = load_runtime('eager', PRED_MODEL_NAME, NUM_LABELS, tokenizer, threads=args.threads)
+
+    results = {}
+    for backend in args.backends:
+        start = time.perf_counter()
+        try:
+            runtime = reference if backend == 'eager' else load_runtime(backend, PRED_MODEL_NAME, NUM_LABELS, tokenizer, threads=args.threads)
+        except Exception as e:
+            print(f"{backend:>12}: not available ({e})")
+            continue
+        load_seconds = time.perf_counter() - start
+
+        accuracy = check_accuracy(reference, runtime, tokenizer, texts)
+        single = benchmark_runtime(runtime, tokenizer, texts[:8], batch_size=1, repeats=args.repeats)
+        batched = benchmark_runtime(runtime, tokenizer, texts, batch_size=args.batch_size, repeats=args.repeats)
+        results[backend] = (accuracy, batched)
+
+        print(f"{backend:>12}: load {load_seconds:6.1f} s  "
+              f"agreement {accuracy['argmax_agreement']:.3f}  max |dlogit| {accuracy['max_abs_diff']:.4f}  "
+              f"batch 1 p50 {single['p50_ms']:7.1f} ms p99 {single['p99_ms']:7.1f} ms  "
+              f"batch {args.batch_size} {batched['texts_per_second']:7.1f} texts/s"
+              f"{'' if accuracy['ok'] else '  (outside tolerance)'}")
+
+    within = {backend: batched for backend, (accuracy, batched) in results.items() if accuracy['ok']}
+    if within:
+        best = max(within, key=lambda backend: within[backend]['texts_per_second'])
+        print(f"Fastest within tolerance: MODEL_RUNTIME = '{best}'")
@@ -0,0 +1,123 @@
+"""
+Throughput and memory of the pre-fork mode for 1..N worker processes.
+
+The models are simulated: a block of --weights-mb stands in for the weights (allocated
+before the fork and read by every request) and each classification burns --cpu-ms of
+CPU while holding the GIL, the part of a request that threads cannot spread over cores.
+For every worker count it prints requests/s and the summed RSS and PSS of the workers;
+PSS counts the shared weights once, RSS once per worker.
+
+    python bench_prefork.py --workers 1 2 4 --clients 32 --requests 20
+"""
+import os
+import io
+import time
+import signal
+import argparse
+import threading
+import contextlib
+import numpy as np
+
+import WebServer
+from PreforkServing import PreforkSupervisor, process_memory
+from bench_concurrency import run_client, percentile
+
+
+def simulate_models(weights_mb: int, cpu_ms: float, db_ms: float):
+    """
+    Replaces the models with a shared read-only array and a busy loop.
+    """
+    weights = np.ones(weights_mb * 1024 * 1024 // 8)
+    weights.setflags(write=False)
+
+    def burn():
+        deadline = time.perf_counter() + cpu_ms / 1000
+        checksum = 0.0
+        while time.perf_counter() < deadline:
+            checksum += 1.0
+        # Touch every page of the weights, as a forward pass does
+        return float(weights[::512].sum()) + checksum
+
+    def classify_arxiv_batch(texts):
+        for _ in texts:
+            burn()
+        return [0] * len(texts)
+
+    def handle_360_Piazza_Database(query, **kwargs):
+        burn()
+        time.sleep(db_ms / 1000)
+        return {'response': []}
+
+    WebServer.classify_arxiv_batch = classify_arxiv_batch
+    WebServer.SidHubHttpServer.handle_360_Piazza_Database = handle_360_Piazza_Database
+    WebServer.model_loader.register('arxiv', lambda: None)
+    WebServer.model_loader.register('piazza', lambda: None)
+    WebServer.model_loader.start(background=False)
+
+
+def worker_pids(supervisor_pid: int):
+    with open(f'/proc/{supervisor_pid}/task/{supervisor_pid}/children') as children:
+        return [int(pid) for pid in children.read().split()]
+
+
+def bench_workers(workers: int, clients: int, num_requests: int):
+    server = WebServer.make_server(('localhost', 0), 'threaded')
+    port = server.server_address[1]
+
+    supervisor_pid = os.fork()
+    if supervisor_pid == 0:
+        with contextlib.redirect_stdout(io.StringIO()):
+            PreforkSupervisor(server, workers, worker_init=lambda index: WebServer.start_batchers()).run()
+        os._exit(0)
+    server.server_close()
+
+    while len(worker_pids(supervisor_pid)) < workers:
+        time.sleep(0.05)
+
+    latencies, statuses, lock = [], {}, threading.Lock()
+    threads = [
+        threading.Thread(target=run_client, args=(port, num_requests, c, latencies, statuses, lock))
+        for c in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    memory = [process_memory(pid) for pid in worker_pids(supervisor_pid)]
+    os.kill(supervisor_pid, signal.SIGTERM)
+    os.waitpid(supervisor_pid, 0)
+    return {
+        'workers'       : workers,
+        'requests'      : len(latencies),
+        'throughput'    : len(latencies) / wall,
+        'p50_ms'        : percentile(latencies, 50) * 1000,
+        'p99_ms'        : percentile(latencies, 99) * 1000,
+        'rss_mb'        : sum(m['rss'] for m in memory) / 2 ** 20,
+        'pss_mb'        : sum(m['pss'] for m in memory) / 2 ** 20,
+        'statuses'      : statuses,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--cpu-ms', type=float, default=20)
+    parser.add_argument('--db-ms', type=float, default=20)
+    parser.add_argument('--weights-mb', type=int, default=256)
+    args = parser.parse_args()
+
+    simulate_models(args.weights_mb, args.cpu_ms, args.db_ms)
+    WebServer.SidHubHttpServer.log_message = lambda *args: None
+
+    baseline = None
+    for workers in args.workers:
+        result = bench_workers(workers, args.clients, args.requests)
+        baseline = baseline or result
+        print(f"{workers:>3} workers: {result['throughput']:7.1f} req/s ({result['throughput'] / baseline['throughput']:.2f}x), "
+              f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, "
+              f"RSS {result['rss_mb']:.0f} MB, PSS {result['pss_mb']:.0f} MB, statuses {result['statuses']}")
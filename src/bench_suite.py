@@ -0,0 +1,479 @@
+"""
+Reproducible end-to-end benchmark of the server, offline, with results as JSON.
+
+1. Corpus: fills Semesters, Posts and Embeddings of a local benchmark database (created
+   if missing, with the scrapeAndDeploy schema) with a synthetic Piazza corpus: posts
+   on --topics topics over --semesters semesters, every sentence embedded by the
+   FakeModels encoder, then the vector index. --reuse-corpus keeps a corpus of the same size.
+2. Server: each of --servers runs in its own process against that database, with the
+   FakeModels random-weight classifier and encoder in place of the real models.
+   One request per resource checks the responses before any load is sent.
+3. Load: for every --rates value, an open-loop generator sends requests at Poisson
+   arrival times for --duration seconds, whether or not earlier ones have been answered,
+   a --arxiv-share of them arxivClassification and the rest 360PiazzaDatabase.
+   Latency is counted from the scheduled arrival, so a server falling behind shows up
+   in the percentiles instead of slowing the generator down.
+
+The JSON has the commit, the configuration, the corpus size and, per server and rate,
+throughput and latency percentiles per resource and the server's mean stage times
+(request_stage_seconds). Compare two files from different commits run with the same
+arguments.
+
+    python bench_suite.py --semesters 4 --posts 2500 --rates 20 50 100 --duration 20
+    python bench_suite.py --reuse-corpus --servers async --rates 200 --output async.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import platform
+import subprocess
+import contextlib
+import http.client
+import numpy as np
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from bench_async import free_port, wait_for_port, read_response
+from bench_concurrency import percentile
+from FakeModels import FakeSentenceEncoder, install_fake_models, CLASSIFIER_HIDDEN_SIZE, CLASSIFIER_LAYERS
+
+SERVERS = ('threaded', 'async')
+RESOURCES = ('arxivClassification', '360PiazzaDatabase')
+
+BENCH_DATABASE = 'piazza_bench'
+TOPIC_WORDS = 12
+COMMON_WORDS = ['question', 'answer', 'homework', 'lecture', 'please', 'thanks', 'code', 'error', 'example', 'week']
+SENTENCE_WORDS = (6, 16)
+# Words of a synthetic arxiv abstract, so the classifier sees a spread of lengths
+ARXIV_WORDS = (20, 300)
+ENCODE_BATCH_SIZE = 1024
+READY_TIMEOUT_SECONDS = 300
+
+
+def bench_login(dbname: str = BENCH_DATABASE) -> dict:
+    from WebServer import POSTGRES_LOGIN
+
+    return dict(POSTGRES_LOGIN, dbname=dbname)
+
+
+def ensure_database(login: dict):
+    """
+    Creates the benchmark database and the vector extension in it if they do not exist.
+    """
+    SQL = PGQ()
+    SQL.login(dict(login, dbname='postgres'))
+    SQL.toggleAutoCommit()
+    if not SQL.SELECT(['1']).FROM(['pg_database']).WHERE('datname = %s', [login['dbname']]).execute_fetch(raise_errors=True):
+        SQL.CREATE_DATABASE(login['dbname']).execute_nofetch(raise_errors=True)
+    SQL.connection.close()
+
+    SQL = PGQ()
+    SQL.login(login)
+    SQL.CREATE_EXTENSTION('IF NOT EXISTS vector').execute_nofetch(raise_errors=True)
+    SQL.commit()
+    return SQL
+
+
+def topic_vocabularies(num_topics: int):
+    return [[f'topic{topic}term{word}' for word in range(TOPIC_WORDS)] for topic in range(num_topics)]
+
+
+def sentence(words, rng: np.random.Generator) -> str:
+    length = int(rng.integers(*SENTENCE_WORDS))
+    return ' '.join(words[int(rng.integers(len(words)))] if rng.random() < 0.4 else COMMON_WORDS[int(rng.integers(len(COMMON_WORDS)))]
+                    for _ in range(length))
+
+
+def synthetic_posts(semester_id: int, num_posts: int, vocabularies, sentences_per_post: int, rng: np.random.Generator):
+    """
+    Yields:
+        (Posts row in POSTS_INSERT_COLUMNS order, the post's sentences to embed)
+    """
+    for post_id in range(1, num_posts + 1):
+        words = vocabularies[int(rng.integers(len(vocabularies)))]
+        sentences = [sentence(words, rng) for _ in range(sentences_per_post)]
+        title, content = sentences[0], '. '.join(sentences[1:-2])
+        instructor_answer, student_answer = sentences[-2], sentences[-1]
+        yield (semester_id, post_id, title, content, instructor_answer, student_answer), sentences
+
+
+def build_corpus(SQL: PGQ, encoder: FakeSentenceEncoder, num_semesters: int, posts_per_semester: int, num_topics: int,
+                 sentences_per_post: int, index_method: str, rng: np.random.Generator) -> dict:
+    """
+    Drops and recreates the scrapeAndDeploy tables and loads the synthetic corpus.
+    The vector index is built once the rows are in.
+    """
+    from scrapeAndDeploy import TABLES, SEMESTERS_COLUMN, POSTS_COLUMN, EMBEDDINGS_COLUMN
+    from ScrapePipeline import ensureIngestSchema, bumpDataVersion, POSTS_INSERT_COLUMNS, EMBEDDINGS_INSERT_COLUMNS
+    from SemesterPartitions import create_semester_partition
+    from VectorIndex import create_vector_index
+
+    start = time.perf_counter()
+    for table in TABLES:
+        SQL.DROP_TABLE().IF_EXISTS(table).execute_nofetch(raise_errors=True)
+    SQL.CREATE_TABLE('Semesters', SEMESTERS_COLUMN).execute_nofetch(raise_errors=True)
+    SQL.CREATE_TABLE('Posts', POSTS_COLUMN).execute_nofetch(raise_errors=True)
+    SQL.CREATE_TABLE('Embeddings', EMBEDDINGS_COLUMN).PARTITION_BY('LIST', ['semester_id']).execute_nofetch(raise_errors=True)
+    ensureIngestSchema(SQL)
+
+    vocabularies = topic_vocabularies(num_topics)
+    embeddings = 0
+    for semester in range(1, num_semesters + 1):
+        SQL.INSERT_INTO(
+            'Semesters', ['semester_name', 'semester_piazza_code', 'ingest_complete']
+        ).VALUES([
+            (PGQ.toString(f'Bench Semester {semester}'), PGQ.toString(f'bench{semester}'), 'TRUE')
+        ]).execute_nofetch(raise_errors=True)
+        semester_id = SQL.SELECT(['semester_id']).FROM(['Semesters']).WHERE(
+            f"semester_piazza_code = {PGQ.toString(f'bench{semester}')}"
+        ).execute_fetch(raise_errors=True)[0][0]
+        create_semester_partition(SQL, semester_id)
+
+        posts, keys, sentences = [], [], []
+        for row, post_sentences in synthetic_posts(semester_id, posts_per_semester, vocabularies, sentences_per_post, rng):
+            posts.append(row)
+            keys.extend([(row[0], row[1])] * len(post_sentences))
+            sentences.extend(post_sentences)
+        SQL.copy_rows('Posts', POSTS_INSERT_COLUMNS, posts)
+        for first in range(0, len(sentences), ENCODE_BATCH_SIZE):
+            vectors = encoder.encode(sentences[first:first + ENCODE_BATCH_SIZE])
+            SQL.copy_rows('Embeddings', EMBEDDINGS_INSERT_COLUMNS,
+                          ((vector, semester_id, post_id, None) for vector, (semester_id, post_id)
+                           in zip(vectors, keys[first:first + ENCODE_BATCH_SIZE])))
+        embeddings += len(sentences)
+        SQL.commit()
+        print(f"Semester {semester_id}: {len(posts)} posts, {len(sentences)} sentence embeddings")
+
+    bumpDataVersion(SQL)
+    SQL.commit()
+    # Commits
+    create_vector_index(SQL, index_method)
+    SQL.connection.cursor().execute('ANALYZE Semesters; ANALYZE Posts; ANALYZE Embeddings;')
+    SQL.commit()
+    return {
+        'semesters'     : num_semesters,
+        'posts'         : num_semesters * posts_per_semester,
+        'embeddings'    : embeddings,
+        'build_seconds' : time.perf_counter() - start,
+    }
+
+
+def corpus_size(SQL: PGQ) -> dict:
+    """
+    The size of the corpus already in the database, or {} when it has none.
+    """
+    try:
+        semesters, posts, embeddings = SQL.SELECT([
+            '(SELECT COUNT(*) FROM Semesters)',
+            '(SELECT COUNT(*) FROM Posts)',
+            '(SELECT COUNT(*) FROM Embeddings)'
+        ]).execute_fetch(raise_errors=True)[0]
+    except Exception:
+        SQL.rollback()
+        return {}
+    return {'semesters': semesters, 'posts': posts, 'embeddings': embeddings}
+
+
+def start_server(kind: str, port: int, login: dict, args) -> int:
+    """
+    Forks a process serving on port with the fake models against the benchmark database.
+    Returns its pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import WebServer
+
+            WebServer.SidHubHttpServer.log_message = lambda *args: None
+            WebServer.POSTGRES_LOGIN = login
+            WebServer.RESPONSE_CACHE = args.response_cache
+            WebServer.QUERY_CACHE = args.query_cache
+            # Random weights put most texts near 0 cosine similarity
+            WebServer.COSINE_SIMILARITY_THRESHOLD = args.min_similarity
+            install_fake_models(WebServer, args.classifier_hidden, args.classifier_layers, seed=args.seed)
+            if kind == 'threaded':
+                server = WebServer.make_server(('localhost', port), 'threaded')
+                WebServer.start_up(background=True)
+                server.serve_forever()
+            else:
+                import AsyncServing
+                WebServer.start_up(background=True)
+                asyncio.run(AsyncServing.serve('localhost', port))
+    finally:
+        os._exit(0)
+
+
+def get_json(port: int, path: str):
+    connection = http.client.HTTPConnection('localhost', port, timeout=30)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def post_json(port: int, body: dict):
+    connection = http.client.HTTPConnection('localhost', port, timeout=120)
+    try:
+        connection.request('POST', '/', json.dumps(body), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def wait_until_ready(port: int, timeout: float = READY_TIMEOUT_SECONDS) -> dict:
+    wait_for_port(port)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status, data = get_json(port, '/ready')
+        if status == 200:
+            return data
+        time.sleep(0.2)
+    raise TimeoutError(f"Models not ready after {timeout} s: {data.get('models')}")
+
+
+def smoke_check(port: int) -> dict:
+    """
+    One request per resource, as the old WebServer TEST_FLAG run did.
+    Raises:
+        AssertionError: a response is not what the handler returns.
+    """
+    from WebServer import LABEL_DESCRIPTIONS
+
+    status, arxiv = post_json(port, {'resource': 'arxivClassification', 'data': 'Neural Networks are a part of machine learning and AI'})
+    assert status == 200 and arxiv.get('message') in LABEL_DESCRIPTIONS, arxiv
+    status, piazza = post_json(port, {'resource': '360PiazzaDatabase', 'data': 'topic0term0 topic0term1'})
+    assert status == 200 and isinstance(piazza.get('response'), list), piazza
+    return {'arxiv_message': arxiv['message'], 'piazza_results': len(piazza['response'])}
+
+
+class RequestFactory:
+    """
+    Bodies of the load: synthetic abstracts for arxivClassification, two topic words for
+    360PiazzaDatabase, a --semester-filter-share of them scoped to one semester.
+    """
+
+    def __init__(self, vocabularies, num_semesters: int, arxiv_share: float, semester_filter_share: float, rng: np.random.Generator):
+        self.vocabularies = vocabularies
+        self.words = [word for vocabulary in vocabularies for word in vocabulary] + COMMON_WORDS
+        self.num_semesters = num_semesters
+        self.arxiv_share = arxiv_share
+        self.semester_filter_share = semester_filter_share
+        self.rng = rng
+
+    def __call__(self):
+        """
+        Returns:
+            (resource, encoded HTTP request)
+        """
+        if self.rng.random() < self.arxiv_share:
+            length = int(self.rng.integers(*ARXIV_WORDS))
+            text = ' '.join(self.words[i] for i in self.rng.integers(len(self.words), size=length))
+            body = {'resource': 'arxivClassification', 'data': text}
+        else:
+            vocabulary = self.vocabularies[int(self.rng.integers(len(self.vocabularies)))]
+            body = {'resource': '360PiazzaDatabase', 'data': ' '.join(self.rng.choice(vocabulary, 2, replace=False))}
+            if self.rng.random() < self.semester_filter_share:
+                body['semesters'] = [int(self.rng.integers(1, self.num_semesters + 1))]
+        encoded = json.dumps(body).encode('utf-8')
+        return body['resource'], (
+            "POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nConnection: close\r\n"
+            f"Content-Length: {len(encoded)}\r\n\r\n"
+        ).encode('latin-1') + encoded
+
+
+async def timed_request(port: int, resource: str, request: bytes, scheduled: float, timeout: float, results: dict):
+    loop = asyncio.get_running_loop()
+    outcome = results[resource]
+    writer = None
+    try:
+        async def exchange():
+            nonlocal writer
+            reader, writer = await asyncio.open_connection('localhost', port)
+            writer.write(request)
+            await writer.drain()
+            return await read_response(reader)
+
+        status, _ = await asyncio.wait_for(exchange(), timeout)
+        outcome['statuses'][status] = outcome['statuses'].get(status, 0) + 1
+        if status == 200:
+            outcome['latencies'].append(loop.time() - scheduled)
+    except asyncio.TimeoutError:
+        outcome['statuses']['timeout'] = outcome['statuses'].get('timeout', 0) + 1
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        outcome['statuses']['error'] = outcome['statuses'].get('error', 0) + 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def open_loop(port: int, rate: float, duration: float, make_request: RequestFactory, timeout: float,
+                    rng: np.random.Generator) -> dict:
+    """
+    Sends requests at Poisson arrivals of the given rate for duration seconds.
+    Returns:
+        per resource: offered and answered requests, throughput and latency percentiles.
+    """
+    loop = asyncio.get_running_loop()
+    results = {resource: {'latencies': [], 'statuses': {}, 'sent': 0} for resource in RESOURCES}
+    tasks = []
+    start = loop.time()
+    scheduled = start
+    while True:
+        scheduled += float(rng.exponential(1 / rate))
+        if scheduled - start > duration:
+            break
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        resource, request = make_request()
+        results[resource]['sent'] += 1
+        tasks.append(asyncio.ensure_future(timed_request(port, resource, request, scheduled, timeout, results)))
+    await asyncio.gather(*tasks)
+    wall = loop.time() - start
+    return {resource: summarize(outcome, wall) for resource, outcome in results.items()}
+
+
+def summarize(outcome: dict, wall: float) -> dict:
+    latencies = outcome['latencies']
+    summary = {
+        'sent'          : outcome['sent'],
+        'ok'            : len(latencies),
+        'throughput'    : len(latencies) / wall,
+        'statuses'      : {str(status): count for status, count in outcome['statuses'].items()},
+    }
+    for name, pct in (('p50_ms', 50), ('p90_ms', 90), ('p99_ms', 99), ('p999_ms', 99.9)):
+        summary[name] = percentile(latencies, pct) * 1000 if latencies else None
+    summary['max_ms'] = max(latencies) * 1000 if latencies else None
+    summary['mean_ms'] = float(np.mean(latencies)) * 1000 if latencies else None
+    return summary
+
+
+def stage_totals(stats: dict) -> dict:
+    """
+    (count, sum) of every request_stage_seconds histogram in a /stats snapshot, by endpoint and stage.
+    """
+    totals = {}
+    for label_key, snapshot in stats.get('request_stage_seconds', {}).items():
+        labels = dict(pair.split('=', 1) for pair in label_key.split(','))
+        totals.setdefault(labels['endpoint'], {})[labels['stage']] = (snapshot['count'], snapshot['sum'])
+    return totals
+
+
+def stage_means(before: dict, after: dict) -> dict:
+    """
+    Mean milliseconds per stage between two stage_totals.
+    """
+    means = {}
+    for endpoint, stages in after.items():
+        for stage, (count, total) in stages.items():
+            previous_count, previous_total = before.get(endpoint, {}).get(stage, (0, 0.0))
+            if count > previous_count:
+                means.setdefault(endpoint, {})[stage] = (total - previous_total) / (count - previous_count) * 1000
+    return means
+
+
+def git_revision() -> dict:
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def bench_server(kind: str, login: dict, args, make_request: RequestFactory, rng: np.random.Generator) -> dict:
+    port = free_port()
+    pid = start_server(kind, port, login, args)
+    try:
+        ready = wait_until_ready(port)
+        result = {'server': kind, 'startup_seconds': ready.get('startup_seconds'), 'smoke': smoke_check(port), 'runs': []}
+        if args.warmup:
+            asyncio.run(open_loop(port, min(args.rates), args.warmup, make_request, args.timeout, rng))
+        for rate in args.rates:
+            _, stats = get_json(port, '/stats')
+            before = stage_totals(stats)
+            resources = asyncio.run(open_loop(port, rate, args.duration, make_request, args.timeout, rng))
+            _, stats = get_json(port, '/stats')
+            result['runs'].append({
+                'rate'      : rate,
+                'duration'  : args.duration,
+                'resources' : resources,
+                'stages_ms' : stage_means(before, stage_totals(stats)),
+            })
+            for resource, summary in resources.items():
+                p50, p99 = summary['p50_ms'], summary['p99_ms']
+                print(f"{kind:>9} {rate:>7.1f}/s {resource:>20}: {summary['ok']:>6}/{summary['sent']:<6} ok, "
+                      f"{summary['throughput']:7.1f} req/s, p50 {p50 if p50 is None else round(p50, 1)} ms, "
+                      f"p99 {p99 if p99 is None else round(p99, 1)} ms, statuses {summary['statuses']}")
+        return result
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dbname', default=BENCH_DATABASE, help='benchmark database, on the WebServer.POSTGRES_LOGIN server')
+    parser.add_argument('--semesters', type=int, default=4)
+    parser.add_argument('--posts', type=int, default=2500, help='posts per semester')
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--sentences', type=int, default=8, help='sentence embeddings per post')
+    parser.add_argument('--index', choices=('hnsw', 'ivfflat'), default='hnsw')
+    parser.add_argument('--reuse-corpus', action='store_true', help='keep a corpus of the same size already in the database')
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+    parser.add_argument('--rates', type=float, nargs='+', default=[20, 50, 100], help='offered requests per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load per rate')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load at the lowest rate before measuring')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a request counts as timed out')
+    parser.add_argument('--arxiv-share', type=float, default=0.5, help='share of arxivClassification requests')
+    parser.add_argument('--semester-filter-share', type=float, default=0.2, help='share of searches scoped to one semester')
+    parser.add_argument('--min-similarity', type=float, default=-1.0, help='COSINE_SIMILARITY_THRESHOLD of the server')
+    parser.add_argument('--response-cache', action='store_true', help='serve repeated searches from the response cache')
+    parser.add_argument('--query-cache', action='store_true', help='batch and cache query embeddings')
+    parser.add_argument('--classifier-hidden', type=int, default=CLASSIFIER_HIDDEN_SIZE)
+    parser.add_argument('--classifier-layers', type=int, default=CLASSIFIER_LAYERS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON results file, default bench_suite-<commit>.json')
+    args = parser.parse_args()
+
+    revision = git_revision()
+    login = bench_login(args.dbname)
+    SQL = ensure_database(login)
+
+    expected = {'semesters': args.semesters, 'posts': args.semesters * args.posts}
+    corpus = corpus_size(SQL)
+    if args.reuse_corpus and all(corpus.get(key) == value for key, value in expected.items()):
+        print(f"Reusing corpus: {corpus}")
+    else:
+        encoder = FakeSentenceEncoder(seed=args.seed)
+        corpus = build_corpus(SQL, encoder, args.semesters, args.posts, args.topics, args.sentences, args.index,
+                              np.random.default_rng(args.seed))
+        print(f"Built corpus: {corpus}")
+    SQL.connection.close()
+
+    # Its own generator, so a reused corpus gets the same request stream as a fresh one
+    rng = np.random.default_rng(args.seed + 1)
+    make_request = RequestFactory(topic_vocabularies(args.topics), args.semesters, args.arxiv_share, args.semester_filter_share, rng)
+    results = {
+        'suite'     : 'bench_suite',
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git'       : revision,
+        'host'      : {'python': sys.version.split()[0], 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config'    : vars(args),
+        'corpus'    : corpus,
+        'servers'   : [bench_server(kind, login, args, make_request, rng) for kind in args.servers],
+    }
+
+    output = args.output or f"bench_suite-{(revision['commit'] or 'unknown')[:10]}.json"
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Wrote {output}")
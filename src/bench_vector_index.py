@@ -0,0 +1,115 @@
+"""
+Compares top-k Piazza search latency of the in-process LocalVectorIndex with the
+pgvector SQL path at several corpus sizes.
+
+The local path runs on synthetic embeddings and needs nothing else. With --sql each
+corpus is also copied into a temporary table in the database from POSTGRES_LOGIN
+and queried with the same ORDER BY embedding <=> q LIMIT k shape as the server.
+
+    python bench_vector_index.py --sizes 10000 100000 1000000
+    python bench_vector_index.py --sizes 10000 100000 --sql --index hnsw
+"""
+import io
+import time
+import argparse
+import numpy as np
+
+from LocalVectorIndex import LocalVectorIndex, EMBEDDING_DIM
+from PostGresQueryGenerator import PGQuery as PGQ
+
+SENTENCES_PER_POST = 8
+
+
+def synthetic_corpus(size: int, rng: np.random.Generator):
+    vectors = rng.standard_normal((size, EMBEDDING_DIM), dtype=np.float32)
+    post_ids = np.arange(size, dtype=np.int32) // SENTENCES_PER_POST
+    semester_ids = np.ones(size, dtype=np.int32)
+    return vectors, semester_ids, post_ids
+
+
+def summarize(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return f"p50 {np.percentile(latencies, 50):8.2f} ms  p99 {np.percentile(latencies, 99):8.2f} ms"
+
+
+def bench_local(vectors, semester_ids, post_ids, queries, k, candidates):
+    start = time.perf_counter()
+    index = LocalVectorIndex(initial_capacity=len(vectors))
+    index.add(vectors, semester_ids, post_ids)
+    build = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, k=k, candidates=candidates)
+        latencies.append(time.perf_counter() - start)
+    return build, latencies
+
+
+def bench_sql(login, vectors, semester_ids, post_ids, queries, candidates, index_method):
+    import psycopg2
+    from VectorIndex import recommended_ivfflat_lists
+
+    connection = psycopg2.connect(**login)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE bench_embeddings (id SERIAL, semester_id INT, post_id INT, embedding vector(768));')
+
+    start = time.perf_counter()
+    buffer = io.StringIO()
+    for vector, semester_id, post_id in zip(vectors, semester_ids, post_ids):
+        buffer.write(f"{semester_id}\t{post_id}\t[{','.join(map(str, vector))}]\n")
+    buffer.seek(0)
+    cursor.copy_expert('COPY bench_embeddings (semester_id, post_id, embedding) FROM STDIN', buffer)
+    if index_method == 'hnsw':
+        cursor.execute('CREATE INDEX ON bench_embeddings USING hnsw (embedding vector_cosine_ops);')
+    elif index_method == 'ivfflat':
+        lists = recommended_ivfflat_lists(len(vectors))
+        cursor.execute(f'CREATE INDEX ON bench_embeddings USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists});')
+    cursor.execute('ANALYZE bench_embeddings;')
+    connection.commit()
+    build = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        query_vector = PGQ.toVector(query)
+        start = time.perf_counter()
+        cursor.execute(f'SET LOCAL hnsw.ef_search = {max(candidates, 40)};')
+        cursor.execute(
+            f'SELECT semester_id, post_id, 1 - (embedding <=> {query_vector}) AS similarity '
+            f'FROM bench_embeddings ORDER BY embedding <=> {query_vector} LIMIT {candidates};'
+        )
+        cursor.fetchall()
+        connection.rollback()
+        latencies.append(time.perf_counter() - start)
+
+    connection.close()
+    return build, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--candidates', type=int, default=100)
+    parser.add_argument('--sql', action='store_true', help='also benchmark the pgvector path')
+    parser.add_argument('--index', choices=['none', 'hnsw', 'ivfflat'], default='hnsw')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    login = None
+    if args.sql:
+        from WebServer import POSTGRES_LOGIN
+        login = POSTGRES_LOGIN
+
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        vectors, semester_ids, post_ids = synthetic_corpus(size, rng)
+        queries = rng.standard_normal((args.queries, EMBEDDING_DIM), dtype=np.float32)
+
+        build, latencies = bench_local(vectors, semester_ids, post_ids, queries, args.k, args.candidates)
+        print(f"{size:>9} local          build {build:8.2f} s  {summarize(latencies)}")
+
+        if login is not None:
+            build, latencies = bench_sql(login, vectors, semester_ids, post_ids, queries, args.candidates, args.index)
+            print(f"{size:>9} sql ({args.index:<7})  build {build:8.2f} s  {summarize(latencies)}")
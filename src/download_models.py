@@ -1,11 +1,26 @@
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from sentence_transformers import SentenceTransformer
+from ModelRuntime import save_state_dict
 
 MODEL_NAME = "bansalsi/467ArxivClassification"
 TOKENIZER_NAME = "bert-base-uncased"
+SENTENCE_MODEL_NAME = "bert-base-nli-mean-tokens"
+
+# Kept in sync with WebServer.PRED_MODEL_NAME, ARXIV_STATE_DICT_PATH and SENTENCE_MODEL_PATH
+MODEL_DIR = "ArxivClassificationModel/"
+STATE_DICT_PATH = MODEL_DIR + "state_dict.pt"
+SENTENCE_MODEL_DIR = "PiazzaSentenceModel/"
+NUM_LABELS = 11
 
 if __name__ == "__main__":
     model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
     tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
-    model.save_pretrained("ArxivClassificationModel/")
+    model.save_pretrained(MODEL_DIR)
     tokenizer.save_pretrained("ArxivClassificationTokenizer/")
-    print("Model and Tokenizer downloaded from the hugging face hub")
\ No newline at end of file
+    print("Model and Tokenizer downloaded from the hugging face hub")
+
+    # Pre-serialized weights the server memory-maps at start-up
+    save_state_dict(MODEL_DIR, NUM_LABELS, STATE_DICT_PATH)
+    # A local copy, so the server does not resolve the model name through the hub cache
+    SentenceTransformer(SENTENCE_MODEL_NAME).save(SENTENCE_MODEL_DIR)
+    print("Saved the memory-mappable state dict and the sentence model")
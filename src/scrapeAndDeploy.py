@@ -1,31 +1,42 @@
 from sentence_transformers import SentenceTransformer
 import torch
 from piazza_api import Piazza
-import time
 import pickle
-import tqdm as tqdm
-import re
 
 from typing import List, Dict
 
 # Custom class to generate and execute readable SQL queries 
-from PostGresQueryGenerator import PGQuery as PGQ
+from PostGresQueryGenerator import PGQuery as PGQ, PGConnectionPool
+from VectorIndex import create_vector_index
+from BatchEncoding import SentenceBatchEncoder
+from RateLimiting import PiazzaRateLimiter
+from ScrapePipeline import ScrapePipeline, IncrementalSyncPipeline, ensureIngestSchema, completedPostIds, \
+    embeddingRows, feedUpdates, changedPostIds, bumpDataVersion, POSTS_INSERT_COLUMNS, EMBEDDINGS_INSERT_COLUMNS, \
+    CHECKPOINTS_COLUMN, DATA_VERSION_COLUMN
+from HybridSearch import SEARCH_VECTOR_COLUMN
+from SemesterPartitions import create_semester_partition, embeddings_partitioned, migrate_embeddings, name_legacy_semesters
+from CompactVectors import add_compact_vectors
 
 ''' 
 ###### DB Design #######
 "Embeddings" Table (
-  id              SERIAL          PRIMARY KEY, 
+  id              SERIAL, 
   embedding       vector(768)     NOT NULL, 
   semester_id     INT             NOT NULL, 
   post_id         INT             NOT NULL,
+  sentence_hash   TEXT,
+  embedding_half  halfvec(768)    GENERATED ALWAYS AS (embedding::halfvec(768)) STORED,      -- optional, COMPACT_VECTORS
+  embedding_bits  bit(768)        GENERATED ALWAYS AS (binary_quantize(embedding)) STORED,   -- optional, COMPACT_VECTORS
+  PRIMARY KEY(semester_id, id),
   FOREIGN KEY(semester_id) REFERENCES Semesters(semester_id),
   FOREIGN KEY(semester_id, post_id) REFERENCES Posts(semester_id, post_id),
-)
+) PARTITION BY LIST (semester_id)     -- one partition per semester, embeddings_s<semester_id>
 
 "Semesters" Table (
   semester_id             SERIAL          PRIMARY KEY,
   semester_name           VARCHAR(255),
   semester_piazza_code    TEXT            UNIQUE,
+  ingest_complete         BOOLEAN         NOT NULL DEFAULT FALSE,
  )
 
 "Posts" Table (
@@ -35,15 +46,21 @@ from PostGresQueryGenerator import PGQuery as PGQ
   post_content        TEXT,
   instructor_answer   TEXT,
   student_answer      TEXT,
+  content_hash        TEXT,
+  piazza_updated      TEXT,
+  search_vector       TSVECTOR    GENERATED ALWAYS AS (title A, content B, answers C) STORED,
   PRIMARY KEY(semester_id, post_id),
 )
 '''
 
+# A partitioned table's primary key has to include the partition key
 EMBEDDINGS_COLUMN = [
-                    'id SERIAL PRIMARY KEY', 
+                    'id SERIAL', 
                     'embedding vector(768) NOT NULL', 
                     'semester_id INT NOT NULL', 
                     'post_id INT NOT NULL',
+                    'sentence_hash TEXT',
+                    'PRIMARY KEY(semester_id, id)',
                     'FOREIGN KEY(semester_id) REFERENCES Semesters(semester_id)',
                     'FOREIGN KEY(semester_id, post_id) REFERENCES Posts(semester_id, post_id)'
                     ]
@@ -51,7 +68,8 @@ EMBEDDINGS_COLUMN = [
 SEMESTERS_COLUMN = [
                     'semester_id SERIAL PRIMARY KEY', 
                     'semester_name VARCHAR(255)', 
-                    'semester_piazza_code TEXT UNIQUE'
+                    'semester_piazza_code TEXT UNIQUE',
+                    'ingest_complete BOOLEAN NOT NULL DEFAULT FALSE'
                     ]
 
 POSTS_COLUMN = [
@@ -61,10 +79,15 @@ POSTS_COLUMN = [
                 'post_content TEXT',
                 'instructor_answer TEXT', 
                 'student_answer TEXT',
+                'content_hash TEXT',
+                'piazza_updated TEXT',
+                SEARCH_VECTOR_COLUMN,
                 'PRIMARY KEY(semester_id, post_id)'
                 ]
 
 TABLES = {
+        'IngestCheckpoints' : CHECKPOINTS_COLUMN,
+        'DataVersion' : DATA_VERSION_COLUMN,
         'Embeddings'  : EMBEDDINGS_COLUMN, 
         'Semesters'   : SEMESTERS_COLUMN, 
         'Posts'       : POSTS_COLUMN
@@ -80,6 +103,18 @@ PG_LOGIN = {
     'port'      : '5432',
 }
 
+# ANN index built on Embeddings.embedding when the tables are created.
+# HNSW is maintained on insert; for IVFFlat run `python VectorIndex.py create ivfflat` after loading instead.
+VECTOR_INDEX_METHOD = 'hnsw'
+
+# Embeddings is partitioned by semester (see SemesterPartitions). A flat Embeddings table
+# from an older database is migrated on the next run, in one transaction.
+PARTITION_EMBEDDINGS = True
+
+# Compact copies of the embeddings for WebServer.VECTOR_QUANTIZATION, each with its own
+# index: 'halfvec' and/or 'binary' (see CompactVectors). Postgres computes them on insert.
+COMPACT_VECTORS = []
+
 RUN_DATABASE_INTIALIZATION = False
 CREATE_NEW_TABLES = False or RUN_DATABASE_INTIALIZATION
 
@@ -92,6 +127,160 @@ def piazzaLogIn() -> Piazza:
     piazza_obj.user_login(email=EMAIL, password=PASSWORD) 
     return piazza_obj
 
+# Encoding batch size used by the embed stage and by re-embedding
+ENCODE_BATCH_SIZE = 64
+
+# Semester ids whose embeddings are recomputed from the stored Posts on the next run
+REEMBED_SEMESTER_IDS = []
+
+# Piazza request pacing, see RateLimiting.DEFAULT_RATE_LIMIT for the keys.
+# 'default' applies to every network, entries keyed by network nid override it.
+PIAZZA_RATE_LIMITS = {
+    'default' : {'rate_per_minute': 10, 'burst': 3},
+}
+
+# Semesters already loaded are re-synced: only posts whose feed entry changed are fetched again
+INCREMENTAL_SYNC = True
+
+# Post ids tried in every semester
+MIN_POST_ID = 5
+MAX_POST_ID = 1000
+
+def reembedSemester(SQL: PGQ, sentence_encoder: SentenceBatchEncoder, semester_id: int, window: int = 500):
+    '''
+    Replaces the Embeddings of a semester with freshly encoded ones from its stored Posts,
+    in one transaction, streaming and encoding `window` posts per batched pass.
+    '''
+    autocommit = SQL.connection.autocommit
+    SQL.connection.autocommit = False
+    try:
+        SQL.DELETE_FROM('Embeddings').WHERE(f'semester_id = {PGQ.toInt(semester_id)}').execute_nofetch()
+        posts = SQL.SELECT(
+            POSTS_INSERT_COLUMNS
+            ).FROM(
+                ['Posts']
+            ).WHERE(
+                'semester_id = %s', [semester_id]
+            ).ORDER_BY(
+                ['post_id']
+            ).execute_stream(itersize=window, batches=True)
+
+        post_count = 0
+        for window_posts in posts:
+            SQL.copy_rows('Embeddings', EMBEDDINGS_INSERT_COLUMNS, embeddingRows(sentence_encoder, window_posts))
+            post_count += len(window_posts)
+        bumpDataVersion(SQL)
+        SQL.commit()
+        print(f"Re-embedded {post_count} posts of semester {semester_id}")
+    finally:
+        SQL.connection.autocommit = autocommit
+
+def piazzaRateLimiter(semester_nid: str) -> PiazzaRateLimiter:
+    config = dict(PIAZZA_RATE_LIMITS.get('default', {}))
+    config.update(PIAZZA_RATE_LIMITS.get(semester_nid, {}))
+    return PiazzaRateLimiter.from_config(semester_nid, config)
+
+def ingestSemester(SQL: PGQ, piazza_obj, sentence_encoder: SentenceBatchEncoder, semester_nid: str,
+                   semester_class_name: str, post_ids: List[int] = None):
+    '''
+    Runs the fetch -> clean -> embed -> load pipeline for one semester.
+    A semester whose Semesters row exists but is not marked ingest_complete is resumed
+    from its IngestCheckpoints instead of being skipped.
+    '''
+    post_ids = range(MIN_POST_ID, MAX_POST_ID) if post_ids is None else post_ids
+
+    # Checking if the semester already exists in the database
+    semester = SQL.SELECT(
+                ['semester_id', 'ingest_complete']
+                ).FROM(
+                    ['Semesters']
+                ).WHERE(
+                    f'semester_piazza_code = {PGQ.toString(semester_nid)}'
+                ).execute_fetch()
+
+    if semester and semester[0][1]:
+        if INCREMENTAL_SYNC:
+            syncSemester(SQL, piazza_obj, sentence_encoder, semester_nid, semester[0][0])
+        else:
+            print("Semester data already acquired")
+        return
+
+    if not semester:
+        # Loading the semester infromation into the database
+        SQL.INSERT_INTO(
+            'Semesters', 
+            ('semester_name', 'semester_piazza_code')
+            ).VALUES([
+                    (PGQ.toString(semester_class_name + semester_nid), PGQ.toString(semester_nid))
+            ]).execute_nofetch()
+        SQL.commit()
+
+        # Getting Semester ID from the database
+        semester = SQL.SELECT(
+            ['semester_id', 'ingest_complete']
+            ).FROM(
+                ['Semesters']
+            ).WHERE(
+                f'semester_piazza_code = {PGQ.toString(semester_nid)}'
+            ).execute_fetch()
+    semester_id = semester[0][0]
+    if PARTITION_EMBEDDINGS:
+        create_semester_partition(SQL, semester_id)
+        SQL.commit()
+
+    done = completedPostIds(SQL, semester_id)
+    remaining = [post_id for post_id in post_ids if post_id not in done]
+    print(f"Semester {semester_class_name}: {len(done)} posts done, {len(remaining)} to fetch")
+
+    rate_limiter = piazzaRateLimiter(semester_nid)
+    network = piazza_obj.network(semester_nid)
+    rate_limiter.acquire()
+    updates = feedUpdates(network)
+
+    pipeline = ScrapePipeline(
+        network,
+        SQL,
+        sentence_encoder,
+        semester_id,
+        remaining,
+        rate_limiter=rate_limiter,
+        reconnect=lambda: piazzaLogIn().network(semester_nid),
+        updates=updates,
+    )
+    print(pipeline.run())
+
+    done = completedPostIds(SQL, semester_id)
+    if all(post_id in done for post_id in post_ids):
+        SQL.UPDATE('Semesters').SET(['ingest_complete = TRUE']).WHERE(f'semester_id = {PGQ.toInt(semester_id)}').execute_nofetch()
+        SQL.commit()
+        print("Semester ingestion complete")
+
+def syncSemester(SQL: PGQ, piazza_obj, sentence_encoder: SentenceBatchEncoder, semester_nid: str, semester_id: int):
+    '''
+    Brings a fully loaded semester up to date: reads the feed once, refetches the posts
+    whose update time changed and re-embeds only their new sentences.
+    '''
+    rate_limiter = piazzaRateLimiter(semester_nid)
+    network = piazza_obj.network(semester_nid)
+    rate_limiter.acquire()
+    updates = feedUpdates(network)
+    changed = changedPostIds(SQL, semester_id, updates)
+    print(f"Semester {semester_nid}: {len(changed)} of {len(updates)} posts changed")
+    if not changed:
+        return
+
+    pipeline = IncrementalSyncPipeline(
+        network,
+        SQL,
+        sentence_encoder,
+        semester_id,
+        changed,
+        updates,
+        rate_limiter=rate_limiter,
+        reconnect=lambda: piazzaLogIn().network(semester_nid),
+    )
+    print(pipeline.run())
+
 def get360Classes(piazza_obj):
     csci360nid = []
     for i in piazza_obj.get_user_classes():
@@ -102,6 +291,7 @@ def get360Classes(piazza_obj):
 if __name__ == "__main__":
 
     encoder = SentenceTransformer('bert-base-nli-mean-tokens')
+    sentence_encoder = SentenceBatchEncoder(encoder, batch_size=ENCODE_BATCH_SIZE)
     if RUN_DATABASE_INTIALIZATION:
         print("Initializing db")
         SQL = PGQ()
@@ -122,8 +312,8 @@ if __name__ == "__main__":
         2. Add the vector extension to the database if intialization is required
     '''
     PG_LOGIN['dbname'] = DATABASE_NAME
-    SQL = PGQ()
-    SQL.login(PG_LOGIN)
+    pg_pool = PGConnectionPool(PG_LOGIN, min_size=1, max_size=2, name='scraper')
+    SQL = PGQ(pg_pool.getconn())
     SQL.toggleAutoCommit()
     print("Logging in")
     if RUN_DATABASE_INTIALIZATION:
@@ -164,153 +354,49 @@ if __name__ == "__main__":
 
         '''
         "Embeddings" Table (
-        id              SERIAL          PRIMARY KEY, 
+        id              SERIAL, 
         embedding       vector(768)     NOT NULL, 
         semester_id     INT             NOT NULL, 
         post_id         INT             NOT NULL,
+        PRIMARY KEY(semester_id, id),
         FOREIGN KEY(semester_id) REFERENCES Semesters(semester_id),
         FOREIGN KEY(semester_id, post_id) REFERENCES Posts(semester_id, post_id),
-        )
+        ) PARTITION BY LIST (semester_id)
         '''
-        SQL.CREATE_TABLE('Embeddings', EMBEDDINGS_COLUMN).execute_nofetch()
+        if PARTITION_EMBEDDINGS:
+            SQL.CREATE_TABLE('Embeddings', EMBEDDINGS_COLUMN).PARTITION_BY('LIST', ['semester_id']).execute_nofetch()
+        else:
+            SQL.CREATE_TABLE('Embeddings', EMBEDDINGS_COLUMN).execute_nofetch()
+        if VECTOR_INDEX_METHOD == 'hnsw':
+            create_vector_index(SQL, VECTOR_INDEX_METHOD)
         
         SQL.commit()
         print("Created new tables")
 
+    # Checkpoint and data version tables, ingest_complete flag and content hashes, also on databases created before they existed
+    ensureIngestSchema(SQL)
+    if PARTITION_EMBEDDINGS and not embeddings_partitioned(SQL):
+        migrate_embeddings(SQL, EMBEDDINGS_COLUMN, VECTOR_INDEX_METHOD)
+    # The first semesters keep the names the responses gave them before Semesters.semester_name did
+    name_legacy_semesters(SQL)
+    for quantization in COMPACT_VECTORS:
+        add_compact_vectors(SQL, quantization, VECTOR_INDEX_METHOD)
+
+    for semester_id in REEMBED_SEMESTER_IDS:
+        reembedSemester(SQL, sentence_encoder, semester_id)
+
     '''
         1. Load data directly from Piazza
         2. Clean the data
         3. Encode the data
         4. Insert the data into the database
     '''
-    FILTER_HTML_TAGS = r'<[^>]*>'
     piazza_obj = piazzaLogIn()
     classNidArr = get360Classes(piazza_obj) # Getting all of the nid's for 360
     for semester_nid, semester_class_name in classNidArr:
-        
-        # Checking if the semester already exists in the database
-        # Avoid overwriting if that is the case
-        exists = SQL.SELECT(
-                    ['*']
-                    ).FROM(
-                        ['Semesters']
-                    ).WHERE(
-                        f'semester_piazza_code = {PGQ.toString(semester_nid)}'
-                    ).execute_fetch()
-    
-        if len(exists) != 0:
-            print("Semester data already acquired")
-            continue
+        ingestSemester(SQL, piazza_obj, sentence_encoder, semester_nid, semester_class_name)
+    # Again for the semesters this run created
+    name_legacy_semesters(SQL)
 
-        # Loading the semester infromation into the database
-        class_network = piazza_obj.network(semester_nid)
-
-        SQL.INSERT_INTO(
-            'Semesters', 
-            ('semester_name', 'semester_piazza_code')
-            ).VALUES([
-                    (PGQ.toString(semester_class_name + semester_nid), PGQ.toString(semester_nid))
-            ]).execute_nofetch()
-        
-        SQL.commit()
-        # Getting Semester ID from the database
-        semester_id = SQL.SELECT(
-            ['semester_id']
-            ).FROM(
-                ['Semesters']
-            ).WHERE(
-                f'semester_piazza_code = {PGQ.toString(semester_nid)}'
-            ).execute_fetch()[0][0]    
-        
-        ######### Iterate through all of the posts in the semester and add them to the database #########
-        minn = 5
-        maxx = 1000
-        myClass = piazza_obj.network(semester_nid)
-        for post_num in tqdm.tqdm(range(minn, maxx)):
-            try:
-
-                ######## Post Filtering ########
-                post = myClass.get_post(post_num)    
-                if 'regrade' in post['folders'] or post['status'] == 'private':
-                    continue
-
-                title = ''
-                content = ''
-                instructor_answer = ''
-                student_answer = ''
-
-                if 'history' in post and post['history']:
-                    if 'subject' in post['history'][0]:
-                        title = post['history'][0]['subject']
-                    
-                    if 'content' in post['history'][0]:
-                        content = post['history'][0]['content']
-                
-                if 'children' in post:
-                    for child_post in post['children']:
-                        if 'type' in child_post and child_post['type'] == 'i_answer':
-                            instructor_answer = ' ' + child_post['history'][0]['content']
-                            if len(student_answer) > 0:
-                                break
-
-                        elif child_post['type'] == 's_answer' and child_post['is_tag_endorse']:
-                            student_answer = child_post['history'][0]['content']
-                            if len(instructor_answer) > 0:
-                                break
-
-                ######## DATABASE INSERTION ########
-                # Remvoing HTML tags and trailing whitespace from the data
-                cleaned_question = re.sub(FILTER_HTML_TAGS, '', title.strip())
-                cleaned_question_content = re.sub(FILTER_HTML_TAGS, '', content.strip())
-                cleaned_instructor_answer = re.sub(FILTER_HTML_TAGS, '', instructor_answer.strip())
-                cleaned_student_answer = re.sub(FILTER_HTML_TAGS, '', student_answer.strip())
-
-                # Encoding the cleaned data
-                encoded_question = encoder.encode(cleaned_question)
-                sentence_encoded_content = [encoder.encode(sentence) for sentence in cleaned_question_content.split('.') if len(sentence) > 20]
-                sentence_encoded_instructor_answer = [encoder.encode(sentence) for sentence in cleaned_instructor_answer.split('.') if len(sentence) > 20]
-                sentence_encoded_student_answer = [encoder.encode(sentence) for sentence in cleaned_student_answer.split('.') if len(sentence) > 20]
-
-                # Making an entry containing entire post information
-                SQL.INSERT_INTO('Posts', ('semester_id', 'post_id', 'post_title', 'post_content', 'instructor_answer', 'student_answer'))\
-                    .VALUES([(str(semester_id), PGQ.toInt(post_num), PGQ.toString(cleaned_question), PGQ.toString(cleaned_question_content), 
-                            PGQ.toString(cleaned_instructor_answer), PGQ.toString(cleaned_student_answer))])\
-                        .execute_nofetch()
-                
-                # Making multiple vector embedding entries for Question + each sentence in the post
-                SQL.INSERT_INTO('Embeddings', ('embedding', 'semester_id', 'post_id'))\
-                    .VALUES([(PGQ.toVector(encoded_question), PGQ.toInt(semester_id), PGQ.toInt(post_num))])\
-                        .execute_nofetch()
-                
-                for embedding in sentence_encoded_content:
-                    SQL.INSERT_INTO('Embeddings', ('embedding', 'semester_id', 'post_id'))\
-                    .VALUES([(PGQ.toVector(embedding), PGQ.toInt(semester_id), PGQ.toInt(post_num))])\
-                        .execute_nofetch()
-                
-                for embedding in sentence_encoded_instructor_answer:
-                    SQL.INSERT_INTO('Embeddings', ('embedding', 'semester_id', 'post_id'))\
-                    .VALUES([(PGQ.toVector(embedding), PGQ.toInt(semester_id), PGQ.toInt(post_num))])\
-                        .execute_nofetch()
-                
-                for embedding in sentence_encoded_student_answer:
-                    SQL.INSERT_INTO('Embeddings', ('embedding', 'semester_id', 'post_id'))\
-                    .VALUES([(PGQ.toVector(embedding), PGQ.toInt(semester_id), PGQ.toInt(post_num))])\
-                        .execute_nofetch()
-
-                SQL.commit()
-
-                ####### Sleeping to avoid getting blocked by Piazza #######
-                if post_num%10 == 0:
-                    time.sleep(60 * 15) # seconds * minutes
-                    piazza_obj = piazzaLogIn()
-                    myClass = piazza_obj.network(semester_nid)
-                else:
-                    time.sleep(60 * 1)
-                    myClass = piazza_obj.network(semester_nid)
-            except:
-                print("Error with post: ", post_num)
-                time.sleep(60 * 10)
-                myClass = piazza_obj.network(semester_nid)
-                continue
-
-        ############################################################
+    pg_pool.putconn(SQL.connection)
+    pg_pool.closeall()
@@ -0,0 +1,22 @@
+import numpy as np
+
+from EmbeddingCache import EmbeddingCache
+
+
+def test_misses_encode_the_original_text():
+    encoded = []
+
+    def encode(texts):
+        encoded.extend(texts)
+        return [np.full(4, len(text), dtype=np.float32) for text in texts]
+
+    cache = EmbeddingCache(encode, max_wait_ms=0, name='test_original_text')
+    try:
+        first = cache.get('How do I   submit HW1?')
+        # A variant of the same query is answered with the first one's embedding
+        assert cache.get('how do i submit hw1') is first
+    finally:
+        cache._batcher.close()
+
+    assert encoded == ['How do I   submit HW1?']
+    assert cache.hits.value == 1
@@ -0,0 +1,38 @@
+import pytest
+
+import HybridSearch
+from HybridSearch import hybrid_search
+
+KEYS = [(1, post_id) for post_id in range(1, 7)]
+
+
+@pytest.fixture
+def candidates(monkeypatch):
+    """
+    Lexical hits KEYS, best first, with the similarities the test sets.
+    """
+    similarities = {}
+    monkeypatch.setattr(HybridSearch, 'lexical_candidates', lambda SQL, query, limit, semester_ids=None: list(KEYS))
+    monkeypatch.setattr(HybridSearch, 'score_candidates', lambda SQL, query_embedding, keys: dict(similarities))
+    return similarities
+
+
+def test_hybrid_search_fuses_the_similar_lexical_hits(candidates):
+    candidates.update({key: 0.9 - 0.01 * i for i, key in enumerate(KEYS)})
+    candidates[KEYS[0]] = 0.1
+
+    hits = hybrid_search(None, 'query', None, limit=10, min_lexical_hits=5, min_similarity=0.75)
+
+    assert [(semester_id, post_id) for semester_id, post_id, _ in hits] == KEYS[1:]
+
+
+def test_hybrid_search_falls_back_when_the_hits_are_not_similar(candidates):
+    candidates.update({key: 0.3 for key in KEYS})
+
+    assert hybrid_search(None, 'query', None, limit=10, min_lexical_hits=5, min_similarity=0.75) is None
+
+
+def test_hybrid_search_falls_back_with_few_lexical_hits(candidates):
+    candidates.update({key: 0.9 for key in KEYS})
+
+    assert hybrid_search(None, 'query', None, limit=10, min_lexical_hits=7) is None
@@ -0,0 +1,136 @@
+import numpy as np
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from LocalVectorIndex import LocalVectorIndex
+
+DIM = 8
+
+
+class FakeSQL(PGQ):
+    """
+    An Embeddings table and its DataVersion, answering the queries of LocalVectorIndex.refresh.
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self.rows = {}
+        self.version = 0
+        self.next_id = 1
+        self.streams = 0
+
+    def insert(self, semester_id: int, post_id: int, vector) -> int:
+        row_id, self.next_id = self.next_id, self.next_id + 1
+        self.rows[row_id] = (semester_id, post_id, np.asarray(vector, dtype=np.float32))
+        self.version += 1
+        return row_id
+
+    def delete(self, row_ids):
+        for row_id in row_ids:
+            del self.rows[row_id]
+        self.version += 1
+
+    def execute_fetch(self, raise_errors=False):
+        sql, params = self.query_string(), self.params
+        self.clear()
+        if 'DataVersion' in sql:
+            return [(self.version,)]
+        ids = [row_id for row_id in self.rows if row_id <= params[0]]
+        return [(len(ids), sum(ids))]
+
+    def execute_stream(self, itersize=1000, decode_vectors=False, batches=False):
+        after = self.params[0]
+        self.clear()
+        self.streams += 1
+        rows = [(row_id,) + self.rows[row_id] for row_id in sorted(self.rows) if row_id > after]
+        for first in range(0, len(rows), itersize):
+            yield rows[first:first + itersize]
+
+    def rollback(self):
+        return self
+
+
+def unit(axis: int):
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[axis] = 1.0
+    return vector
+
+
+def found_posts(index, axis: int):
+    return [(semester_id, post_id) for semester_id, post_id, _ in index.search(unit(axis), k=10, threshold=0.5)]
+
+
+def test_refresh_appends_new_rows_and_skips_an_unchanged_version():
+    SQL = FakeSQL()
+    SQL.insert(1, 1, unit(0))
+    index = LocalVectorIndex(dim=DIM)
+    assert index.refresh(SQL) == 1
+
+    assert index.refresh(SQL) == 0
+    assert SQL.streams == 1
+
+    SQL.insert(1, 2, unit(1))
+    assert index.refresh(SQL) == 1
+    assert index.size == 2
+    assert found_posts(index, 1) == [(1, 2)]
+
+
+def test_refresh_drops_deleted_rows():
+    SQL = FakeSQL()
+    kept = SQL.insert(1, 1, unit(0))
+    gone = SQL.insert(1, 2, unit(1))
+    index = LocalVectorIndex(dim=DIM)
+    index.refresh(SQL)
+
+    # A post that turned private, or a detached semester
+    SQL.delete([gone])
+    index.refresh(SQL)
+
+    assert index.size == 1
+    assert found_posts(index, 1) == []
+    assert found_posts(index, 0) == [(1, 1)]
+    assert kept in SQL.rows
+
+
+def test_refresh_replaces_reembedded_rows():
+    SQL = FakeSQL()
+    old = SQL.insert(1, 1, unit(0))
+    SQL.insert(1, 2, unit(2))
+    index = LocalVectorIndex(dim=DIM)
+    index.refresh(SQL)
+
+    # Re-embedding deletes the post's rows and inserts new ones with higher ids
+    SQL.delete([old])
+    SQL.insert(1, 1, unit(1))
+    index.refresh(SQL)
+
+    assert index.size == 2
+    assert found_posts(index, 0) == []
+    assert found_posts(index, 1) == [(1, 1)]
+
+
+def test_refresh_picks_up_rows_with_old_ids(tmp_path):
+    SQL = FakeSQL()
+    first = SQL.insert(1, 1, unit(0))
+    SQL.insert(2, 1, unit(1))
+    detached = SQL.rows.pop(first)
+    index = LocalVectorIndex(dim=DIM, mmap_path=str(tmp_path / 'index.f32'))
+    index.refresh(SQL)
+
+    # Attaching a semester back brings rows below the last id loaded
+    SQL.rows[first] = detached
+    SQL.version += 1
+    index.refresh(SQL)
+
+    assert index.size == 2
+    assert found_posts(index, 0) == [(1, 1)]
+
+
+def test_search_within_semesters():
+    index = LocalVectorIndex(dim=DIM)
+    index.add(np.stack([unit(0), unit(0) + 0.5 * unit(1), unit(1)]), [1, 2, 2], [10, 20, 21])
+
+    assert [hit[:2] for hit in index.search(unit(0), k=3, semester_ids=(2,))] == [(2, 20), (2, 21)]
+    assert [hit[:2] for hit in index.search(unit(0), k=3, candidates=1, semester_ids=(1,))] == [(1, 10)]
+    assert index.search(unit(0), k=3, semester_ids=(3,)) == []
+    # The stored matrix is not touched by the masking
+    assert [hit[:2] for hit in index.search(unit(0), k=1)] == [(1, 10)]
@@ -0,0 +1,21 @@
+import pytest
+
+from MicroBatching import InferenceBatcher
+
+
+def lengths(texts):
+    if not all(isinstance(text, str) for text in texts):
+        raise TypeError("expected strings")
+    return [len(text) for text in texts]
+
+
+def test_bad_item_fails_only_its_own_future():
+    batcher = InferenceBatcher(lengths, max_batch_size=8, max_wait_ms=200, name='test_bad_item')
+    try:
+        futures = [batcher.submit(item) for item in ['a', 'bb', None, 'dddd']]
+        with pytest.raises(TypeError):
+            futures[2].result(10)
+        assert [futures[i].result(10) for i in (0, 1, 3)] == [1, 2, 4]
+        assert batcher.batch_retries.value >= 1
+    finally:
+        batcher.close()
@@ -0,0 +1,124 @@
+import re
+import numpy as np
+
+from PostGresQueryGenerator import PreparedStatementCache, number_placeholders
+
+PREPARE = re.compile(r'PREPARE (\w+) AS ')
+DEALLOCATE = re.compile(r'DEALLOCATE (\w+);')
+
+
+class FakeConnection:
+    """
+    A session's prepared statements, as pg_prepared_statements would list them.
+    """
+
+    def __init__(self):
+        self.prepared = set()
+
+
+class FakeCursor:
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+        self.executed = []
+        self._row = None
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        if sql.startswith('SELECT 1 FROM pg_prepared_statements'):
+            self._row = (1,) if params[0] in self.connection.prepared else None
+        elif sql.startswith('PREPARE'):
+            name = PREPARE.match(sql).group(1)
+            assert name not in self.connection.prepared, f"{name} prepared twice"
+            self.connection.prepared.add(name)
+        elif sql.startswith('DEALLOCATE'):
+            self.connection.prepared.remove(DEALLOCATE.match(sql).group(1))
+        elif sql.startswith('EXECUTE'):
+            assert sql.split()[1].rstrip(';') in self.connection.prepared
+
+    def fetchone(self):
+        return self._row
+
+    def statements(self, prefix: str) -> list:
+        return [sql for sql, _ in self.executed if sql.startswith(prefix)]
+
+
+def test_repeated_parameter_object_is_bound_once():
+    vector = np.ones(3, dtype=np.float32)
+    statement, values = number_placeholders(
+        'SELECT 1 - (embedding <=> %s) FROM Embeddings WHERE semester_id = %s ORDER BY embedding <=> %s', [vector, 4, vector]
+    )
+
+    assert statement == 'SELECT 1 - (embedding <=> $1) FROM Embeddings WHERE semester_id = $2 ORDER BY embedding <=> $1'
+    assert len(values) == 2 and values[0] is vector and values[1] == 4
+
+
+def test_equal_but_distinct_objects_get_their_own_numbers():
+    statement, values = number_placeholders('SELECT %s, %s', [[1.0, 2.0], [1.0, 2.0]])
+
+    assert statement == 'SELECT $1, $2'
+    assert len(values) == 2
+
+
+def test_escaped_percent_is_unescaped_and_consumes_no_parameter():
+    statement, values = number_placeholders("SELECT post_title LIKE '50%%' OR post_id = %s", [7])
+
+    assert statement == "SELECT post_title LIKE '50%' OR post_id = $1"
+    assert values == [7]
+
+
+def test_statement_is_prepared_once_per_connection():
+    cache = PreparedStatementCache()
+    connection = FakeConnection()
+    cursor = FakeCursor(connection)
+    hits, misses = cache.hits.value, cache.misses.value
+
+    for post_id in (1, 2, 3):
+        cache.execute(connection, cursor, 'SELECT * FROM Posts WHERE post_id = %s', [post_id])
+
+    assert len(cursor.statements('PREPARE')) == 1
+    assert [params for sql, params in cursor.executed if sql.startswith('EXECUTE')] == [[1], [2], [3]]
+    assert (cache.hits.value - hits, cache.misses.value - misses) == (2, 1)
+
+    # Another session prepares its own copy
+    other = FakeConnection()
+    cache.execute(other, FakeCursor(other), 'SELECT * FROM Posts WHERE post_id = %s', [1])
+    assert len(other.prepared) == 1
+
+
+def test_least_recently_used_statement_is_deallocated():
+    cache = PreparedStatementCache(per_connection=2)
+    connection = FakeConnection()
+    cursor = FakeCursor(connection)
+    evictions = cache.evictions.value
+
+    for column in ('a', 'b', 'a', 'c'):
+        cache.execute(connection, cursor, f'SELECT {column} FROM Posts WHERE post_id = %s', [1])
+
+    # 'b' was used least recently when 'c' needed room
+    assert len(cursor.statements('DEALLOCATE')) == 1
+    assert cache.evictions.value - evictions == 1
+    assert len(connection.prepared) == 2
+    assert cache.stats()['statements'] == 2
+
+    # Using 'b' again prepares it again, in place of 'a'
+    cache.execute(connection, cursor, 'SELECT b FROM Posts WHERE post_id = %s', [1])
+    assert len(cursor.statements('PREPARE')) == 4
+    assert len(connection.prepared) == 2
+
+
+def test_statement_still_on_the_server_is_not_prepared_again():
+    connection = FakeConnection()
+    cursor = FakeCursor(connection)
+    PreparedStatementCache().execute(connection, cursor, 'SELECT * FROM Posts WHERE post_id = %s', [1])
+
+    # A cache that lost track of the connection's statements (e.g. a failure right after PREPARE)
+    fresh = PreparedStatementCache()
+    fresh.execute(connection, cursor, 'SELECT * FROM Posts WHERE post_id = %s', [2])
+
+    assert len(cursor.statements('PREPARE')) == 1
+    assert len(cursor.statements('EXECUTE')) == 2
+
+    # Once the server has dropped it, the next miss prepares it again
+    connection.prepared.clear()
+    PreparedStatementCache().execute(connection, cursor, 'SELECT * FROM Posts WHERE post_id = %s', [3])
+    assert len(cursor.statements('PREPARE')) == 2
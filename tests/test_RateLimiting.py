@@ -0,0 +1,28 @@
+from RateLimiting import PiazzaRateLimiter
+
+
+def make_limiter(name: str, slept: list) -> PiazzaRateLimiter:
+    return PiazzaRateLimiter(name, rate_per_minute=60, burst=10, min_rate_per_minute=1,
+                             backoff_base_seconds=2, backoff_max_seconds=8, sleep=slept.append)
+
+
+def test_failure_halves_the_rate_and_backs_off():
+    slept = []
+    limiter = make_limiter('test_backoff', slept)
+
+    delay = limiter.failure(0)
+
+    assert limiter.rate_per_minute == 30
+    assert limiter.errors_counter.value == 1
+    assert slept == [delay] and 1 <= delay <= 2
+
+
+def test_last_failure_is_counted_without_sleeping():
+    slept = []
+    limiter = make_limiter('test_last_failure', slept)
+
+    assert limiter.failure(3, backoff=False) == 0.0
+
+    assert limiter.rate_per_minute == 30
+    assert limiter.errors_counter.value == 1
+    assert slept == []
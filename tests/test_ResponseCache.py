@@ -0,0 +1,82 @@
+from ResponseCache import ResponseCache, DataVersionPoller, ENTRY_OVERHEAD_BYTES
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def entry_bytes(key, body: bytes) -> int:
+    return len(body) + len(repr(key)) + ENTRY_OVERHEAD_BYTES
+
+
+def test_newer_version_flushes_the_cache():
+    cache = ResponseCache(name='test_version_flush')
+    cache.put(('a',), 1, b'old a')
+    cache.put(('b',), 1, b'old b')
+    assert cache.get(('a',), 1) == b'old a'
+
+    assert cache.get(('a',), 2) is None
+    assert cache.stats()['entries'] == 0 and cache.bytes == 0
+    assert cache.invalidations.value == 1
+
+    cache.put(('a',), 2, b'new a')
+    assert cache.get(('a',), 2) == b'new a'
+
+
+def test_older_version_neither_flushes_nor_is_stored():
+    cache = ResponseCache(name='test_older_version')
+    cache.put(('a',), 2, b'new a')
+
+    # A request that read the version before the bump: a miss, and its result is not kept
+    assert cache.get(('a',), 1) is None
+    cache.put(('b',), 1, b'old b')
+
+    assert cache.get(('a',), 2) == b'new a'
+    assert cache.get(('b',), 2) is None
+    assert cache.version == 2
+
+
+def test_entries_expire_after_the_ttl():
+    clock = FakeClock()
+    cache = ResponseCache(ttl_seconds=60, name='test_ttl', clock=clock)
+    cache.put(('a',), 1, b'a')
+
+    clock.now += 59
+    assert cache.get(('a',), 1) == b'a'
+    clock.now += 2
+    assert cache.get(('a',), 1) is None
+    assert cache.expirations.value == 1
+    assert cache.stats()['entries'] == 0 and cache.bytes == 0
+
+
+def test_least_recently_used_entries_are_evicted_over_the_budget():
+    body = b'x' * 100
+    cache = ResponseCache(max_bytes=3 * entry_bytes(('a',), body), name='test_budget')
+    for key in ('a', 'b', 'c'):
+        cache.put((key,), 1, body)
+    # 'a' becomes the most recently used
+    assert cache.get(('a',), 1) == body
+
+    cache.put(('d',), 1, body)
+
+    assert cache.get(('b',), 1) is None
+    assert all(cache.get((key,), 1) == body for key in ('a', 'c', 'd'))
+    assert cache.evictions.value == 1
+    assert cache.bytes == 3 * entry_bytes(('a',), body) <= cache.max_bytes
+
+
+def test_data_version_is_unknown_after_a_failed_read():
+    versions = iter([3])
+
+    def read_version():
+        return next(versions)
+
+    poller = DataVersionPoller(read_version, interval=3600)
+    poller.poll()
+    assert poller.version == 3
+    poller.poll()
+    assert poller.version is None
@@ -0,0 +1,257 @@
+import re
+import threading
+import numpy as np
+import pytest
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from RateLimiting import PiazzaRateLimiter
+from FakePiazza import FakePiazzaNetwork, FakeRequestError, makeFakePiazza
+from ScrapePipeline import ScrapePipeline, completedPostIds, changedPostIds, feedUpdates, CHECKPOINT_FAILED, \
+    CHECKPOINT_LOADED, CHECKPOINT_SKIPPED, MAX_FETCH_ATTEMPTS
+
+CHECKPOINT_VALUES = re.compile(r"\((\d+), (\d+), '(\w+)', (?:'([^']*)'|NULL)\)")
+# A pipeline that hangs fails the test instead of the run
+RUN_TIMEOUT_SECONDS = 30
+
+
+class FakeConnection:
+    def __init__(self, sql):
+        self.sql = sql
+        self.autocommit = False
+
+    def commit(self):
+        self.sql.apply()
+
+    def rollback(self):
+        if self.sql.dropped:
+            raise ConnectionError("connection already closed")
+        self.sql.pending = []
+
+
+class FakeSQL(PGQ):
+    """
+    The writes and reads of ScrapePipeline and completedPostIds, kept in memory with
+    transactions: a batch shows up only once committed.
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self.connection = FakeConnection(self)
+        self.posts = {}
+        self.embeddings = []
+        self.checkpoints = {}
+        # post_id -> the feed time written with its checkpoint
+        self.checkpoint_updates = {}
+        self.pending = []
+        self.fail_writes = False
+        self.dropped = False
+        # Writes start failing after this many commits, like a connection lost mid-run
+        self.fail_after_commits = None
+        self.commits = 0
+
+    def copy_rows(self, table_name, columns, rows, binary=True):
+        if self.fail_writes:
+            raise ConnectionError("server closed the connection unexpectedly")
+        self.pending.append((table_name, list(rows)))
+        return {}
+
+    def execute_nofetch(self, raise_errors=False):
+        sql = self.query_string()
+        self.clear()
+        if self.fail_writes:
+            raise ConnectionError("server closed the connection unexpectedly")
+        if sql.startswith('INSERT INTO IngestCheckpoints'):
+            self.pending.append(('IngestCheckpoints', [
+                (int(post_id), status, updated or None) for _, post_id, status, updated in CHECKPOINT_VALUES.findall(sql)
+            ]))
+
+    def execute_fetch(self, raise_errors=False):
+        sql = self.query_string()
+        self.clear()
+        if sql.startswith('SELECT post_id, piazza_updated FROM IngestCheckpoints'):
+            return [(post_id, self.checkpoint_updates[post_id]) for post_id, (status, _) in self.checkpoints.items()
+                    if status == CHECKPOINT_SKIPPED]
+        if sql.startswith('SELECT post_id, piazza_updated FROM Posts'):
+            return [(post_id, row[-1]) for post_id, row in self.posts.items()]
+        if 'FROM IngestCheckpoints' in sql:
+            done = {post_id for post_id, (status, attempts) in self.checkpoints.items()
+                    if status != CHECKPOINT_FAILED or attempts >= MAX_FETCH_ATTEMPTS}
+            return [(post_id,) for post_id in done | set(self.posts)]
+        return []
+
+    def apply(self):
+        self.commits += 1
+        if self.fail_after_commits is not None and self.commits >= self.fail_after_commits:
+            self.fail_writes = True
+        for table_name, rows in self.pending:
+            if table_name == 'Posts':
+                for row in rows:
+                    assert row[1] not in self.posts, f"post {row[1]} loaded twice"
+                    self.posts[row[1]] = row
+            elif table_name == 'Embeddings':
+                self.embeddings.extend(rows)
+            elif table_name == 'IngestCheckpoints':
+                for post_id, status, updated in rows:
+                    _, attempts = self.checkpoints.get(post_id, (None, 0))
+                    self.checkpoints[post_id] = (status, attempts + 1)
+                    self.checkpoint_updates[post_id] = updated
+        self.pending = []
+
+
+class FakeEncoder:
+    last_stats = {}
+
+    def encode(self, items):
+        return [(key, np.zeros(768, dtype=np.float32)) for key, _ in items]
+
+
+def rate_limiter():
+    return PiazzaRateLimiter('test', rate_per_minute=1e9, burst=1000, sleep=lambda seconds: None)
+
+
+def run_pipeline(network, SQL, post_ids, **kwargs) -> dict:
+    pipeline = ScrapePipeline(network, SQL, FakeEncoder(), 1, post_ids, rate_limiter=rate_limiter(), **kwargs)
+    result = {}
+    runner = threading.Thread(target=lambda: result.update(pipeline.run()), daemon=True)
+    runner.start()
+    runner.join(RUN_TIMEOUT_SECONDS)
+    assert not runner.is_alive(), "pipeline did not finish"
+    return result
+
+
+@pytest.fixture
+def network():
+    return makeFakePiazza(posts_per_class=40).network('fakenid0')
+
+
+def test_failed_relogin_does_not_hang_the_pipeline():
+    class DownNetwork:
+        def get_post(self, post_id):
+            raise FakeRequestError("Piazza is down")
+
+    def reconnect():
+        raise FakeRequestError("login rate limited")
+
+    post_ids = list(range(5, 15))
+    stats = run_pipeline(DownNetwork(), FakeSQL(), post_ids, reconnect=reconnect, relogin_after=1)
+
+    assert stats['failed'] == len(post_ids)
+
+
+def test_dropped_connection_does_not_hang_the_pipeline(network):
+    SQL = FakeSQL()
+    SQL.fail_writes = True
+    SQL.dropped = True
+    post_ids = sorted(network.posts)
+    # Small queues: a dead load stage would leave the embed stage blocked on put()
+    stats = run_pipeline(network, SQL, post_ids, queue_size=2, batch_posts=1)
+
+    assert stats['load_errors'] > 0
+    assert stats['loaded'] == 0
+    assert not SQL.posts and not SQL.checkpoints
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_stage_crash_reaches_the_end_of_the_pipeline(network, monkeypatch):
+    def crash(self):
+        raise RuntimeError("embed stage died")
+
+    # Past the per-batch error handling: the stage thread itself dies
+    monkeypatch.setattr(ScrapePipeline, '_next_batch', crash)
+    stats = run_pipeline(network, FakeSQL(), sorted(network.posts), queue_size=2, batch_posts=1)
+
+    assert stats['loaded'] == 0
+
+
+def hidden_post_ids(network) -> set:
+    return {post_id for post_id, post in network.posts.items() if post['status'] == 'private' or 'regrade' in post['folders']}
+
+
+def test_resume_after_partial_run(network):
+    SQL = FakeSQL()
+    SQL.fail_after_commits = 3
+    post_ids = sorted(network.posts)
+    first = run_pipeline(network, SQL, post_ids, batch_posts=5)
+    assert first['load_errors'] > 0
+
+    # What scrapeAndDeploy.ingestSemester fetches on the next run
+    done = completedPostIds(SQL, 1)
+    remaining = [post_id for post_id in post_ids if post_id not in done]
+    assert remaining and set(remaining) == set(post_ids) - set(SQL.checkpoints)
+
+    SQL.fail_writes = False
+    SQL.fail_after_commits = None
+    requests = network.requests
+    run_pipeline(network, SQL, remaining, batch_posts=5)
+
+    # Only the posts of the lost batches were fetched again, and none was loaded twice
+    assert network.requests - requests == len(remaining)
+    assert set(SQL.posts) == set(post_ids) - hidden_post_ids(network)
+    assert {post_id for post_id, (status, _) in SQL.checkpoints.items() if status == CHECKPOINT_SKIPPED} == hidden_post_ids(network)
+    assert len(SQL.embeddings) > 0
+
+
+def test_fetch_failures_are_retried_then_given_up(network):
+    flaky = sorted(network.posts)[:3]
+    missing = [1000, 1001]
+    network = FakePiazzaNetwork(network.posts, fail_once=flaky)
+    SQL = FakeSQL()
+    post_ids = sorted(network.posts) + missing
+
+    stats = run_pipeline(network, SQL, post_ids)
+
+    # A temporary error is retried within the run
+    assert all(SQL.checkpoints[post_id][0] == CHECKPOINT_LOADED for post_id in flaky)
+    assert stats['failed'] == len(missing)
+    assert all(SQL.checkpoints[post_id] == (CHECKPOINT_FAILED, 1) for post_id in missing)
+
+    # Posts that do not exist are fetched again by the next runs, until MAX_FETCH_ATTEMPTS
+    for attempt in range(2, MAX_FETCH_ATTEMPTS + 1):
+        remaining = [post_id for post_id in post_ids if post_id not in completedPostIds(SQL, 1)]
+        assert remaining == missing
+        run_pipeline(network, SQL, remaining)
+        assert all(SQL.checkpoints[post_id] == (CHECKPOINT_FAILED, attempt) for post_id in missing)
+    assert set(post_ids) <= completedPostIds(SQL, 1)
+
+
+def test_failed_fetch_without_retries_is_resumed(network):
+    flaky = sorted(network.posts)[:2]
+    network = FakePiazzaNetwork(network.posts, fail_once=flaky)
+    SQL = FakeSQL()
+
+    run_pipeline(network, SQL, sorted(network.posts), fetch_retries=0)
+    remaining = [post_id for post_id in sorted(network.posts) if post_id not in completedPostIds(SQL, 1)]
+    assert remaining == flaky
+
+    run_pipeline(network, SQL, remaining, fetch_retries=0)
+    assert all(SQL.checkpoints[post_id] == (CHECKPOINT_LOADED, 2) for post_id in flaky)
+
+
+def test_sync_does_not_refetch_skipped_posts(network):
+    SQL = FakeSQL()
+    run_pipeline(network, SQL, sorted(network.posts), updates=feedUpdates(network))
+    hidden = sorted(hidden_post_ids(network))
+    assert hidden and not set(hidden) & set(SQL.posts)
+
+    # Private posts and regrade requests have no Posts row, their checkpoint holds the feed time
+    assert changedPostIds(SQL, 1, feedUpdates(network)) == []
+
+    network.edit_post(hidden[0], network.posts[hidden[0]])
+    assert changedPostIds(SQL, 1, feedUpdates(network)) == [hidden[0]]
+
+
+def test_every_failed_fetch_slows_the_rate_down():
+    class DownNetwork:
+        def get_post(self, post_id):
+            raise FakeRequestError("Piazza is down")
+
+    slept = []
+    limiter = PiazzaRateLimiter('test_fetch_failures', rate_per_minute=1e6, burst=1000, min_rate_per_minute=1,
+                                backoff_base_seconds=1, backoff_max_seconds=1, sleep=slept.append)
+    pipeline = ScrapePipeline(DownNetwork(), FakeSQL(), FakeEncoder(), 1, [5], rate_limiter=limiter, fetch_retries=1)
+
+    assert pipeline._fetch(5) is None
+    # Both attempts are counted and halve the rate; only the one followed by a retry sleeps
+    assert limiter.errors_counter.value == 2
+    assert limiter.rate_per_minute == 1e6 / 4
+    assert len(slept) == 1
@@ -0,0 +1,68 @@
+import pytest
+
+from PostGresQueryGenerator import PGQuery as PGQ
+from SemesterPartitions import SemesterDirectory, name_legacy_semesters, LEGACY_SEMESTER_NAMES
+
+SEMESTERS = [(1, 'CSCI 360abc', 'abc'), (3, 'Spring 2023', 'def'), (7, 'CSCI 360ghi', 'ghi')]
+
+
+class FakeSQL(PGQ):
+    """
+    A Semesters table answering the UPDATE ... RETURNING of name_legacy_semesters.
+    """
+
+    def __init__(self, semesters):
+        super().__init__(None)
+        self.names = {semester_id: name for semester_id, name, _ in semesters}
+        self.version = 0
+
+    def execute_fetch(self, raise_errors=False):
+        sql, params = self.query_string(), self.params
+        self.clear()
+        assert sql.startswith('UPDATE Semesters') and 'RETURNING semester_id' in sql
+        semester_id = int(sql.split('semester_id = ')[1].split()[0])
+        if semester_id not in self.names or self.names[semester_id] == params[1]:
+            return []
+        self.names[semester_id] = params[0]
+        return [(semester_id,)]
+
+    def execute_nofetch(self, raise_errors=False):
+        assert self.query_string().startswith('UPDATE DataVersion')
+        self.clear()
+        self.version += 1
+
+    def commit(self):
+        return self
+
+
+def test_directory_is_read_before_start_returns():
+    directory = SemesterDirectory()
+    directory.start(lambda: SEMESTERS, interval=3600)
+
+    assert directory.name(3) == 'Spring 2023'
+    assert directory.name(99) == '99'
+
+
+def test_legacy_semester_names_are_restored_once():
+    SQL = FakeSQL(SEMESTERS)
+    name_legacy_semesters(SQL)
+
+    assert SQL.names == {1: LEGACY_SEMESTER_NAMES[1], 3: 'Spring 2023', 7: 'CSCI 360ghi'}
+    assert SQL.version == 1
+
+    # A second deploy changes nothing and keeps the response cache
+    name_legacy_semesters(SQL)
+    assert SQL.version == 1
+
+
+def test_unknown_semester_filter_is_a_bad_request(monkeypatch):
+    import WebServer
+
+    directory = SemesterDirectory()
+    directory.poll(lambda: SEMESTERS)
+    monkeypatch.setattr(WebServer, 'semester_directory', directory)
+
+    assert WebServer.search_options({'semesters': ['Spring 2023', 7]}) == {'semesters': (3, 7)}
+    for data in ({'semesters': 'Fall 2030'}, {'ef_search': 'many'}):
+        with pytest.raises(WebServer.BadRequestError):
+            WebServer.search_options(data)